@@ -36,7 +36,7 @@ long_desc = """
   * more to come.
 """
 
-scripts = ['bin/ldi']
+scripts = ['bin/ldi', 'bin/ldid']
 
 from os.path import join, isdir
 include_dirs = [join('tests', 'data'), join('tests', 'packages')]
@@ -0,0 +1,209 @@
+# Copyright (c) 2007-2011 LOGILAB S.A. (Paris, FRANCE).
+# http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""archive of the files removed from the distributions of a repository.
+
+Files are stored by source package, sharded the way pool/ directories are::
+
+  archive/<dist>/<prefix>/<source package>/<file>
+
+where the prefix is the first letter of the source package name, or its four
+first letters for lib* packages. Each archived file is recorded in the
+append-only `archive/MANIFEST` file, one tab separated line giving the date,
+the distribution, the source package, the file name (relative to the
+distribution directory) and the reason why it was archived. The line is also
+appended to the `.manifest` file of the source package directory, so that
+looking up the history of a package doesn't read the whole manifest.
+"""
+
+from __future__ import with_statement
+
+import io
+import os
+import os.path as osp
+import shutil
+import time
+
+from debinstall.debfiles import Changes
+
+MANIFEST = 'MANIFEST'
+PACKAGE_MANIFEST = '.manifest'
+
+
+def pool_prefix(package):
+    """return the shard directory name of a source package"""
+    if package.startswith('lib') and len(package) > 3:
+        return package[:4]
+    return package[:1]
+
+def package_name(fname):
+    """guess the package name of a file from its name"""
+    return fname.split('_', 1)[0]
+
+
+def _append(path, lines):
+    # a single write in append mode, so that concurrent writers don't
+    # interleave their lines
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, ''.join(lines).encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def _read_manifest(path):
+    """yield the entries of a manifest file"""
+    if not osp.exists(path):
+        return
+    with io.open(path, encoding='utf-8') as stream:
+        for line in stream:
+            entry = line.rstrip('\n').split('\t', 4)
+            if len(entry) == 5:
+                yield tuple(entry)
+
+
+class ArchiveStore(object):
+    """sharded archive directory of a repository"""
+    def __init__(self, directory, logger):
+        self.directory = directory
+        self.logger = logger
+
+    def __repr__(self):
+        return 'ArchiveStore(%s)' % self.directory
+
+    @property
+    def manifest(self):
+        return osp.join(self.directory, MANIFEST)
+
+    def relpath(self, package, fname):
+        """return the path of an archived file relative to the directory of
+        its distribution
+        """
+        return osp.join(pool_prefix(package), package, fname)
+
+    def archive(self, dist, package, fpath, reason, copy=False):
+        """move (or copy if `copy` is true) the file `fpath` of source package
+        `package` to the archive of distribution `dist`, and record it in the
+        manifest
+        """
+        relpath = self.relpath(package, osp.basename(fpath))
+        destfile = osp.join(self.directory, dist, relpath)
+        destdir = osp.dirname(destfile)
+        if not osp.isdir(destdir):
+            try:
+                os.makedirs(destdir)
+            except OSError:
+                if not osp.isdir(destdir): # else created meanwhile
+                    raise
+        if copy:
+            self.logger.debug('copy %s %s', fpath, destfile)
+            shutil.copy(fpath, destfile)
+        else:
+            self.logger.debug('move %s %s', fpath, destfile)
+            shutil.move(fpath, destfile)
+        self.record([(time.time(), dist, package, relpath, reason)])
+        return destfile
+
+    def package_manifest(self, dist, package):
+        return osp.join(self.directory, dist, pool_prefix(package), package,
+                        PACKAGE_MANIFEST)
+
+    def record(self, entries):
+        """append (timestamp, distribution, package, relative path, reason)
+        entries to the manifest and to the manifests of their source packages
+        """
+        lines = []
+        packages = {}
+        for timestamp, dist, package, relpath, reason in entries:
+            line = u'%s\t%s\t%s\t%s\t%s\n' % (
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)),
+                dist, package, relpath, reason)
+            lines.append(line)
+            packages.setdefault((dist, package), []).append(line)
+        _append(self.manifest, lines)
+        for dist, package in sorted(packages):
+            _append(self.package_manifest(dist, package),
+                    packages[(dist, package)])
+
+    def entries(self, package=None, dists=None):
+        """yield (date, distribution, package, relative path, reason) entries
+        of the manifest, optionally restricted to a source package and to
+        some distributions
+        """
+        if package is None:
+            for entry in _read_manifest(self.manifest):
+                if dists is None or entry[1] in dists:
+                    yield entry
+            return
+        if dists is None:
+            if not osp.isdir(self.directory):
+                return
+            dists = [dist for dist in os.listdir(self.directory)
+                     if osp.isdir(osp.join(self.directory, dist))]
+        entries = []
+        for dist in sorted(dists):
+            entries += [entry for entry in _read_manifest(
+                self.package_manifest(dist, package)) if entry[2] == package]
+        # in chronological order, as in the manifest
+        entries.sort(key=lambda entry: entry[0])
+        for entry in entries:
+            yield entry
+
+    def files(self, dist, package):
+        """return the sorted list of files of a source package found in the
+        archive of a distribution
+        """
+        pkgdir = osp.join(self.directory, dist, pool_prefix(package), package)
+        if not osp.isdir(pkgdir):
+            return []
+        return sorted(osp.join(pkgdir, fname) for fname in os.listdir(pkgdir)
+                      if fname != PACKAGE_MANIFEST)
+
+    def migrate(self, dist):
+        """move files stored directly in the archive directory of a
+        distribution (as ldi used to do) to their shard; return the number of
+        migrated files.
+
+        Source packages are found from the archived changes files, or guessed
+        from the file name.
+        """
+        distdir = osp.join(self.directory, dist)
+        flat = [fname for fname in os.listdir(distdir)
+                if not osp.isdir(osp.join(distdir, fname))]
+        sources = {}
+        for fname in flat:
+            if fname.endswith('.changes'):
+                try:
+                    changes = Changes.open(osp.join(distdir, fname))
+                    for path in changes.get_all_files(check_if_exists=False):
+                        sources[osp.basename(path)] = changes['Source']
+                except Exception as ex:
+                    self.logger.warning('cannot read %s: %s', fname, ex)
+        entries = []
+        for fname in sorted(flat):
+            package = sources.get(fname) or package_name(fname)
+            fpath = osp.join(distdir, fname)
+            relpath = self.relpath(package, fname)
+            destdir = osp.join(distdir, osp.dirname(relpath))
+            if not osp.isdir(destdir):
+                os.makedirs(destdir)
+            mtime = os.stat(fpath).st_mtime
+            os.rename(fpath, osp.join(distdir, relpath))
+            entries.append((mtime, dist, package, relpath, 'migrated'))
+            if len(entries) >= 1000:
+                self.record(entries)
+                entries = []
+        if entries:
+            self.record(entries)
+        return len(flat)
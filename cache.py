@@ -0,0 +1,243 @@
+# Copyright (c) 2007-2011 LOGILAB S.A. (Paris, FRANCE).
+# http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""persistent caches stored in the cache directory of a repository"""
+
+import os
+import os.path as osp
+import sqlite3
+import threading
+from time import time
+
+
+def stat_key(path):
+    """return the (device, inode, size, mtime in ns, ctime in ns) tuple
+    identifying the content of a file.
+
+    The mtime of a file may be restored by whoever can write it (os.utime) but
+    its ctime can't be set from userspace, so that a file rewritten in place
+    doesn't keep its key.
+    """
+    st = os.stat(path)
+    try:
+        mtime_ns, ctime_ns = st.st_mtime_ns, st.st_ctime_ns
+    except AttributeError: # python < 3.3
+        mtime_ns, ctime_ns = int(st.st_mtime * 1e9), int(st.st_ctime * 1e9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns)
+
+
+class SQLiteCache(object):
+    """base class for size-bounded caches stored in a sqlite database.
+
+    Concrete classes define the `table` name and its `schema`, which must
+    include a `last_used` column: when the cache grows beyond `maxsize` entries,
+    the least recently used ones are evicted. The `version` of the schema is
+    stored in the database, tables of other versions are dropped.
+    """
+    table = None
+    schema = None
+    version = 0
+
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._inserted = 0
+        self.cnx = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # this is a cache: losing the last transactions on power loss is fine
+        self.cnx.execute('PRAGMA synchronous=OFF')
+        if self.cnx.execute('PRAGMA user_version').fetchone()[0] != self.version:
+            self.cnx.execute('DROP TABLE IF EXISTS %s' % self.table)
+            self.cnx.execute('PRAGMA user_version=%d' % self.version)
+        self.cnx.execute('CREATE TABLE IF NOT EXISTS %s (%s)'
+                         % (self.table, self.schema))
+        self.cnx.commit()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.path)
+
+    def execute(self, sql, args=()):
+        with self._lock:
+            return self.cnx.execute(sql, args).fetchall()
+
+    def commit(self):
+        with self._lock:
+            self.cnx.commit()
+
+    def touch(self, sql, args):
+        """update the last use of an entry, committing at once so that the
+        database isn't left locked for other processes
+        """
+        with self._lock:
+            self.cnx.execute(sql, args)
+            self.cnx.commit()
+
+    def evict(self):
+        """drop least recently used entries beyond maxsize"""
+        with self._lock:
+            count = self.cnx.execute('SELECT COUNT(*) FROM %s'
+                                     % self.table).fetchone()[0]
+            if count > self.maxsize:
+                self.cnx.execute(
+                    'DELETE FROM %(table)s WHERE rowid IN (SELECT rowid FROM '
+                    '%(table)s ORDER BY last_used LIMIT ?)'
+                    % {'table': self.table}, (count - self.maxsize,))
+            self.cnx.commit()
+            self._inserted = 0
+
+    def inserted(self):
+        """to be called after each insertion, evict old entries from time to
+        time
+        """
+        self._inserted += 1
+        if self._inserted >= max(self.maxsize // 10, 1):
+            self.evict()
+
+    def close(self):
+        self.evict()
+        self.cnx.close()
+
+    def stats(self):
+        return '%s: %d hits, %d misses' % (self, self.hits, self.misses)
+
+
+class HashCache(SQLiteCache):
+    """cache of file digests, keyed on (device, inode, size, mtime, ctime), so
+    that unmodified files are never hashed again
+    """
+    table = 'digests'
+    schema = ('dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+              'ctime_ns INTEGER, sha256 TEXT, sha1 TEXT, md5 TEXT, '
+              'last_used REAL, '
+              'PRIMARY KEY (dev, ino, size, mtime_ns, ctime_ns)')
+    version = 1
+    algorithms = ('sha256', 'sha1', 'md5')
+
+    def get(self, key, algorithms):
+        """return a {algorithm: digest} dictionary for the file identified by
+        `key` (see `stat_key`), or None if some of the requested algorithms are
+        unknown
+        """
+        rows = self.execute('SELECT sha256, sha1, md5 FROM digests WHERE '
+                            'dev=? AND ino=? AND size=? AND mtime_ns=? AND '
+                            'ctime_ns=?', key)
+        if rows:
+            digests = dict((algo, digest) for algo, digest
+                           in zip(self.algorithms, rows[0]) if digest)
+            if all(algo in digests for algo in algorithms):
+                self.hits += 1
+                self.touch('UPDATE digests SET last_used=? WHERE dev=? AND '
+                           'ino=? AND size=? AND mtime_ns=? AND ctime_ns=?',
+                           (time(),) + tuple(key))
+                return digests
+        self.misses += 1
+        return None
+
+    def set(self, key, digests):
+        """record digests for the file identified by `key`, merging them with
+        already known ones
+        """
+        old = self.execute('SELECT sha256, sha1, md5 FROM digests WHERE '
+                           'dev=? AND ino=? AND size=? AND mtime_ns=? AND '
+                           'ctime_ns=?', key)
+        if old:
+            for algo, digest in zip(self.algorithms, old[0]):
+                if digest:
+                    digests.setdefault(algo, digest)
+        values = [digests.get(algo) for algo in self.algorithms]
+        self.execute('INSERT OR REPLACE INTO digests VALUES (?,?,?,?,?,?,?,?,?)',
+                     tuple(key) + tuple(values) + (time(),))
+        self.commit()
+        self.inserted()
+
+
+class SignatureCache(SQLiteCache):
+    """cache of gpg signature verification results, keyed on the sha256 of the
+    signed file and an identifier of the keyring used to check it
+    """
+    table = 'signatures'
+    schema = ('sha256 TEXT, keyring TEXT, valid INTEGER, keyid TEXT, '
+              'fingerprint TEXT, signer TEXT, last_used REAL, '
+              'PRIMARY KEY (sha256, keyring)')
+
+    def get(self, key):
+        """return a (valid, keyid, fingerprint, signer) tuple or None"""
+        rows = self.execute('SELECT valid, keyid, fingerprint, signer FROM '
+                            'signatures WHERE sha256=? AND keyring=?', key)
+        if rows:
+            self.hits += 1
+            self.touch('UPDATE signatures SET last_used=? WHERE sha256=? AND '
+                       'keyring=?', (time(),) + tuple(key))
+            valid, keyid, fingerprint, signer = rows[0]
+            return bool(valid), keyid, fingerprint, signer
+        self.misses += 1
+        return None
+
+    def set(self, key, result):
+        self.execute('INSERT OR REPLACE INTO signatures VALUES (?,?,?,?,?,?,?)',
+                     tuple(key) + tuple(result) + (time(),))
+        self.commit()
+        self.inserted()
+
+
+class CheckerCache(SQLiteCache):
+    """cache of checkers results, keyed on the sha256 of the checked changes
+    file (which holds the checksums of every uploaded file), the checker name,
+    its options and the version of the underlying tool
+    """
+    table = 'checkers'
+    schema = ('sha256 TEXT, checker TEXT, options TEXT, version TEXT, '
+              'success INTEGER, stdout BLOB, stderr BLOB, last_used REAL, '
+              'PRIMARY KEY (sha256, checker, options, version)')
+
+    def get(self, key):
+        """return a (success, stdout, stderr) tuple or None"""
+        rows = self.execute('SELECT success, stdout, stderr FROM checkers WHERE '
+                            'sha256=? AND checker=? AND options=? AND version=?',
+                            key)
+        if rows:
+            self.hits += 1
+            self.touch('UPDATE checkers SET last_used=? WHERE sha256=? AND '
+                       'checker=? AND options=? AND version=?',
+                       (time(),) + tuple(key))
+            success, stdout, stderr = rows[0]
+            return bool(success), bytes(stdout), bytes(stderr)
+        self.misses += 1
+        return None
+
+    def set(self, key, result):
+        success, stdout, stderr = result
+        self.execute('INSERT OR REPLACE INTO checkers VALUES (?,?,?,?,?,?,?,?)',
+                     tuple(key) + (success, sqlite3.Binary(stdout),
+                                   sqlite3.Binary(stderr), time()))
+        self.commit()
+        self.inserted()
+
+
+def open_cache(cachedir, cacheclass, maxsize, logger=None):
+    """return an instance of `cacheclass` stored in `cachedir`, or None if it
+    can't be opened (the caller then works without cache)
+    """
+    try:
+        if not osp.isdir(cachedir):
+            os.makedirs(cachedir)
+        return cacheclass(osp.join(cachedir, '%s.db' % cacheclass.table),
+                          maxsize)
+    except (OSError, sqlite3.Error) as ex:
+        if logger is not None:
+            logger.warning('cannot use %s cache in %s: %s',
+                           cacheclass.table, cachedir, ex)
+        return None
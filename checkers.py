@@ -16,41 +16,401 @@
 """common interface to lintian"""
 
 import os
+import os.path as osp
+import re
+import signal
+import sys
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
+from threading import Timer
+
+from logilab.common.decorators import cached
+
+from debinstall.__pkginfo__ import version as debinstall_version
+from debinstall.debfiles import (BadPackage, Changes, CheckerError, DebFile,
+                                 digest_file, strip_epoch)
+
+
+def user_privileges():
+    """give up the effective privileges of the current process for those of
+    the real user
+    """
+    gid, uid = os.getgid(), os.getuid()
+    if os.getegid() != gid:
+        os.setresgid(gid, gid, gid)
+    if os.geteuid() != uid:
+        os.setresuid(uid, uid, uid)
+
+def _new_session():
+    os.setsid()
+    user_privileges()
+
+def process_options(new_session=False):
+    """return Popen keyword arguments running a process with the real user
+    privileges, otherwise the perl behind lintian complains loudly, and in a
+    new session if `new_session` is true (so that its children may be killed
+    with it). Privileges of ldi (and of its other threads) are left untouched.
+
+    preexec_fn isn't safe when other threads run, it's only used when
+    python doesn't provide an alternative.
+    """
+    drop = os.geteuid() != os.getuid() or os.getegid() != os.getgid()
+    if sys.version_info >= (3, 9):
+        options = {'start_new_session': new_session}
+        if drop:
+            options.update(user=os.getuid(), group=os.getgid())
+        return options
+    if sys.version_info >= (3, 2) and not drop:
+        return {'start_new_session': new_session}
+    return {'preexec_fn': new_session and _new_session or user_privileges}
 
 
 class Checker(object):
+    name = None
     command = None
     options = []
+    version_options = ['--version']
     ok_status = (0, )
-    def run(self, changesfile):
-        # we need to run this with normal privileges, otherwise the
-        # perl behind lintian complains loudly
-        euid = os.geteuid()
-        egid = os.getegid()
-        os.seteuid(os.getuid())
-        os.setegid(os.getgid())
-        status, stdout, stderr = self.do_run(changesfile)
-        os.seteuid(euid)
-        os.setegid(egid)
-        return status in self.ok_status, stdout, stderr
-
-    def do_run(self, changesfile):
-        argv = [self.command] + self.options + [changesfile]
+    # in-process checkers are cheap, they're run first and other checkers are
+    # skipped for changes files they reject
+    inprocess = False
+    # maximum number of changes files checked by a single process, 1 for
+    # checkers which can't split their output per changes file
+    batchsize = 1
+
+    @cached
+    def version(self):
+        """return the version of the checker tool, used to invalidate cached
+        results when it is upgraded
+        """
+        try:
+            pipe = Popen([self.command] + self.version_options,
+                         stdout=PIPE, stderr=PIPE, **process_options())
+        except OSError:
+            raise Exception('%s is not installed' % self.command)
+        stdout, _ = pipe.communicate()
+        return stdout.decode('utf-8', 'replace').strip()
+
+    def cache_key(self, changesfile):
+        return (digest_file(changesfile, ('sha256',))['sha256'], self.name,
+                ' '.join(self.options), self.version())
+
+    def run(self, changesfile, cache=None, timeout=None):
+        """return a (success, stdout, stderr) tuple. If a
+        `debinstall.cache.CheckerCache` is given, the checker is run only if no
+        result is known for this changes file. The checker is killed after
+        `timeout` seconds (and its failure isn't cached).
+        """
+        return self.run_batch([changesfile], cache, timeout)[changesfile]
+
+    def run_batch(self, changesfiles, cache=None, timeout=None):
+        """same as `run` for several changes files, return a {changes file:
+        (success, stdout, stderr)} dictionary
+        """
+        results = {}
+        keys = {}
+        for changesfile in changesfiles:
+            if cache is not None:
+                keys[changesfile] = key = self.cache_key(changesfile)
+                result = cache.get(key)
+                if result is not None:
+                    results[changesfile] = result
+        todo = [changesfile for changesfile in changesfiles
+                if changesfile not in results]
+        if len(todo) > 1:
+            batch_results = self.do_run_batch(todo, timeout)
+        else:
+            batch_results = None
+        for changesfile in todo:
+            if batch_results is not None:
+                result = batch_results[changesfile]
+            else:
+                result = self.result(self.do_run(changesfile, timeout), timeout)
+            results[changesfile] = result
+            if cache is not None and result[0] is not None:
+                cache.set(keys[changesfile], result)
+        return dict((changesfile, (bool(success), stdout, stderr))
+                    for changesfile, (success, stdout, stderr)
+                    in results.items())
+
+    def result(self, run_result, timeout):
+        """turn a do_run result into a (success, stdout, stderr) tuple, success
+        being None on timeout
+        """
+        status, stdout, stderr = run_result
+        if status is None:
+            return (None, stdout, stderr +
+                    ('\n%s killed after %s seconds' % (self.command, timeout)
+                     ).encode('utf-8'))
+        return (status in self.ok_status, stdout, stderr)
+
+    def do_run(self, changesfile, timeout=None):
+        """return (exit status, stdout, stderr), exit status being None if the
+        process has been killed on timeout
+        """
+        return self.execute([changesfile], timeout)
+
+    def do_run_batch(self, changesfiles, timeout=None):
+        """check several changes files at once and return a {changes file:
+        (success, stdout, stderr)} dictionary, or None if the checker can't
+        tell results apart
+        """
+        return None
+
+    def execute(self, paths, timeout=None):
+        argv = [self.command] + self.options + list(paths)
         try:
-            pipe = Popen(argv, stdout=PIPE, stderr=PIPE)
+            pipe = Popen(argv, stdout=PIPE, stderr=PIPE,
+                         **process_options(new_session=True))
         except OSError:
             raise Exception('%s is not installed' % self.command)
-        stdout = pipe.stdout.read()
-        stderr = pipe.stderr.read()
-        status = pipe.wait()
-        return status, stdout, stderr
+        killed = []
+        def kill():
+            killed.append(True)
+            try:
+                os.killpg(pipe.pid, signal.SIGKILL)
+            except OSError:
+                pass # already dead
+        timer = None
+        if timeout:
+            timer = Timer(timeout, kill)
+            timer.start()
+        # communicate reads stdout and stderr at the same time, so the checker
+        # can't block on a full pipe
+        stdout, stderr = pipe.communicate()
+        if timer is not None:
+            timer.cancel()
+        if killed:
+            return None, stdout, stderr
+        return pipe.returncode, stdout, stderr
 
 class LintianChecker(Checker):
+    name = "lintian"
     command = "lintian"
     # XXX make options configurable
     options = ['-vi', '--suppress-tags', 'bad-distribution-in-changes-file']
     ok_status = (0, 2)
+    # lintian exits with this status when it emitted some error tags
+    error_status = 1
+    batchsize = 20
 
+    # "E: package source: tag extra" or "N: Processing changes file package ..."
+    tag_rgx = re.compile(r'^([A-Z]): (\S+?)(?: (?:source|udeb|changes|buildinfo|binary))?: ')
+    processing_rgx = re.compile(r'^N: Processing \S+ file (\S+) ')
 
-ALL_CHECKERS = {'lintian': LintianChecker()}
+    def do_run_batch(self, changesfiles, timeout=None):
+        """run lintian once on all changes files, then split its output
+        according to the package names each changes file contains. Return None
+        if some package name is shared by several changes files or some error
+        can't be attributed.
+        """
+        owners = {}
+        for changesfile in changesfiles:
+            changes = Changes.open(changesfile)
+            names = changes.get_packages()
+            names.add(changes.filename[:-len('.changes')])
+            for name in names:
+                if owners.setdefault(name, changesfile) != changesfile:
+                    return None
+        status, stdout, stderr = self.execute(
+            changesfiles, timeout and timeout * len(changesfiles))
+        if status is None:
+            return dict((changesfile, self.result((None, stdout, stderr),
+                                                  timeout * len(changesfiles)))
+                        for changesfile in changesfiles)
+        if status not in self.ok_status + (self.error_status,):
+            return None
+        output = dict((changesfile, []) for changesfile in changesfiles)
+        failed = set()
+        current = None
+        for line in stdout.splitlines(True):
+            text = line.decode('utf-8', 'replace')
+            match = self.processing_rgx.match(text) or self.tag_rgx.match(text)
+            if match:
+                name = match.groups()[-1]
+                if name not in owners:
+                    return None
+                current = owners[name]
+                if match.re is self.tag_rgx and match.group(1) == 'E':
+                    failed.add(current)
+            if current is None:
+                # header, shared by every changes file
+                for lines in output.values():
+                    lines.append(line)
+            else:
+                output[current].append(line)
+        if status == self.error_status and not failed:
+            return None
+        return dict((changesfile, (status in self.ok_status
+                                   or changesfile not in failed,
+                                   b''.join(output[changesfile]), stderr))
+                    for changesfile in changesfiles)
+
+
+class StructureChecker(Checker):
+    """cheap in-process checks of the structure of an upload, run before
+    other checkers which aren't run when it fails:
+
+    * the changes file name is <source>_<version>_<arch>.changes, with a
+      version the repository can parse,
+    * files have the size declared in the changes file,
+    * binary packages are valid ar archives with readable control.tar and
+      data.tar headers, their control file has the required fields, and their
+      name is <package>_<version>_<architecture>.deb
+    """
+    name = "structure"
+    inprocess = True
+    required_fields = ('Package', 'Version', 'Architecture', 'Maintainer',
+                       'Description')
+
+    def version(self):
+        return debinstall_version
+
+    def run_batch(self, changesfiles, cache=None, timeout=None):
+        results = {}
+        for changesfile in changesfiles:
+            errors = self.check(changesfile)
+            results[changesfile] = (not errors, ''.join(
+                '%s\n' % error for error in errors).encode('utf-8'), b'')
+        return results
+
+    def check(self, changesfile):
+        """return a list of error messages"""
+        from debinstall.debrepo import Version
+        errors = []
+        try:
+            changes = Changes.open(changesfile)
+        except Exception as ex:
+            return ['%s: cannot read changes file: %s' % (changesfile, ex)]
+        for field in ('Source', 'Version', 'Files'):
+            try:
+                changes[field]
+            except KeyError:
+                errors.append('%s: missing %s field' % (changes.filename, field))
+        if errors:
+            return errors
+        source, version = changes['Source'], changes['Version']
+        parts = changes.filename[:-len('.changes')].split('_')
+        if len(parts) != 3:
+            errors.append('%s: file name is not <source>_<version>_<arch>'
+                          '.changes' % changes.filename)
+        elif (parts[0], parts[1]) != (source, strip_epoch(version)):
+            errors.append('%s: file name does not match source %s version %s'
+                          % (changes.filename, source, version))
+        try:
+            Version(version)
+        except ValueError as ex:
+            errors.append('%s: unsupported version %s (%s)'
+                          % (changes.filename, version, ex))
+        for info in changes['Files']:
+            if len(info) != 5 or not info['size'].isdigit():
+                errors.append('%s: malformed Files line' % changes.filename)
+                continue
+            path = osp.join(changes.dirname, info['name'])
+            try:
+                size = os.stat(path).st_size
+            except OSError as ex:
+                errors.append('%s: %s' % (info['name'], ex))
+                continue
+            if size != int(info['size']):
+                errors.append('%s: size is %s, %s expected' % (
+                    info['name'], size, info['size']))
+            elif path.endswith(('.deb', '.udeb')):
+                errors += self.check_deb(path)
+        return errors
+
+    def check_deb(self, path):
+        deb = DebFile(path)
+        try:
+            deb.check_tar_header('control.tar')
+            deb.check_tar_header('data.tar')
+            control = deb.control()
+        except ImportError:
+            # optional decompression module is missing, leave it to others
+            return []
+        except BadPackage as ex:
+            return [str(ex)]
+        errors = ['%s: missing %s field' % (deb.filename, field)
+                  for field in self.required_fields if not control.get(field)]
+        if not errors:
+            expected = '%s_%s_%s' % (control['Package'],
+                                     strip_epoch(control['Version']),
+                                     control['Architecture'])
+            if osp.splitext(deb.filename)[0] != expected:
+                errors.append('%s: file name does not match control file '
+                              '(%s)' % (deb.filename, expected))
+        return errors
+
+
+ALL_CHECKERS = {'structure': StructureChecker(),
+                'lintian': LintianChecker()}
+
+
+def get_checkers(names):
+    checkers = []
+    for name in names:
+        try:
+            checkers.append(ALL_CHECKERS[name])
+        except KeyError:
+            raise Exception('no such checker %s' % name)
+    return checkers
+
+def run_checkers(changesfiles, names, cache=None, jobs=1, timeout=None,
+                 batchsize=None):
+    """run the named checkers on every changes file, `jobs` checker processes
+    at a time, each being killed after `timeout` seconds. Checkers which
+    support it check up to `batchsize` (default to the checker's own limit)
+    changes files per process. In-process checkers run first, and changes
+    files they reject aren't given to other checkers.
+
+    Return a {changes file: CheckerError or None} dictionary. Errors are
+    reported in the order of `changesfiles` and `names`, whatever the order in
+    which checkers complete.
+    """
+    checkers = get_checkers(names)
+    checker_results = {}
+    rejected = set()
+    for checker in checkers:
+        if checker.inprocess:
+            for changesfile, result in checker.run_batch(changesfiles).items():
+                checker_results[(changesfile, checker.name)] = result
+                if not result[0]:
+                    rejected.add(changesfile)
+    remaining = [changesfile for changesfile in changesfiles
+                 if changesfile not in rejected]
+    tasks = []
+    for checker in checkers:
+        if checker.inprocess:
+            continue
+        size = max(min(batchsize or checker.batchsize, checker.batchsize), 1)
+        for i in range(0, len(remaining), size):
+            tasks.append((checker, remaining[i:i+size]))
+    def run(task):
+        checker, batch = task
+        return checker.run_batch(batch, cache, timeout)
+    if jobs > 1 and len(tasks) > 1:
+        pool = ThreadPool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(run, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run(task) for task in tasks]
+    for (checker, _), batch_results in zip(tasks, results):
+        for changesfile, result in batch_results.items():
+            checker_results[(changesfile, checker.name)] = result
+    errors = {}
+    for changesfile in changesfiles:
+        messages = []
+        for checker in checkers:
+            try:
+                success, stdout, stderr = checker_results[(changesfile,
+                                                           checker.name)]
+            except KeyError:
+                continue # skipped after an in-process checker failure
+            if not success:
+                messages.append('checker %s is in error on %s: \n%s\n%s'
+                                % (checker.name, changesfile, stdout, stderr))
+        errors[changesfile] = messages and CheckerError('\n'.join(messages)) or None
+    return errors
@@ -0,0 +1,509 @@
+# Copyright (c) 2007-2011 LOGILAB S.A. (Paris, FRANCE).
+# http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""long running ldi process serving a repository (`ldid`).
+
+The daemon watches the incoming queues of the repository (with inotify when
+available, else by polling their modification time) and publishes them once no
+changes file arrived for a while. It also runs upload, publish and list
+commands sent by `ldi` on a local unix socket, one at a time, so that parsed
+changes files, imported modules and the repository, with its open caches,
+stanza store and metadata index, are kept from one command to the other.
+
+Requests and responses are single lines of JSON. Commands run with the
+privileges of the daemon, so they are only accepted with a fixed set of options
+(see `check_arguments`), on the repository served and from members of the
+group of its incoming directory (upload) or of its dists directory (publish),
+as told by the credentials of the peer of the socket.
+"""
+
+from __future__ import with_statement
+
+import ctypes
+import ctypes.util
+import errno
+import grp
+import json
+import logging
+import os
+import os.path as osp
+import pwd
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+try:
+    import socketserver
+except ImportError: # python 2
+    import SocketServer as socketserver
+try:
+    from StringIO import StringIO
+except ImportError: # python 3
+    from io import StringIO
+
+from debinstall.cache import stat_key
+
+SOCKET_NAME = 'ldid.sock'
+# commands which may be run by the daemon, with the options they accept mapped
+# to whether they take a value
+COMMANDS = {
+    'upload': {'--checkers': True, '-C': True,
+               '--distribution': True, '-d': True},
+    'publish': {'--checkers': True, '-C': True, '--refresh': False,
+                '-r': False, '--no-confirm': False, '-u': False,
+                '--coalesce': False, '--wait': False},
+    'list': {'--distribution': True, '-d': True, '--orphaned': True,
+             '-o': True},
+    }
+# options of publish telling not to ask for a confirmation
+NO_CONFIRM_OPTIONS = ('--no-confirm', '-u', '--coalesce')
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+PEERCRED = struct.Struct('3i')
+
+# from sys/inotify.h
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def socket_path(repodir):
+    """return the path of the socket of the daemon of a repository"""
+    return osp.join(repodir, SOCKET_NAME)
+
+def check_arguments(command, args):
+    """return the positional arguments of a command to be run by the daemon,
+    raise ValueError if it can't be because of the command or its options
+    """
+    if command not in COMMANDS:
+        raise ValueError('command %r not allowed' % command)
+    options = COMMANDS[command]
+    positionals = []
+    given = set()
+    args = iter(args)
+    for arg in args:
+        if arg == '--':
+            positionals.extend(args)
+        elif not arg.startswith('-') or arg == '-':
+            positionals.append(arg)
+        elif arg.startswith('--'):
+            name = arg.split('=', 1)[0]
+            if name not in options:
+                raise ValueError('option %s not allowed' % name)
+            if options[name] and '=' not in arg and next(args, None) is None:
+                raise ValueError('option %s requires a value' % name)
+            given.add(name)
+        else:
+            name = arg[:2]
+            if name not in options or (len(arg) > 2 and not options[name]):
+                raise ValueError('option %s not allowed' % arg)
+            if options[name] and len(arg) == 2 and next(args, None) is None:
+                raise ValueError('option %s requires a value' % name)
+            given.add(name)
+    if command == 'publish' and not given.intersection(NO_CONFIRM_OPTIONS):
+        raise ValueError('publish requires --no-confirm, ldid cannot ask for '
+                         'a confirmation')
+    return positionals
+
+def peer_credentials(sock):
+    """return the (pid, uid, gid) of the process connected to a unix
+    socket"""
+    return PEERCRED.unpack(sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                           PEERCRED.size))
+
+def is_member(uid, gid, group):
+    """return True if the user `uid`, whose process runs with the group `gid`,
+    belongs to `group`"""
+    if gid == group:
+        return True
+    try:
+        user = pwd.getpwuid(uid)
+        return user.pw_gid == group or user.pw_name in grp.getgrgid(group).gr_mem
+    except KeyError:
+        return False
+
+def forward(path, command, args, loglevel=None):
+    """run a command in the daemon listening on `path` and return its response,
+    a dictionary with the exit `status` of the command, its `stdout` and its
+    `log` output. Raise socket.error if the daemon can't be reached.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        request = {'command': command, 'args': args, 'loglevel': loglevel}
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        line = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not line:
+        raise socket.error(errno.ECONNRESET, 'no response from %s' % path)
+    return json.loads(line.decode('utf-8'))
+
+
+class PollingWatcher(object):
+    """watch directories by polling their modification time"""
+    delay = 1
+
+    def __init__(self):
+        self.directories = {}
+
+    def __repr__(self):
+        return 'PollingWatcher(%d directories)' % len(self.directories)
+
+    def watch(self, directories):
+        """set the watched directories"""
+        for directory in list(self.directories):
+            if directory not in directories:
+                del self.directories[directory]
+        for directory in directories:
+            if directory not in self.directories:
+                self.directories[directory] = self._mtime(directory)
+
+    def _mtime(self, directory):
+        try:
+            return stat_key(directory)[3]
+        except OSError:
+            return None
+
+    def wait(self, timeout):
+        """return the set of watched directories modified within `timeout`
+        seconds, empty if none was
+        """
+        end = time.time() + timeout
+        while True:
+            changed = set()
+            for directory, mtime in self.directories.items():
+                current = self._mtime(directory)
+                if current != mtime:
+                    self.directories[directory] = current
+                    changed.add(directory)
+            remaining = end - time.time()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.delay, remaining))
+
+    def close(self):
+        self.directories.clear()
+
+
+class InotifyWatcher(object):
+    """watch directories using linux's inotify, through ctypes"""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        # raise AttributeError on systems without inotify
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
+
+    def __repr__(self):
+        return 'InotifyWatcher(%d directories)' % len(self.watches)
+
+    def watch(self, directories):
+        """set the watched directories"""
+        for wd, directory in list(self.watches.items()):
+            if directory not in directories:
+                self._rm_watch(self.fd, wd)
+                del self.watches[wd]
+        watched = set(self.watches.values())
+        for directory in directories:
+            if directory in watched:
+                continue
+            wd = self._add_watch(self.fd, directory.encode('utf-8'), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, '%s: %s' % (directory, os.strerror(err)))
+            self.watches[wd] = directory
+
+    def wait(self, timeout):
+        """return the set of watched directories modified within `timeout`
+        seconds, empty if none was
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as ex:
+            if ex.errno == errno.EAGAIN:
+                return changed
+            raise
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+            if wd in self.watches:
+                changed.add(self.watches[wd])
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+        self.watches.clear()
+
+
+def watcher(logger=None):
+    """return an InotifyWatcher, or a PollingWatcher if inotify isn't
+    available
+    """
+    try:
+        return InotifyWatcher()
+    except (AttributeError, OSError) as ex:
+        if logger is not None:
+            logger.info('inotify not available (%s), polling directories', ex)
+        return PollingWatcher()
+
+
+class _ThreadOutput(object):
+    """replacement of sys.stdout sending what is written by a thread to its
+    own buffer while it runs a command, and anything else to `stream`
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _target(self):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream
+        return buffer
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+def _error(message):
+    return {'status': 1, 'stdout': '', 'log': 'ERROR: %s\n' % message}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('not an object')
+        except ValueError as ex:
+            response = _error('bad request: %s' % ex)
+        else:
+            try:
+                peer = peer_credentials(self.request)
+            except (socket.error, struct.error):
+                peer = None
+            error = self.server.daemon.check_request(request, peer)
+            if error:
+                self.server.daemon.logger.warning('refused request: %s', error)
+                response = _error(error)
+            else:
+                response = self.server.daemon.execute(request)
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class LdiDaemon(object):
+    """serve a repository: publish its incoming queues after `debounce`
+    seconds without new changes file, and run commands received on its socket.
+
+    `commandline` is the ldi command line (used to run commands), `rcfile` its
+    configuration file and `publish_args` additional arguments of automatic
+    publications.
+    """
+    def __init__(self, logger, repo, commandline, rcfile=None, debounce=5,
+                 publish_args=(), sockpath=None):
+        self.logger = logger
+        self.repo = repo
+        self.commandline = commandline
+        self.rcfile = rcfile
+        self.debounce = debounce
+        self.publish_args = list(publish_args)
+        self.sockpath = sockpath or socket_path(repo.directory)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.server = None
+
+    def __repr__(self):
+        return 'LdiDaemon(%s)' % self.repo.directory
+
+    def check_request(self, request, peer):
+        """return why a request received from the `peer` process, given as a
+        (pid, uid, gid) tuple, is refused, or None if it may be executed
+        """
+        if peer is None:
+            return 'unknown peer credentials'
+        command = request.get('command')
+        args = request.get('args')
+        if not isinstance(args, list) or not all(
+                isinstance(arg, type(u'')) for arg in args):
+            return 'bad arguments %r' % (args,)
+        try:
+            positionals = check_arguments(command, args)
+        except ValueError as ex:
+            return str(ex)
+        if not positionals or osp.realpath(positionals[0]) != \
+                osp.realpath(self.repo.directory):
+            return 'only %s is served' % self.repo.directory
+        pid, uid, gid = peer
+        if uid in (0, os.geteuid()):
+            return None
+        if command == 'upload':
+            directories = [self.repo.incoming_directory]
+        elif command == 'publish':
+            directories = [self.repo.dists_directory]
+        else:
+            directories = [self.repo.incoming_directory,
+                           self.repo.dists_directory]
+        if not any(is_member(uid, gid, os.stat(directory).st_gid)
+                   for directory in directories):
+            return 'user %s is not allowed to %s' % (uid, command)
+        if command == 'upload':
+            # uploaded files are read with the privileges of the daemon
+            for path in positionals[1:]:
+                try:
+                    owner = os.stat(path).st_uid
+                except OSError as ex:
+                    return 'cannot upload %s: %s' % (path, ex)
+                if owner != uid:
+                    return '%s does not belong to user %s' % (path, uid)
+        return None
+
+    def execute(self, request):
+        """run a command and return its response, commands being run one at
+        a time. Requests received on the socket must have been checked by
+        `check_request`.
+        """
+        command = request.get('command')
+        log = StringIO()
+        handler = logging.StreamHandler(log)
+        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        logger = self.commandline.create_logger(handler, request.get('loglevel'))
+        args = list(request.get('args', ())) + ['--no-daemon']
+        output = StringIO()
+        with self._lock:
+            start = time.time()
+            stdout = sys.stdout
+            if isinstance(stdout, _ThreadOutput):
+                stdout.local.buffer = output
+            # the repository and its caches are kept open from one command
+            # to the other, messages it logs go to the response
+            repo_logger, self.repo.logger = self.repo.logger, logger
+            try:
+                cmd = self.commandline.get_command(command, logger)
+                cmd.repository = self.repo
+                status = cmd.main_run(args, self.rcfile)
+            except SystemExit as ex:
+                status = ex.code
+            except Exception as ex:
+                logger.exception('%s failed: %s', command, ex)
+                status = 1
+            finally:
+                self.repo.logger = repo_logger
+                if isinstance(stdout, _ThreadOutput):
+                    stdout.local.buffer = None
+            self.logger.info('%s %s: status %s in %.2fs', command,
+                             ' '.join(args), status, time.time() - start)
+        return {'status': status, 'stdout': output.getvalue(),
+                'log': log.getvalue()}
+
+    def incoming_directories(self):
+        """return the incoming directory and its distribution directories"""
+        incoming = self.repo.incoming_directory
+        return [incoming] + [osp.join(incoming, dist)
+                             for dist in sorted(os.listdir(incoming))
+                             if osp.isdir(osp.join(incoming, dist))]
+
+    def publish(self):
+        """publish the incoming queue if it holds changes files"""
+        if not self.repo.incoming_changes_files([]):
+            return
+        response = self.execute({
+            'command': 'publish',
+            'args': ['--no-confirm'] + self.publish_args + [self.repo.directory],
+            'loglevel': logging.getLevelName(self.logger.getEffectiveLevel())})
+        for line in response['log'].splitlines():
+            self.logger.info('publish: %s', line)
+
+    def serve(self):
+        """listen to the socket and watch incoming queues until `stop` is
+        called
+        """
+        if osp.exists(self.sockpath):
+            try:
+                forward(self.sockpath, None, [])
+            except socket.error:
+                os.unlink(self.sockpath) # stale socket
+            else:
+                raise OSError(errno.EADDRINUSE, '%s is already served'
+                              % self.sockpath)
+        self.server = _Server(self.sockpath, _RequestHandler)
+        self.server.daemon = self
+        os.chmod(self.sockpath, 0o660)
+        # output of the commands is captured by thread
+        stdout = sys.stdout = _ThreadOutput(sys.stdout)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.logger.info('serving %s on %s', self.repo.directory, self.sockpath)
+        watch = watcher(self.logger)
+        try:
+            # publish what arrived while the daemon wasn't running
+            last_event = time.time() - self.debounce
+            while not self._stop.is_set():
+                watch.watch(self.incoming_directories())
+                if last_event is None:
+                    timeout = 1
+                else:
+                    timeout = max(0, last_event + self.debounce - time.time())
+                if watch.wait(timeout):
+                    last_event = time.time()
+                elif last_event is not None and \
+                         time.time() >= last_event + self.debounce:
+                    last_event = None
+                    try:
+                        self.publish()
+                    except Exception as ex:
+                        self.logger.exception('publication failed: %s', ex)
+        finally:
+            watch.close()
+            self.server.shutdown()
+            self.server.server_close()
+            if sys.stdout is stdout:
+                sys.stdout = stdout.stream
+            if osp.exists(self.sockpath):
+                os.unlink(self.sockpath)
+
+    def stop(self):
+        self._stop.set()
@@ -17,9 +17,16 @@
 
 from __future__ import with_statement
 
+import io
+import os
 import os.path as osp
+import tarfile
 from subprocess import Popen, PIPE
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from time import time
 import hashlib
+import threading
 
 try:
     from debian import deb822
@@ -28,41 +35,732 @@ except ImportError:
 
 from logilab.common.decorators import cached
 
+from debinstall.cache import stat_key
+
 class BadSignature(Exception): pass
 
 class CheckerError(Exception): pass
 
+class BadPackage(Exception): pass
 
-def check_sig(filename):
-    """return True if the file is correctly signed"""
-    pipe = Popen(["gpg", "--verify",  filename], stderr=PIPE)
-    pipe.stderr.read()
-    status = pipe.wait()
-    if status != 0:
-        raise BadSignature('%s is not properly signed' % filename)
-
-def hash_file(hashfun, filename):
+
+# (changes file field, checksum key, hashlib algorithm), strongest first
+CHECKSUM_FIELDS = (
+    ('Checksums-Sha256', 'sha256', 'sha256'),
+    ('Checksums-Sha1', 'sha1', 'sha1'),
+    ('Files', 'md5sum', 'md5'),
+    )
+
+CHECKSUM_ALGORITHMS = tuple(algo for _, _, algo in CHECKSUM_FIELDS)
+
+# read buffer size used when digesting files: large enough to keep syscall
+# overhead negligible on multi-hundred-MB tarballs
+HASH_BUFSIZE = 1 << 20
+
+def digest_file(filename, algorithms=CHECKSUM_ALGORITHMS, cache=None):
+    """return a dictionary mapping each algorithm name to the hex digest of the
+    file, reading it only once whatever the number of algorithms.
+
+    If a `debinstall.cache.HashCache` is given, digests of files which have not
+    changed since they were last hashed are taken from it.
+    """
+    if cache is not None:
+        key = stat_key(filename)
+        digests = cache.get(key, algorithms)
+        if digests is not None:
+            return digests
+        digests = _digest_file(filename, algorithms)
+        cache.set(key, dict(digests))
+        return digests
+    return _digest_file(filename, algorithms)
+
+def _digest_file(filename, algorithms):
+    hashobjs = [(algo, hashlib.new(algo)) for algo in algorithms]
+    buf = bytearray(HASH_BUFSIZE)
+    view = memoryview(buf)
     with open(filename, 'rb') as f:
-        hashobj = hashfun()
         while True:
-            buf = f.read(4096)
-            if not buf:
+            size = f.readinto(buf)
+            if not size:
                 break
-            hashobj.update(buf)
+            chunk = view[:size]
+            for _, hashobj in hashobjs:
+                hashobj.update(chunk)
+    return dict((algo, hashobj.hexdigest()) for algo, hashobj in hashobjs)
+
+def copy_digest_file(source, destination, algorithms=CHECKSUM_ALGORITHMS):
+    """copy `source` to `destination` and return a dictionary mapping each
+    algorithm name to the hex digest of the copied data, so that the file is
+    only read once
+    """
+    hashobjs = [(algo, hashlib.new(algo)) for algo in algorithms]
+    buf = bytearray(HASH_BUFSIZE)
+    view = memoryview(buf)
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            while True:
+                size = src.readinto(buf)
+                if not size:
+                    break
+                chunk = view[:size]
+                for _, hashobj in hashobjs:
+                    hashobj.update(chunk)
+                dst.write(chunk)
+    return dict((algo, hashobj.hexdigest()) for algo, hashobj in hashobjs)
+
+def hash_file(hashfun, filename, cache=None):
+    algo = hashfun().name
+    return digest_file(filename, (algo,), cache)[algo]
+
+
+def check_sig(filename):
+    """check the file is correctly signed and return the id of the signer key"""
+    return SignatureVerifier().check(filename)
+
+
+class Signature(object):
+    """result of the verification of the signature of a file"""
+    def __init__(self, valid, keyid=None, fingerprint=None, signer=None):
+        self.valid = valid
+        self.keyid = keyid
+        self.fingerprint = fingerprint
+        self.signer = signer
+
+    def __repr__(self):
+        return 'Signature(%s, %s)' % (self.valid and 'good' or 'bad', self.keyid)
+
+def parse_gpg_status(lines):
+    """return a Signature from the status lines output by gpg for one file"""
+    valid = False
+    keyid = fingerprint = signer = None
+    for line in lines:
+        words = line.split(None, 3)
+        if len(words) < 2 or words[0] != '[GNUPG:]':
+            continue
+        keyword = words[1]
+        if keyword == 'GOODSIG':
+            valid = True
+            keyid = words[2]
+            signer = len(words) > 3 and words[3] or None
+        elif keyword == 'VALIDSIG':
+            fingerprint = words[2]
+        elif keyword in ('BADSIG', 'ERRSIG', 'EXPKEYSIG', 'REVKEYSIG', 'NODATA'):
+            return Signature(False, len(words) > 2 and words[2] or None)
+    return Signature(valid, keyid, fingerprint, signer)
+
+# gpg keyrings whose content identifies the set of trusted keys
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg', 'trustedkeys.kbx',
+                 'trustedkeys.gpg')
+
+class SignatureVerifier(object):
+    """verify gpg signatures of many files with a single gpg process.
+
+    Results are remembered for the lifetime of the verifier and, if a
+    `debinstall.cache.SignatureCache` is given, stored in it keyed on the
+    content of the file and of the keyring, so that a file verified once (for
+    instance on upload) is not verified again (on publish).
+    """
+    batchsize = 100
+
+    def __init__(self, cache=None, hashcache=None):
+        self.cache = cache
+        self.hashcache = hashcache
+        self._results = {}
+
+    @property
+    @cached
+    def keyring_id(self):
+        """digest identifying the keyring gpg uses"""
+        gnupghome = os.environ.get('GNUPGHOME') or osp.expanduser('~/.gnupg')
+        hashobj = hashlib.sha256()
+        for fname in KEYRING_FILES:
+            path = osp.join(gnupghome, fname)
+            if osp.isfile(path):
+                hashobj.update(fname.encode('ascii'))
+                hashobj.update(digest_file(path, ('sha256',),
+                                           self.hashcache)['sha256'].encode('ascii'))
         return hashobj.hexdigest()
 
+    def _content_id(self, filename):
+        # compute every digest: checksums of .dsc files will be needed later
+        return digest_file(filename, CHECKSUM_ALGORITHMS,
+                           self.hashcache)['sha256']
+
+    def verify(self, filenames):
+        """verify signatures of the given files, return a {filename: Signature}
+        dictionary
+        """
+        todo = []
+        for filename in filenames:
+            if filename in self._results or filename in todo:
+                continue
+            if self.cache is not None:
+                try:
+                    key = (self._content_id(filename), self.keyring_id)
+                except (IOError, OSError):
+                    self._results[filename] = Signature(False)
+                    continue
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self._results[filename] = Signature(*cached)
+                    continue
+            todo.append(filename)
+        for i in range(0, len(todo), self.batchsize):
+            batch = todo[i:i+self.batchsize]
+            for filename, signature in zip(batch, self._run_gpg(batch)):
+                self._results[filename] = signature
+                if self.cache is not None and osp.isfile(filename):
+                    self.cache.set((self._content_id(filename), self.keyring_id),
+                                   (signature.valid, signature.keyid,
+                                    signature.fingerprint, signature.signer))
+        return dict((filename, self._results[filename])
+                    for filename in filenames)
+
+    def check(self, filename):
+        """return the id of the key which signed the file, raise BadSignature
+        if it is not properly signed
+        """
+        signature = self.verify([filename])[filename]
+        if not signature.valid:
+            raise BadSignature('%s is not properly signed' % filename)
+        return signature.keyid
+
+    def _gpg(self, args):
+        pipe = Popen(['gpg', '--batch', '--status-fd', '1'] + args,
+                     stdout=PIPE, stderr=PIPE)
+        stdout, _ = pipe.communicate()
+        return stdout.decode('utf-8', 'replace').splitlines()
+
+    def _run_gpg(self, filenames):
+        """return the list of Signature of the given files"""
+        if len(filenames) > 1:
+            # one FILE_START ... FILE_DONE block per file with gpg >= 2.1
+            blocks = []
+            for line in self._gpg(['--verify-files'] + filenames):
+                if line.startswith('[GNUPG:] FILE_START'):
+                    blocks.append([])
+                elif blocks:
+                    blocks[-1].append(line)
+            if len(blocks) == len(filenames):
+                return [parse_gpg_status(lines) for lines in blocks]
+        return [parse_gpg_status(self._gpg(['--verify', filename]))
+                for filename in filenames]
+
+
+class FileCheck(object):
+    """result of the verification of one file listed in a changes file"""
+    def __init__(self, path, expected):
+        self.path = path
+        self.name = osp.basename(path)
+        # {algorithm: expected hex digest}
+        self.expected = expected
+        self.computed = {}
+        self.size = None
+        self.expected_size = None
+        self.error = None
+        self.start = self.end = None
+        # when set, the file is copied there while being checked
+        self.destination = None
+
+    def __repr__(self):
+        return 'FileCheck(%s, %s)' % (self.name, self.ok and 'ok' or 'failed')
+
+    @property
+    def mismatches(self):
+        """return the sorted list of algorithms whose digest doesn't match"""
+        return sorted(algo for algo, digest in self.expected.items()
+                      if self.computed.get(algo) != digest)
+
+    @property
+    def ok(self):
+        if self.error is not None:
+            return False
+        if self.expected_size is not None and self.size != self.expected_size:
+            return False
+        return not self.mismatches
+
+    def check(self, cache=None):
+        """compute digests of the file, copying it to `destination` if set. The
+        copy is removed if it doesn't match the expected checksums.
+        """
+        self.start = time()
+        try:
+            self.size = os.stat(self.path).st_size
+            if self.destination is None:
+                self.computed = digest_file(self.path, sorted(self.expected),
+                                            cache)
+            else:
+                self.computed = copy_digest_file(self.path, self.destination,
+                                                 sorted(self.expected))
+        except (IOError, OSError) as ex:
+            self.error = str(ex)
+        if self.destination is not None and not self.ok:
+            self.discard()
+        self.end = time()
+
+    def discard(self):
+        """remove the copy of the file, if any"""
+        if self.destination is not None and osp.exists(self.destination):
+            os.remove(self.destination)
+
+    def describe(self):
+        if self.error is not None:
+            return '%s: %s' % (self.name, self.error)
+        problems = []
+        if self.expected_size is not None and self.size != self.expected_size:
+            problems.append('size %s, expected %s' % (self.size,
+                                                      self.expected_size))
+        for algo in self.mismatches:
+            problems.append('%s %s, expected %s' % (
+                algo, self.computed.get(algo), self.expected[algo]))
+        if not problems:
+            return '%s: ok' % self.name
+        return '%s: %s' % (self.name, ', '.join(problems))
+
+
+class HashReport(object):
+    """result of the verification of every checksum declared in a changes
+    file. Evaluates to False if any file is missing or doesn't match.
+    """
+    def __init__(self, path, files):
+        self.path = path
+        self.files = files
+        self.elapsed = 0.
+
+    def __bool__(self):
+        return all(fcheck.ok for fcheck in self.files)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'HashReport(%s, %s)' % (self.path, bool(self) and 'ok' or 'failed')
+
+    @property
+    def failures(self):
+        return [fcheck for fcheck in self.files if not fcheck.ok]
+
+    @property
+    def errors(self):
+        return ['%s: %s' % (self.path, fcheck.describe())
+                for fcheck in self.failures]
+
+    @property
+    def size(self):
+        """number of bytes read"""
+        return sum(fcheck.size or 0 for fcheck in self.files)
+
+    @property
+    def throughput(self):
+        """hashing throughput in MB/s"""
+        if not self.elapsed:
+            return 0.
+        return self.size / self.elapsed / (1 << 20)
+
+    def summary(self):
+        return '%s: %d files, %.1f MB checked in %.2fs (%.1f MB/s)' % (
+            self.path, len(self.files), self.size / float(1 << 20),
+            self.elapsed, self.throughput)
+
+    def check(self, cache=None, workers=1):
+        check_reports([self], cache, workers)
+        return self
+
+    def update_elapsed(self):
+        """compute elapsed time once every file has been checked"""
+        checked = [fcheck for fcheck in self.files if fcheck.end is not None]
+        if checked:
+            self.elapsed = (max(fcheck.end for fcheck in checked)
+                            - min(fcheck.start for fcheck in checked))
+
+
+def check_reports(reports, cache=None, workers=1):
+    """check the files of several HashReport at once, using a pool of `workers`
+    threads (hashlib releases the GIL while digesting large buffers).
+
+    Files are dispatched to the pool regardless of the changes file they belong
+    to, but results are stored in each report, so the order in which failures
+    are reported doesn't depend on scheduling.
+    """
+    fchecks = [fcheck for report in reports for fcheck in report.files]
+    workers = min(workers, len(fchecks))
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            pool.map(lambda fcheck: fcheck.check(cache), fchecks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for fcheck in fchecks:
+            fcheck.check(cache)
+    for report in reports:
+        report.update_elapsed()
+    return reports
+
+
+def strip_epoch(version):
+    """return the version without its epoch, as used in file names"""
+    return version.split(':', 1)[-1]
+
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+TAR_BLOCK_SIZE = 512
+
+def _decompressor(member):
+    """return a decompressor object for the given deb member name, None for an
+    uncompressed tarball
+    """
+    if member.endswith('.tar'):
+        return None
+    if member.endswith('.gz'):
+        import zlib
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if member.endswith('.xz'):
+        import lzma
+        return lzma.LZMADecompressor()
+    if member.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2Decompressor()
+    if member.endswith('.zst'):
+        import zstandard # optional dependency
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise BadPackage('unsupported compression for %s' % member)
+
+
+class _ChunksReader(object):
+    """file-like object reading from an iterator of chunks, to stream tarballs
+    through tarfile
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class DebFile(object):
+    """minimal reader for binary packages (.deb), an ar archive holding
+    debian-binary, control.tar.* and data.tar.* members
+    """
+    def __init__(self, path):
+        self.path = path
+        self.filename = osp.basename(path)
+
+    def __repr__(self):
+        return 'DebFile(%s)' % self.path
+
+    @cached
+    def members(self):
+        """return the list of (name, offset, size) of the ar members, raise
+        BadPackage if the ar structure is invalid
+        """
+        members = []
+        filesize = os.stat(self.path).st_size
+        with open(self.path, 'rb') as f:
+            if f.read(len(AR_MAGIC)) != AR_MAGIC:
+                raise BadPackage('%s: not an ar archive' % self.filename)
+            offset = len(AR_MAGIC)
+            while offset < filesize:
+                f.seek(offset)
+                header = f.read(AR_HEADER_SIZE)
+                if len(header) != AR_HEADER_SIZE or header[58:60] != b'`\n':
+                    raise BadPackage('%s: bad ar header at offset %d'
+                                     % (self.filename, offset))
+                name = header[:16].decode('ascii', 'replace').strip().rstrip('/')
+                try:
+                    size = int(header[48:58])
+                except ValueError:
+                    raise BadPackage('%s: bad size for ar member %s'
+                                     % (self.filename, name))
+                offset += AR_HEADER_SIZE
+                if offset + size > filesize:
+                    raise BadPackage('%s: truncated ar member %s'
+                                     % (self.filename, name))
+                members.append((name, offset, size))
+                offset += size + size % 2
+        names = [name for name, _, _ in members]
+        if (len(names) < 3 or names[0] != 'debian-binary'
+            or not names[1].startswith('control.tar')
+            or not names[2].startswith('data.tar')):
+            raise BadPackage('%s: unexpected members %s'
+                             % (self.filename, ', '.join(names)))
+        return members
+
+    def iter_member(self, name, bufsize=1 << 16):
+        """yield uncompressed chunks of the given member"""
+        for mname, offset, size in self.members():
+            if mname == name:
+                break
+        else:
+            raise BadPackage('%s: no %s member' % (self.filename, name))
+        decompressor = _decompressor(name)
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while size:
+                chunk = f.read(min(bufsize, size))
+                if not chunk:
+                    raise BadPackage('%s: truncated %s' % (self.filename, name))
+                size -= len(chunk)
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+
+    def member_name(self, prefix):
+        for name, _, _ in self.members():
+            if name.startswith(prefix):
+                return name
+
+    def check_tar_header(self, prefix):
+        """check the first header of the control.tar or data.tar member,
+        decompressing only what is needed. Raise ImportError if the module
+        needed to decompress it is missing.
+        """
+        name = self.member_name(prefix)
+        data = b''
+        try:
+            for chunk in self.iter_member(name):
+                data += chunk
+                if len(data) >= TAR_BLOCK_SIZE:
+                    break
+            tarfile.TarInfo.frombuf(data[:TAR_BLOCK_SIZE], 'utf-8', 'replace')
+        except (BadPackage, ImportError):
+            raise
+        except (tarfile.TarError, EnvironmentError, ValueError) as ex:
+            raise BadPackage('%s: bad tar header in %s: %s'
+                             % (self.filename, name, ex))
+        except Exception as ex: # decompression errors
+            raise BadPackage('%s: cannot read %s: %s' % (self.filename, name, ex))
+
+    def _tarfile(self, prefix):
+        name = self.member_name(prefix)
+        try:
+            data = b''.join(self.iter_member(name))
+            return tarfile.open(fileobj=io.BytesIO(data), mode='r:')
+        except (BadPackage, ImportError):
+            raise
+        except Exception as ex:
+            raise BadPackage('%s: cannot read %s: %s' % (self.filename, name, ex))
+
+    def data_files(self):
+        """return the paths of the files shipped by the package (directories
+        excepted), without leading './'
+        """
+        name = self.member_name('data.tar')
+        try:
+            tar = tarfile.open(fileobj=_ChunksReader(self.iter_member(name)),
+                               mode='r|')
+            return [tarinfo.name[2:] if tarinfo.name.startswith('./')
+                    else tarinfo.name.lstrip('/')
+                    for tarinfo in tar if not tarinfo.isdir()]
+        except (BadPackage, ImportError):
+            raise
+        except Exception as ex:
+            raise BadPackage('%s: cannot read %s: %s' % (self.filename, name, ex))
+
+    @cached
+    def control(self):
+        """return the content of the control file as a deb822.Deb822 instance"""
+        tar = self._tarfile('control.tar')
+        for tarinfo in tar:
+            if tarinfo.name in ('control', './control'):
+                return deb822.Deb822(tar.extractfile(tarinfo).read().decode('utf-8'))
+        raise BadPackage('%s: no control file' % self.filename)
+
+
+class ReferenceIndex(object):
+    """reverse index mapping each file to the set of changes files referencing
+    it, built once per directory
+    """
+    def __init__(self, logger=None):
+        self.logger = logger
+        self._dirs = set()
+        self._references = {}
+
+    def _scan(self, dirname):
+        self._dirs.add(dirname)
+        # paths are joined to `dirname` as in Changes, even if it is empty
+        for fname in os.listdir(dirname or os.curdir):
+            if not fname.endswith('.changes'):
+                continue
+            path = osp.join(dirname, fname)
+            try:
+                files = Changes.open(path).get_all_files(
+                    check_if_exists=False)
+            except Exception as ex:
+                if self.logger is not None:
+                    self.logger.warning('cannot read %s: %s', path, ex)
+                continue
+            for filename in files:
+                self._references.setdefault(filename, set()).add(path)
+
+    def referrers(self, path):
+        """return the set of changes files referencing `path`"""
+        dirname = osp.dirname(path)
+        if dirname not in self._dirs:
+            self._scan(dirname)
+        return self._references.get(path, set())
+
+    def shared(self, changes):
+        """return the set of files of `changes` also referenced by other
+        changes files
+        """
+        return set(filename for filename in changes.get_all_files()
+                   if self.referrers(filename) - set((changes.path,)))
+
+    def remove(self, changes):
+        """forget references of a changes file which has been moved away"""
+        for filename in changes.get_all_files(check_if_exists=False):
+            self.referrers(filename).discard(changes.path)
+
+    def add(self, changes):
+        """restore references of a changes file"""
+        for filename in changes.get_all_files(check_if_exists=False):
+            self.referrers(filename)
+            self._references.setdefault(filename, set()).add(changes.path)
+
+
+def read_fields(path):
+    """return a {lower cased field name: raw value} dictionary of the first
+    paragraph of a (possibly signed) control file, values being left unparsed
+    """
+    fields = {}
+    name = None
+    with io.open(path, encoding='utf-8', errors='replace') as stream:
+        lines = iter(stream)
+        for line in lines:
+            if line.startswith('-----BEGIN PGP SIGNED MESSAGE'):
+                # skip armor headers
+                for line in lines:
+                    if not line.strip():
+                        break
+                continue
+            if line.startswith('-----BEGIN PGP SIGNATURE'):
+                break
+            if line.startswith('- '): # dash escaped line
+                line = line[2:]
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                if fields:
+                    break
+                continue
+            if line[0] in ' \t':
+                if name is not None:
+                    fields[name] += '\n' + line
+                continue
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            fields[name] = value.strip()
+    return fields
+
+# fields whose value is a list of dictionaries
+MULTIVALUED_FIELDS = deb822.Changes._multivalued_fields
+
+_LISTINGS = {}
+
+def directory_entries(dirname, refresh=False):
+    """return the set of names of the non directory entries of a directory,
+    listed once as long as the directory isn't modified (or unless `refresh`
+    is true)
+    """
+    mtime = stat_key(dirname)[3]
+    cached = _LISTINGS.get(dirname)
+    if cached is not None and cached[0] == mtime and not refresh:
+        return cached[1]
+    if hasattr(os, 'scandir'):
+        names = frozenset(entry.name for entry in os.scandir(dirname)
+                          if not entry.is_dir())
+    else: # python < 3.5
+        names = frozenset(os.listdir(dirname))
+    _LISTINGS[dirname] = (mtime, names)
+    return names
+
+
+class ChangesCache(object):
+    """bounded LRU cache of parsed changes files, keyed on their path, size
+    and modification time so that a modified file is parsed again
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ChangesCache(%d/%d)' % (len(self._entries), self.size)
+
+    def get(self, path):
+        """return the Changes instance of `path`, parsed at most once as long
+        as the file isn't modified
+        """
+        key = (path,) + stat_key(path)[2:]
+        with self._lock:
+            changes = self._entries.pop(key, None)
+            if changes is not None:
+                self.hits += 1
+                self._entries[key] = changes
+                return changes
+            self.misses += 1
+        changes = Changes(path)
+        with self._lock:
+            self._entries[key] = changes
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return changes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return '%s: %d hits, %d misses' % (self, self.hits, self.misses)
+
+
 class Changes(object):
+    """a changes file. Only its header is read, when the object is created, and
+    the value of a field is parsed when it is first accessed.
+
+    Use `Changes.open` to share instances of unmodified files within a process.
+    """
+    cache = ChangesCache()
+
     def __init__(self, path):
         self.path = path
         self.filename = osp.basename(path)
-        self.changes = deb822.Changes(open(path))
         self.dirname = osp.dirname(path)
+        self._fields = read_fields(path)
+        self._parsed = {}
+
+    @classmethod
+    def open(cls, path):
+        """return the (possibly cached) instance for the changes file `path`"""
+        return cls.cache.get(path)
 
     def __repr__(self):
         return 'Changes(%s)' % self.path
 
     def __getitem__(self, key):
-        return self.changes[key]
+        key = key.lower()
+        value = self._fields[key]
+        if key not in MULTIVALUED_FIELDS:
+            return value
+        try:
+            return self._parsed[key]
+        except KeyError:
+            keys = MULTIVALUED_FIELDS[key]
+            parsed = self._parsed[key] = [
+                dict(zip(keys, line.split(None, len(keys) - 1)))
+                for line in value.splitlines() if line.strip()]
+            return parsed
 
     def get_dsc(self):
         """return the full path to the dsc file in the changes file
@@ -89,58 +787,80 @@ class Changes(object):
             packages.add(binpkg)
         return packages
 
-    @cached
     def get_all_files(self, check_if_exists=True):
         all_files = set((self.path,))
-        for info in self.changes['Files']:
-            path = osp.join(self.dirname, info['name'])
-            # TODO Need unit tests
-            if check_if_exists:
-                try:
-                    fdesc = open(path)
-                    fdesc.close()
-                except IOError as ex:
-                    raise Exception("Cannot read '%s' from %s: %s"
-                                    % (info['name'], self.path, ex))
-            all_files.add(path)
+        if check_if_exists:
+            dirname = self.dirname or os.curdir
+            existing = directory_entries(dirname)
+        for info in self['Files']:
+            if check_if_exists and info['name'] not in existing:
+                # the modification time of the directory may not have changed
+                # if the file was just added
+                existing = directory_entries(dirname, refresh=True)
+                if info['name'] not in existing:
+                    raise Exception("Cannot read '%s' from %s: no such file"
+                                    % (info['name'], self.path))
+            all_files.add(osp.join(self.dirname, info['name']))
         return all_files
 
-    def check_sig(self):
-        """check the gpg signature of the changes file and the dsc file (if it
-        exists). Raise an exception if that's not the case.
-        """
-        check_sig(self.path)
+    def signed_files(self):
+        """return the list of files whose signature should be checked"""
         dsc = self.get_dsc()
         if dsc is not None:
-            check_sig(dsc)
+            return [self.path, dsc]
+        return [self.path]
 
-    def run_checkers(self, checkers):
-        from debinstall.checkers import ALL_CHECKERS
-        errors = []
-        for check in checkers:
-            try:
-                checker = ALL_CHECKERS[check]
-            except KeyError:
-                raise Exception('no such checker %s' % check)
-            success, stdout, stderr = checker.run(self.path)
-            if not success:
-                errors.append('checker %s is in error on %s: \n%s\n%s'
-                              % (check, self.path, stdout, stderr))
-        if errors:
-            raise CheckerError('\n'.join(errors))
-
-    def check_hashes(self):
-        for attr, hashfield, hashfun in (
-                ('Checksums-Sha256', 'sha256', hashlib.sha256),
-                ('Checksums-Sha1', 'sha1', hashlib.sha1),
-                ('Files', 'md5sum', hashlib.md5)):
+    def check_sig(self, verifier=None):
+        """check the gpg signature of the changes file and the dsc file (if it
+        exists). Raise an exception if that's not the case, else return the
+        list of signer key ids.
+        """
+        if verifier is None:
+            verifier = SignatureVerifier()
+        signed_files = self.signed_files()
+        verifier.verify(signed_files)
+        return [verifier.check(path) for path in signed_files]
+
+    def run_checkers(self, checkers, cache=None, timeout=None):
+        """run the given checkers on the changes file, raise CheckerError if
+        some fail. `cache` is an optional `debinstall.cache.CheckerCache`.
+        """
+        from debinstall.checkers import run_checkers
+        error = run_checkers([self.path], checkers, cache,
+                             timeout=timeout)[self.path]
+        if error is not None:
+            raise error
+
+    def hashes_report(self):
+        """return a HashReport for every file listed in the changes file, not
+        yet checked, expecting every checksum family it declares
+        """
+        files = {}
+        found = False
+        for attr, hashfield, algo in CHECKSUM_FIELDS:
             try:
                 checksums = self[attr]
             except KeyError:
                 continue
+            found = True
             for f in checksums:
-                path = osp.join(osp.dirname(self.path), f['name'])
-                if hash_file(hashfun, path) != f[hashfield]:
-                    return False
-            return True
-        raise Exception('malformed changes files %s, no checksum found' % self.path)
+                path = osp.join(self.dirname, f['name'])
+                fcheck = files.get(path)
+                if fcheck is None:
+                    fcheck = files[path] = FileCheck(path, {})
+                fcheck.expected[algo] = f[hashfield]
+                if f.get('size') is not None:
+                    fcheck.expected_size = int(f['size'])
+        if not found:
+            raise Exception('malformed changes files %s, no checksum found'
+                            % self.path)
+        return HashReport(self.path, [files[path] for path in sorted(files)])
+
+    def check_hashes(self, cache=None, workers=1):
+        """check every checksum declared in the changes file, reading each file
+        only once, and return a HashReport (which is false on failure).
+
+        `cache` is an optional `debinstall.cache.HashCache`, `workers` the number
+        of files checked concurrently.
+        """
+        return self.hashes_report().check(cache, workers)
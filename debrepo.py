@@ -13,79 +13,146 @@
 # You should have received a copy of the GNU General Public License along with
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
-"""wrapper functions to run the apt-ftparchive command"""
+"""debian repository layout and index publication"""
 
+import hashlib
 import os
 import os.path as osp
+import re
+import sqlite3
+import stat
 import subprocess
-import shutil
+import tempfile
+import time
 from glob import glob
 
+try:
+    import fcntl
+except ImportError: # not a unix platform
+    fcntl = None
+
+from lockfile import AlreadyLocked, FileLock
 from logilab.common.clcommands import CommandError
-from logilab.common.changelog import Version as BaseVersion
 
+from debinstall.archive import ArchiveStore
+from debinstall.cache import open_cache
 from debinstall.debfiles import Changes
+from debinstall.indexes import (INDEXES, IndexGenerator, StanzaStore,
+                                check_compressions)
+from debinstall.metadata import MetadataIndex
 
 def changesfile(package, version, archi, upstreamversion=False):
     if upstreamversion:
         return '%s_%s-*_%s.changes' % (package, version, archi)
     return '%s_%s_%s.changes' % (package, version, archi)
 
-_SEPARATOR = object()
+_VERSION_RGX = re.compile(r'^(?:(\d+):)?([0-9][A-Za-z0-9.+~-]*?)'
+                          r'(?:-([A-Za-z0-9.+~]+))?$')
+_VERSION_PART_RGX = re.compile(r'(\D*)(\d*)')
+_SERIES_RGX = re.compile(r'(\d+)(?:\.(\d+))?')
+# parsed versions, cleared when it grows beyond _VERSIONS_CACHE_SIZE
+_VERSIONS_CACHE = {}
+_VERSIONS_CACHE_SIZE = 100000
+
+def _order(char):
+    """weight of a non digit character, as in dpkg's verrevcmp"""
+    if char == '~':
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+def _sort_key(part):
+    """return a flat tuple of integers comparing as dpkg compares upstream
+    versions or debian revisions: each non digit part is a sequence of
+    character weights ended by 0, followed by the value of the next digit
+    part, and the whole key is ended by 0 (the weight of an empty part)
+    """
+    key = []
+    for chars, digits in _VERSION_PART_RGX.findall(part)[:-1] or [('', '')]:
+        key.extend(_order(char) for char in chars)
+        key.append(0)
+        key.append(int(digits or 0))
+    key.append(0)
+    return key
+
+class Version(object):
+    """debian package version, compared as dpkg does.
+
+    Versions are immutable and parsed once: instantiating an already parsed
+    version string returns the same object.
+    """
+    __slots__ = ('epoch', 'upstream_version', 'debian_version', '_str', '_key')
 
-class Version(BaseVersion):
     def __new__(cls, versionstr):
-        if isinstance(versionstr, basestring):
-            try:
-                versionstr, debversion = versionstr.split('-', 1)
-            except ValueError:
-                debversion = None
-            else:
-                try:
-                    debversion = int(debversion)
-                except ValueError:
-                    pass
-            parsed = cls.parse(versionstr)
-            if debversion is not None:
-                parsed.append(_SEPARATOR)
-                parsed.append(debversion)
-        else:
-            parsed = versionstr
-        return tuple.__new__(cls, parsed)
-
-    @classmethod # remove once lgc > 0.54 is out
-    def parse(cls, versionstr):
-        versionstr = versionstr.strip(' :')
+        if isinstance(versionstr, Version):
+            return versionstr
         try:
-            return [int(i) for i in versionstr.split('.')]
-        except ValueError as ex:
-            raise ValueError("invalid literal for version '%s' (%s)"%(versionstr, ex))
+            return _VERSIONS_CACHE[versionstr]
+        except KeyError:
+            pass
+        match = _VERSION_RGX.match(versionstr.strip())
+        if match is None:
+            raise ValueError("invalid literal for version '%s'" % versionstr)
+        self = object.__new__(cls)
+        epoch, upstream, revision = match.groups()
+        self.epoch = int(epoch or 0)
+        self.upstream_version = upstream
+        self.debian_version = revision
+        self._str = versionstr.strip()
+        self._key = tuple([self.epoch] + _sort_key(upstream)
+                          + _sort_key(revision or ''))
+        if len(_VERSIONS_CACHE) >= _VERSIONS_CACHE_SIZE:
+            _VERSIONS_CACHE.clear()
+        _VERSIONS_CACHE[versionstr] = self
+        return self
 
     def __str__(self):
-        version = '.'.join(str(num) for num in self.upstream_version)
-        debianversion = self.debian_version
-        if debianversion is not None:
-            return '%s-%s' % (version, debianversion)
-        return version
+        return self._str
 
-    @property
-    def upstream_version(self):
-        version = []
-        for num in self:
-            if num is _SEPARATOR:
-                break
-            version.append(num)
-        return tuple(version)
+    def __repr__(self):
+        return 'Version(%r)' % self._str
+
+    def __reduce__(self):
+        return (Version, (self._str,))
 
     @property
-    def debian_version(self):
-        separator_found = False
-        for num in self:
-            if separator_found is True:
-                return num
-            if num is _SEPARATOR:
-                separator_found = True
-        return None
+    def series(self):
+        """epoch and two first numeric components of the upstream version, eg.
+        (0, 1, 2) for 1.2.3-1 as for 1.2~rc1-1
+        """
+        match = _SERIES_RGX.match(self.upstream_version)
+        return (self.epoch,) + tuple(int(number) for number in match.groups()
+                                     if number is not None)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        return isinstance(other, Version) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key < other._key
+
+    def __le__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key <= other._key
+
+    def __gt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key > other._key
+
+    def __ge__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key >= other._key
 
 APTDEFAULT_APTCONF = '''// This header is used to generate the apt.conf file
 // you may modify it to configure your repository, eg. you can add headers in
@@ -102,6 +169,7 @@ APT {
   };
 };
 
+// available compressions are: . (uncompressed) gzip bzip2 xz zstd
 Default {
         Packages::Compress ". gzip bzip2";
         Sources::Compress ". gzip bzip2";
@@ -123,11 +191,136 @@ BinDirectory "%(distribution)s" {
 };
 '''
 
+_APTCONF_TOKENS = re.compile(r'"[^"]*"|[{};]|[^\s{};"]+')
+
+def parse_aptconf(text):
+    """return a {'A::B::C': value} dictionary from an apt.conf like text,
+    handling both nested scopes and full option names. Lists are stored under
+    their scope name as a list of values.
+    """
+    text = re.sub(r'//[^\n]*|/\*.*?\*/', '', text, flags=re.S)
+    options = {}
+    scopes = []
+    words = []
+    for token in _APTCONF_TOKENS.findall(text):
+        if token == '{':
+            scopes.append('::'.join(words))
+            words = []
+        elif token == '}':
+            if scopes:
+                scopes.pop()
+            words = []
+        elif token == ';':
+            if words:
+                if len(words) == 1: # list item
+                    options.setdefault('::'.join(scopes), []).append(words[0])
+                else:
+                    name = '::'.join(scopes + [words[0]])
+                    options[name] = ' '.join(words[1:])
+            words = []
+        else:
+            words.append(token.strip('"'))
+    return options
+
+# fields of the Release file, in apt-ftparchive's order
+RELEASE_FIELDS = ('Origin', 'Label', 'Suite', 'Version', 'Codename', 'Date',
+                  'Valid-Until', 'Architectures', 'Components', 'Description')
+RELEASE_CHECKSUMS = (('MD5Sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256'))
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+           'Oct', 'Nov', 'Dec')
+
+def release_date(timestamp=None):
+    """return a RFC 1123 date, whatever the locale is"""
+    t = time.gmtime(timestamp)
+    return '%s, %02d %s %d %02d:%02d:%02d UTC' % (
+        _DAYS[t.tm_wday], t.tm_mday, _MONTHS[t.tm_mon - 1], t.tm_year,
+        t.tm_hour, t.tm_min, t.tm_sec)
+
+def format_release(fields, files):
+    """return the content of a Release file. `fields` is a dictionary of
+    header fields and `files` a {file name: (size, {algorithm: digest})}
+    dictionary
+    """
+    lines = ['%s: %s\n' % (name, fields[name]) for name in RELEASE_FIELDS
+             if fields.get(name)]
+    for field, algo in RELEASE_CHECKSUMS:
+        lines.append('%s:\n' % field)
+        for fname in sorted(files):
+            size, digests = files[fname]
+            lines.append(' %s %16d %s\n' % (digests[algo], size, fname))
+    return ''.join(lines)
+
+
+class TimedLock(object):
+    """file lock logging how long it was waited for and held"""
+    def __init__(self, path, logger, name):
+        self.lock = FileLock(path)
+        self.logger = logger
+        self.name = name
+        self.acquired = None
+
+    def __repr__(self):
+        return 'TimedLock(%s)' % self.name
+
+    def __enter__(self):
+        start = time.time()
+        self.lock.acquire()
+        self.acquired = time.time()
+        waited = self.acquired - start
+        if waited >= 1:
+            self.logger.info('waited %.1fs for the lock of %s', waited,
+                             self.name)
+        else:
+            self.logger.debug('locked %s', self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+        self.logger.debug('lock of %s held for %.2fs', self.name,
+                          time.time() - self.acquired)
+
+
+class FlockLock(object):
+    """non blocking lock on a file, released by the system when its holder
+    dies so that it never gets stale
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, timeout=0):
+        """acquire the lock or raise AlreadyLocked; `timeout` is only there
+        for compatibility with FileLock, the lock isn't waited for
+        """
+        fd = os.open(self.path, os.O_RDONLY | os.O_CREAT, 0o664)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            raise AlreadyLocked('%s is locked' % self.path)
+        self.fd = fd
+
+    def release(self):
+        os.close(self.fd)
+        self.fd = None
+
+
 class DebianRepository(object):
     def __init__(self, logger, directory):
         self.logger = logger
         self.directory = directory
         self.ldiname = osp.basename(directory.rstrip(os.sep))
+        # optional debinstall.cache.HashCache used when indexing packages
+        self.hash_cache = None
+        self._metadata = None
+        # distributions whose index must be updated before closing
+        self._stale_dists = set()
+        self._private_cachedir = None
+        self._stanza_store = None
+        # open caches, kept until the repository is closed
+        self._caches = {}
 
     @property
     def aptconf_file(self):
@@ -142,6 +335,168 @@ class DebianRepository(object):
     @property
     def archive_directory(self):
         return osp.join(self.directory, 'archive')
+    @property
+    def archive(self):
+        return ArchiveStore(self.archive_directory, self.logger)
+    @property
+    def cache_directory(self):
+        return osp.join(self.directory, 'cache')
+    @property
+    def publisher_cache_directory(self):
+        return osp.join(self.directory, 'publisher-cache')
+
+    def private_cache_directory(self):
+        """return the directory of the caches trusted on publication, created
+        if needed, or None if it may be written by users who can't write the
+        dists directory (eg. uploaders, who share the cache directory).
+        """
+        if self._private_cachedir is None:
+            self._private_cachedir = self._check_private_cache() or False
+        return self._private_cachedir or None
+
+    def _check_private_cache(self):
+        directory = self.publisher_cache_directory
+        try:
+            self._makedirs(directory)
+            dists = os.stat(self.dists_directory)
+            st = os.stat(directory)
+            if st.st_uid == os.geteuid():
+                if st.st_gid != dists.st_gid:
+                    os.chown(directory, -1, dists.st_gid)
+                if stat.S_IMODE(st.st_mode) != 0o2770:
+                    os.chmod(directory, 0o2770)
+                return directory
+        except OSError as ex:
+            self.logger.warning('cannot use %s: %s', directory, ex)
+            return None
+        if (st.st_uid != dists.st_uid or st.st_gid != dists.st_gid
+            or st.st_mode & stat.S_IWOTH):
+            self.logger.warning('%s may be written by users not allowed to '
+                                'publish, not using it', directory)
+            return None
+        return directory
+
+    def _makedirs(self, directory):
+        """create `directory` if needed, possibly concurrently, and return it"""
+        if not osp.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not osp.isdir(directory): # else created meanwhile
+                    raise
+        return directory
+
+    @property
+    def locks_directory(self):
+        return osp.join(self.directory, 'locks')
+
+    def lock(self, dist=None):
+        """return a lock of the whole repository, to be held shortly (eg. to
+        write apt.conf), or of one of its distributions, to be held while
+        packages are ingested in it and its indexes generated.
+
+        Distribution locks must be taken one at a time, and the repository
+        lock never while waiting for another one.
+        """
+        if dist is None:
+            return TimedLock(osp.join(self.directory, 'ldi.lock'), self.logger,
+                             self.ldiname)
+        lockdir = self._makedirs(self.locks_directory)
+        return TimedLock(osp.join(lockdir, dist), self.logger,
+                         '%s/%s' % (self.ldiname, dist))
+
+    @property
+    def requests_directory(self):
+        return osp.join(self.locks_directory, 'requests')
+
+    def publisher_lock(self):
+        """return the lock held by the coalescing publisher of the repository
+        (see `ldi publish --coalesce`)
+        """
+        path = osp.join(self._makedirs(self.locks_directory), 'publisher')
+        if fcntl is None:
+            return FileLock(path)
+        return FlockLock(path)
+
+    def request_publish(self):
+        """register a request for the incoming queue to be published and
+        return the path of the request file, removed once it is processed
+        """
+        fd, path = tempfile.mkstemp(
+            prefix='publish-', dir=self._makedirs(self.requests_directory))
+        os.close(fd)
+        return path
+
+    def publish_requests(self):
+        """return the sorted list of pending publication request files"""
+        if not osp.isdir(self.requests_directory):
+            return []
+        return sorted(osp.join(self.requests_directory, fname)
+                      for fname in os.listdir(self.requests_directory))
+
+    def metadata(self):
+        """return the MetadataIndex of the repository, or None if it can't be
+        used (in which case the file system is scanned).
+
+        Publication trusts the index, so it is kept in the publisher-only
+        cache directory: uploaders don't use it, their changes are noticed
+        through the modification time of the directories they write.
+        """
+        if self._metadata is None:
+            directory = self.private_cache_directory()
+            if directory is None or not os.access(directory,
+                                                  os.W_OK | os.X_OK):
+                self.logger.debug('no metadata index, scanning directories')
+                self._metadata = False
+                return None
+            try:
+                self._metadata = MetadataIndex(
+                    osp.join(directory, 'metadata.db'), self.directory,
+                    self.logger)
+            except sqlite3.Error as ex:
+                self.logger.warning('cannot use metadata index in %s: %s',
+                                    directory, ex)
+                self._metadata = False
+        return self._metadata or None
+
+    def update_metadata(self, section, dist):
+        """index changes files of a distribution directory which was just
+        modified
+        """
+        metadata = self.metadata()
+        if metadata is not None:
+            metadata.sync(section, osp.basename(osp.realpath(
+                osp.join(self.directory, section, dist))), force=True)
+
+    def open_cache(self, cachedir, cacheclass, maxsize):
+        """return the `cacheclass` instance stored in `cachedir` (see
+        `debinstall.cache.open_cache`), opened once until the repository is
+        closed
+        """
+        key = (cachedir, cacheclass)
+        if key not in self._caches:
+            self._caches[key] = open_cache(cachedir, cacheclass, maxsize,
+                                           self.logger)
+        return self._caches[key]
+
+    def flush(self):
+        """index the distributions modified by `archive_package`"""
+        for dist in sorted(self._stale_dists):
+            self.update_metadata('dists', dist)
+        self._stale_dists.clear()
+
+    def close(self):
+        self.flush()
+        if self._metadata:
+            self._metadata.close()
+        self._metadata = None
+        if self._stanza_store is not None:
+            self._stanza_store.close()
+        self._stanza_store = None
+        for cache in self._caches.values():
+            if cache is not None:
+                cache.close()
+        self._caches.clear()
 
     def check_distrib(self, section, distrib):
         distribdir = osp.join(self.directory, section, distrib)
@@ -157,63 +512,173 @@ class DebianRepository(object):
         return distribdir
 
     def generate_aptconf(self, origin='Logilab'):
-        """write a configuration file for use by apt-ftparchive"""
+        """write a configuration file for use by apt-ftparchive, unless it is
+        up to date. Return True if the file was written.
+        """
         header_file = self.aptconf_file+".in"
         if not osp.isfile(header_file):
             with open(header_file, "w") as stream:
                 stream.write(APTDEFAULT_APTCONF % { 'origin': origin,
                                                     'archivedir': self.dists_directory,
                                                     })
-        stream = open(self.aptconf_file, "w")
-        stream.write('// Generated by ldi; DO NOT EDIT\n')
-        stream.write('// You may edit the apt.conf.in file to customize it\n')
+        content = ['// Generated by ldi; DO NOT EDIT\n',
+                   '// You may edit the apt.conf.in file to customize it\n']
         header = [line.rstrip() for line in open(header_file)]
         marker = "// MODIFY BELOW THIS LINE"
         if marker in header:
             header = header[header.index(marker) + 1:]
-        stream.write('\n'.join(header))
-        for distrib in glob(osp.join(self.dists_directory, '*')):
+        content.append('\n'.join(header))
+        for distrib in sorted(glob(osp.join(self.dists_directory, '*'))):
             if osp.isdir(distrib) and not osp.islink(distrib):
                 distrib = osp.basename(distrib)
-                stream.write(BINDIRECTORY_APTCONF % {'distribution': distrib})
-        stream.close()
+                content.append(BINDIRECTORY_APTCONF % {'distribution': distrib})
+        content = ''.join(content)
+        if osp.isfile(self.aptconf_file):
+            with open(self.aptconf_file) as stream:
+                if stream.read() == content:
+                    return False
+        with open(self.aptconf_file, "w") as stream:
+            stream.write(content)
+        return True
+
+    def aptconf_options(self):
+        """return options set in the apt.conf.in file (see `parse_aptconf`)"""
+        header_file = self.aptconf_file + '.in'
+        if not osp.isfile(header_file):
+            return {}
+        with open(header_file) as stream:
+            return parse_aptconf(stream.read())
+
+    def fingerprints_directory(self):
+        """return the directory where fingerprints of published distributions
+        are recorded, or None if it can't be trusted
+        """
+        cachedir = self.private_cache_directory()
+        if cachedir is None:
+            return None
+        return osp.join(cachedir, 'fingerprints')
+
+    def dist_fingerprint(self, dist, extra=''):
+        """return a digest of the name, size and modification time of the files
+        of a distribution (index files excepted) and of the apt.conf.in file,
+        `extra` being any other string the indexes depend on
+        """
+        distdir = osp.join(self.dists_directory, dist)
+        generated = ('Packages', 'Sources', 'Contents', 'Release')
+        digest = hashlib.sha1(extra.encode('utf-8'))
+        header_file = self.aptconf_file + '.in'
+        if osp.isfile(header_file):
+            with open(header_file, 'rb') as stream:
+                digest.update(stream.read())
+        for fname in sorted(os.listdir(distdir)):
+            if fname.startswith(generated) or fname.startswith('.'):
+                continue
+            st = os.stat(osp.join(distdir, fname))
+            digest.update(('%s\0%d\0%r\0' % (fname, st.st_size, st.st_mtime)
+                           ).encode('utf-8'))
+        return digest.hexdigest()
+
+    def dist_uptodate(self, dist, extra=''):
+        """return True if the distribution didn't change since the fingerprint
+        recorded by `save_fingerprint` and its Release file exists
+        """
+        directory = self.fingerprints_directory()
+        if directory is None or \
+               not osp.isfile(osp.join(self.dists_directory, dist, 'Release')):
+            return False
+        try:
+            with open(osp.join(directory, dist)) as stream:
+                recorded = stream.read().strip()
+        except (IOError, OSError):
+            return False
+        return recorded == self.dist_fingerprint(dist, extra)
+
+    def save_fingerprint(self, dist, extra=''):
+        """record the fingerprint of a successfully published distribution"""
+        directory = self.fingerprints_directory()
+        if directory is None:
+            return
+        path = osp.join(self._makedirs(directory), dist)
+        with open(path + '.new', 'w') as stream:
+            stream.write(self.dist_fingerprint(dist, extra) + '\n')
+        os.rename(path + '.new', path)
 
     def dist_publish(self, dist, gpgkeyid=None):
-        self.dist_clean(dist)
-        self.ftparchive_generate(dist)
-        self.ftparchive_release(dist)
+        written = self.generate_indexes(dist)
+        self.dist_clean(dist, keep=written)
+        self.write_release(dist, written)
         if gpgkeyid:
             self.sign(dist, gpgkeyid)
 
-    def dist_clean(self, dist):
+    def dist_clean(self, dist, keep=()):
         for mask in ['Packages*', 'Source*', 'Content*', 'Release*']:
             for path in glob(osp.join(self.dists_directory, dist, mask)):
+                if osp.basename(path) in keep:
+                    continue
                 self.logger.debug('rm %s', path)
                 os.remove(path)
 
-    def ftparchive_generate(self, dist):
-        command = ['apt-ftparchive', '-q=2', 'generate',
-                   self.aptconf_file, dist]
-        self.logger.debug(' '.join(command))
-        pipe = subprocess.Popen(command)
-        status = pipe.wait()
-        if status != 0:
-            raise CommandError('apt-ftparchive exited with error status %d' % status)
-
-    def ftparchive_release(self, dist):
-        distdir = osp.join(self.dists_directory, dist)
-        command = ['apt-ftparchive', '-c', self.aptconf_file, 'release',
-                   distdir,
-                   '-o', 'APT::FTPArchive::Release::Codename=%s' % dist]
-        self.logger.debug('running command: %s', ' '.join(command))
-        release_file = osp.join(distdir, 'Release')
-        release = open(release_file, 'w')
-        pipe = subprocess.Popen(command, stdout=release)
-        pipe.communicate()
-        release.close()
-        if pipe.returncode != 0:
-            raise CommandError('apt-ftparchive exited with error status %d'
-                               % pipe.returncode)
+    def compressions(self):
+        """return a {index name: compressions} dictionary according to the
+        Default::<index>::Compress options of apt.conf.in
+        """
+        options = self.aptconf_options()
+        compressions = {}
+        for index in INDEXES:
+            value = options.get('Default::%s::Compress' % index)
+            if value is None:
+                continue
+            formats = value.split()
+            unavailable = check_compressions(formats)
+            for compression in unavailable:
+                self.logger.warning('%s compression is not available, skip '
+                                    'it for %s files', compression, index)
+            compressions[index] = [fmt for fmt in formats
+                                   if fmt not in unavailable]
+        return compressions
+
+    def generate_indexes(self, dist):
+        """write the Packages, Sources and Contents files of a distribution,
+        only reading packages which were not indexed by a previous run
+        """
+        generator = IndexGenerator(self.logger, self.dists_directory,
+                                   self.stanza_store(), self.hash_cache,
+                                   self.compressions())
+        return generator.generate(dist)
+
+    def stanza_store(self):
+        """return the StanzaStore used to generate indexes, opened once until
+        the repository is closed
+        """
+        if self._stanza_store is None:
+            cachedir = self.private_cache_directory()
+            if cachedir is None:
+                # index every package again rather than trusting stanzas
+                # stored where others may write
+                self._stanza_store = StanzaStore(':memory:')
+            else:
+                self._stanza_store = StanzaStore(osp.join(cachedir,
+                                                          'stanzas.db'))
+        return self._stanza_store
+
+    def write_release(self, dist, files):
+        """write the Release file of a distribution, `files` being the
+        {file name: (size, digests)} dictionary returned by `generate_indexes`
+        """
+        options = self.aptconf_options()
+        prefix = 'APT::FTPArchive::Release::'
+        fields = dict((name[len(prefix):], value)
+                      for name, value in options.items()
+                      if name.startswith(prefix))
+        fields['Codename'] = dist
+        fields['Date'] = release_date()
+        release_file = osp.join(self.dists_directory, dist, 'Release')
+        tmppath = osp.join(self.dists_directory, dist, '.Release.new')
+        with open(tmppath, 'wb') as stream:
+            stream.write(format_release(fields, files).encode('utf-8'))
+        os.chmod(tmppath, 0o664)
+        os.rename(tmppath, release_file)
+        self.logger.debug('wrote %s', release_file)
 
     def sign(self, dist, gpgkeyid):
         releasepath = osp.join(self.dists_directory, dist, 'Release')
@@ -237,6 +702,15 @@ class DebianRepository(object):
         changes = []
         if distrib:
             distrib = osp.basename(osp.realpath(osp.join(path, distrib)))
+        metadata = self.metadata()
+        if metadata is not None:
+            rows = metadata.changes(osp.basename(path),
+                                    distrib and [distrib] or None)
+            for dist, fname, _, _, _ in rows:
+                fpath = osp.join(path, dist, fname)
+                if not args or fname in args or fpath in args:
+                    changes.append(fpath)
+            return sorted(changes)
         if args:
             file_match = lambda f: f in args or osp.join(root, f) in args
         else:
@@ -251,6 +725,15 @@ class DebianRepository(object):
         return sorted(changes)
 
     def iter_changes_files(self, package=None, dists=None):
+        metadata = self.metadata()
+        if metadata is not None:
+            if dists:
+                dists = [osp.basename(osp.realpath(
+                    osp.join(self.dists_directory, dist))) for dist in dists]
+            for dist, fname, _, _, _ in metadata.changes('dists', dists):
+                if package is None or fname.startswith(package + '_'):
+                    yield osp.join(self.dists_directory, dist, fname)
+            return
         if package is None:
             matchstring = '*.changes'
         else:
@@ -264,7 +747,7 @@ class DebianRepository(object):
 
     def iter_packages(self, package=None, dists=None):
         for changesfile in self.iter_changes_files(package, dists):
-            package, version, archi = changesfile.split('_')
+            package, version, archi = osp.basename(changesfile).split('_')
             dist = osp.basename(osp.dirname(changesfile))
             try:
                 yield (dist, archi.replace('.changes', ''),
@@ -278,46 +761,41 @@ class DebianRepository(object):
             repo1.setdefault(package, {}).setdefault(dist, {}).setdefault(archi, set()).add(version)
         return repo1
 
-    def archive_package(self, dist, package, version, archi):
+    def archive_package(self, dist, package, version, archi, reason='archive'):
         self.logger.info('archive %s %s %s %s', dist, package, version, archi)
         distdir = osp.join(self.dists_directory, dist)
-        archivedir = osp.join(self.archive_directory, dist)
+        archive = self.archive
         changes = osp.join(distdir, changesfile(package, version, archi))
-        for bpackage in Changes(changes).get_packages():
+        for bpackage in Changes.open(changes).get_packages():
             for fpath in glob(osp.join(distdir, '%s_%s_%s*' % (bpackage, version, archi))):
-                self.logger.debug('move %s', fpath)
-                shutil.move(fpath, osp.join(archivedir, osp.basename(fpath)))
+                archive.archive(dist, package, fpath, reason)
             for fpath in glob(osp.join(distdir, '%s_%s_all*' % (bpackage, version))):
-                self.logger.debug('move %s', fpath)
-                shutil.move(fpath, osp.join(archivedir, osp.basename(fpath)))
-        if glob(osp.join(distdir, changesfile(package, version, '*'))):
-            # .dsc, .diff.gz, .orig.tar.gz should be kept for some other
-            # architecture
-            move = shutil.copy
-        else:
-            move = shutil.move
+                archive.archive(dist, package, fpath, reason)
+        # .dsc, .diff.gz, .orig.tar.gz should be kept for some other
+        # architecture
+        copy = bool(glob(osp.join(distdir, changesfile(package, version, '*'))))
         for fpath in (osp.join(distdir, '%s_%s.dsc' % (package, version)),
                       osp.join(distdir, '%s_%s.diff.gz' % (package, version))):
             if osp.exists(fpath):
-                self.logger.debug('%s %s', move.__name__, fpath)
-                move(fpath, osp.join(archivedir, osp.basename(fpath)))
+                archive.archive(dist, package, fpath, reason, copy)
         upstreamversion = Version(version.upstream_version)
         if glob(osp.join(distdir, changesfile(package, upstreamversion, '*',
                                               upstreamversion=True))):
             # don't remove .orig.tar.gz if there still exists packages for that
             # upstream version
-            move = shutil.copy
+            copy = True
         fpath  = osp.join(distdir, '%s_%s.orig.tar.gz' % (package, upstreamversion))
         if osp.exists(fpath):
-            self.logger.debug('%s %s', move.__name__, fpath)
-            move(fpath, osp.join(archivedir, osp.basename(fpath)))
+            archive.archive(dist, package, fpath, reason, copy)
+        # indexed once for all the packages archived (see `close`)
+        self._stale_dists.add(dist)
 
     def reduce_package(self, dist, package, versions, archi):
         versions = sorted(versions)
-        lastversion = versions.pop()[:2]
+        lastversion = versions.pop().series
         for version in reversed(versions):
-            majorversion = version[:2]
+            majorversion = version.series
             if lastversion == majorversion:
-                self.archive_package(dist, package, version, archi)
+                self.archive_package(dist, package, version, archi, 'reduce')
             else:
                 lastversion = majorversion
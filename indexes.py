@@ -0,0 +1,435 @@
+# Copyright (c) 2007-2011 LOGILAB S.A. (Paris, FRANCE).
+# http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""native generation of the Packages, Sources and Contents index files of a
+distribution, as apt-ftparchive would write them.
+
+Stanzas are kept in a per-repository store, so that only packages added to a
+distribution since its last publication have to be read.
+"""
+
+from __future__ import with_statement
+
+import hashlib
+import os
+import os.path as osp
+import sqlite3
+import threading
+from time import time
+
+try:
+    from debian import deb822
+except ImportError:
+    from debian_bundle import deb822
+
+from debinstall.cache import stat_key
+from debinstall.debfiles import DebFile, digest_file
+
+# field order of the stanzas written by apt-ftparchive (see apt's tagfile.cc),
+# other fields come next in their original order
+PACKAGES_ORDER = (
+    'Package', 'Essential', 'Status', 'Priority', 'Section', 'Installed-Size',
+    'Maintainer', 'Original-Maintainer', 'Architecture', 'Source', 'Version',
+    'Revision', 'Config-Version', 'Replaces', 'Provides', 'Depends',
+    'Pre-Depends', 'Recommends', 'Suggests', 'Conflicts', 'Breaks',
+    'Conffiles', 'Filename', 'Size', 'MD5Sum', 'MD5sum', 'SHA1', 'SHA256',
+    'SHA512', 'MSDOS-Filename', 'Description')
+
+SOURCES_ORDER = (
+    'Package', 'Source', 'Binary', 'Version', 'Priority', 'Section',
+    'Maintainer', 'Original-Maintainer', 'Build-Depends',
+    'Build-Depends-Indep', 'Build-Conflicts', 'Build-Conflicts-Indep',
+    'Architecture', 'Standards-Version', 'Format', 'Directory', 'Files')
+
+# (field of Sources stanzas, checksum key, hashlib algorithm)
+SOURCES_CHECKSUMS = (
+    ('Files', 'md5sum', 'md5'),
+    ('Checksums-Sha1', 'sha1', 'sha1'),
+    ('Checksums-Sha256', 'sha256', 'sha256'),
+    )
+
+# variants of each index, as in the default apt.conf ('.' is uncompressed)
+COMPRESSIONS = ('.', 'gzip', 'bzip2')
+EXTENSIONS = {'.': '', 'gzip': '.gz', 'bzip2': '.bz2', 'xz': '.xz',
+              'zstd': '.zst'}
+# size of the chunks of index data written or compressed at once
+CHUNK_SIZE = 1 << 20
+
+INDEXES = ('Packages', 'Sources', 'Contents')
+
+
+def format_stanza(fields, order):
+    """return a stanza as a string, `fields` being a list of (name, value)"""
+    rank = dict((name.lower(), i) for i, name in enumerate(order))
+    fields = sorted(enumerate(fields),
+                    key=lambda item: (rank.get(item[1][0].lower(), len(order)),
+                                      item[0]))
+    lines = []
+    for _, (name, value) in fields:
+        if value.startswith('\n'):
+            lines.append('%s:%s\n' % (name, value))
+        else:
+            lines.append('%s: %s\n' % (name, value))
+    return ''.join(lines)
+
+def deb_stanza(path, filename, hashcache=None):
+    """return the (Packages stanza, Contents lines) of a binary package,
+    `filename` being its path relative to the archive directory
+    """
+    deb = DebFile(path)
+    control = deb.control()
+    digests = digest_file(path, ('md5', 'sha1', 'sha256'), hashcache)
+    fields = list(control.items()) + [
+        ('Filename', filename),
+        ('Size', str(os.stat(path).st_size)),
+        ('MD5sum', digests['md5']),
+        ('SHA1', digests['sha1']),
+        ('SHA256', digests['sha256']),
+        ]
+    location = '%s/%s' % (control.get('Section') or 'unknown',
+                          control['Package'])
+    contents = ''.join('%s\t%s\n' % (fpath, location)
+                       for fpath in deb.data_files())
+    return format_stanza(fields, PACKAGES_ORDER), contents
+
+def dsc_stanza(path, directory, hashcache=None):
+    """return the Sources stanza of a source package, `directory` being its
+    directory relative to the archive directory
+    """
+    dirname = osp.dirname(path)
+    with open(path) as stream:
+        dsc = deb822.Deb822(stream)
+    fields = []
+    files = []
+    for name, value in dsc.items():
+        if name == 'Source':
+            fields.append(('Package', value))
+        elif name in ('Files', 'Checksums-Sha1', 'Checksums-Sha256'):
+            if name == 'Files':
+                files = [line.split()[-1] for line in value.splitlines()
+                         if line.strip()]
+        else:
+            fields.append((name, value))
+    fields.append(('Directory', directory))
+    files.insert(0, osp.basename(path))
+    for field, _, algo in SOURCES_CHECKSUMS:
+        lines = []
+        for fname in files:
+            fpath = osp.join(dirname, fname)
+            digest = digest_file(fpath, ('md5', 'sha1', 'sha256'),
+                                 hashcache)[algo]
+            lines.append(' %s %s %s' % (digest, os.stat(fpath).st_size, fname))
+        fields.append((field, '\n' + '\n'.join(lines)))
+    return format_stanza(fields, SOURCES_ORDER)
+
+def contents_file(lines):
+    """return the content of a Contents file from 'path\\tlocation' lines: one
+    line per path, sorted, listing every package shipping it
+    """
+    locations = {}
+    for line in lines:
+        if line:
+            fpath, location = line.rsplit('\t', 1)
+            locations.setdefault(fpath, []).append(location)
+    output = []
+    for fpath in sorted(locations):
+        output.append(fpath)
+        # apt-ftparchive aligns package names on column 60 using tabs then
+        # spaces
+        current, target = len(fpath), max(60, len(fpath) + 1)
+        while (current // 8 + 1) * 8 < target:
+            output.append('\t')
+            current = (current // 8 + 1) * 8
+        output.append(' ' * (target - current))
+        output.append(','.join(locations[fpath]))
+        output.append('\n')
+    return ''.join(output)
+
+
+class StanzaStore(object):
+    """sqlite database holding the Packages / Sources stanzas and Contents
+    lines of the packages of every distribution, with the (device, inode,
+    size, mtime, ctime) of the file they were computed from
+    """
+    # version of the schema, stored in the database
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.cnx = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.cnx.execute('PRAGMA synchronous=OFF')
+        if self.cnx.execute('PRAGMA user_version').fetchone()[0] != self.version:
+            self.cnx.execute('DROP TABLE IF EXISTS stanzas')
+            self.cnx.execute('PRAGMA user_version=%d' % self.version)
+        self.cnx.execute('CREATE TABLE IF NOT EXISTS stanzas (dist TEXT, '
+                         'filename TEXT, kind TEXT, dev INTEGER, ino INTEGER, '
+                         'size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, '
+                         'stanza TEXT, contents TEXT, '
+                         'PRIMARY KEY (dist, filename))')
+        self.cnx.commit()
+
+    def __repr__(self):
+        return 'StanzaStore(%s)' % self.path
+
+    def keys(self, dist):
+        """return a {filename: stat key} dictionary"""
+        with self._lock:
+            rows = self.cnx.execute('SELECT filename, dev, ino, size, mtime_ns, '
+                                    'ctime_ns FROM stanzas WHERE dist=?',
+                                    (dist,))
+            return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def update(self, dist, removed, added):
+        """remove stanzas of `removed` filenames and add `added` ones, a list
+        of (filename, kind, stat key, stanza, contents), in one transaction
+        """
+        with self._lock:
+            with self.cnx:
+                self.cnx.executemany(
+                    'DELETE FROM stanzas WHERE dist=? AND filename=?',
+                    [(dist, filename) for filename in removed])
+                self.cnx.executemany(
+                    'INSERT OR REPLACE INTO stanzas VALUES '
+                    '(?,?,?,?,?,?,?,?,?,?)',
+                    [(dist, filename, kind) + tuple(key) + (stanza, contents)
+                     for filename, kind, key, stanza, contents in added])
+
+    def stanzas(self, dist, kind):
+        """return the list of (stanza, contents) of the distribution, ordered
+        by file name
+        """
+        with self._lock:
+            return self.cnx.execute('SELECT stanza, contents FROM stanzas WHERE '
+                                    'dist=? AND kind=? ORDER BY filename',
+                                    (dist, kind)).fetchall()
+
+    def close(self):
+        self.cnx.close()
+
+
+class CompressionError(Exception):
+    """raised when an index file couldn't be compressed"""
+
+
+def compressor(compression):
+    """return a compressor object (with `compress` and `flush` methods) for
+    the given apt compression name
+    """
+    if compression == 'gzip':
+        import zlib
+        # gzip header with no file name nor time stamp
+        return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'bzip2':
+        import bz2
+        return bz2.BZ2Compressor(9)
+    if compression == 'xz':
+        try:
+            import lzma
+        except ImportError: # python 2
+            from backports import lzma # optional dependency
+        return lzma.LZMACompressor(lzma.FORMAT_XZ)
+    if compression == 'zstd':
+        import zstandard # optional dependency
+        return zstandard.ZstdCompressor(level=19).compressobj()
+    raise CompressionError('unsupported compression %r' % compression)
+
+def check_compressions(compressions):
+    """return a list of the given compressions which are not available"""
+    unavailable = []
+    for compression in compressions:
+        if compression == '.':
+            continue
+        try:
+            compressor(compression)
+        except (ImportError, CompressionError):
+            unavailable.append(compression)
+    return unavailable
+
+def write_variant(compression, data, path):
+    """write `data` compressed with `compression` ('.' for none) to `path` and
+    return the size and digests of the written file with the elapsed time.
+
+    Compressors and hashes release the GIL on large chunks, so that variants
+    may be written by concurrent threads.
+    """
+    start = time()
+    compobj = None
+    if compression != '.':
+        compobj = compressor(compression)
+    with open(path, 'wb') as output:
+        hasher = HashingWriter(output)
+        for offset in range(0, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            if compobj is not None:
+                chunk = compobj.compress(chunk)
+            hasher.write(chunk)
+        if compobj is not None:
+            hasher.write(compobj.flush())
+    return hasher.size, hasher.digests(), time() - start
+
+
+class IndexGenerator(object):
+    """generate the index files of the distributions of a repository.
+
+    `compressions` is a {index name: compressions} dictionary, indexes not in
+    it being written with the default COMPRESSIONS.
+    """
+    def __init__(self, logger, dists_directory, store, hashcache=None,
+                 compressions=None):
+        self.logger = logger
+        self.dists_directory = dists_directory
+        self.store = store
+        self.hashcache = hashcache
+        self.compressions = compressions or {}
+
+    def update_store(self, dist):
+        """synchronize stanzas of the distribution with the packages it holds,
+        reading only new or modified ones
+        """
+        distdir = osp.join(self.dists_directory, dist)
+        known = self.store.keys(dist)
+        current = {}
+        for fname in os.listdir(distdir):
+            if fname.endswith(('.deb', '.udeb', '.dsc')):
+                current[fname] = stat_key(osp.join(distdir, fname))
+        removed = [fname for fname in known
+                   if current.get(fname) != known[fname]]
+        added = []
+        for fname in sorted(current):
+            if known.get(fname) == current[fname]:
+                continue
+            path = osp.join(distdir, fname)
+            try:
+                if fname.endswith('.dsc'):
+                    stanza = dsc_stanza(path, dist, self.hashcache)
+                    added.append((fname, 'dsc', current[fname], stanza, ''))
+                else:
+                    stanza, contents = deb_stanza(path, '%s/%s' % (dist, fname),
+                                                  self.hashcache)
+                    added.append((fname, 'deb', current[fname], stanza,
+                                  contents))
+            except Exception as ex:
+                self.logger.error('skip %s from %s indexes: %s', fname, dist, ex)
+        self.logger.debug('%s: %d stanzas removed, %d added', dist,
+                          len([f for f in removed if f not in current]),
+                          len(added))
+        self.store.update(dist, removed, added)
+
+    def generate(self, dist):
+        """write Packages, Sources and Contents files of the distribution with
+        their compressed variants; return the list of written file names
+        """
+        self.update_store(dist)
+        debs = self.store.stanzas(dist, 'deb')
+        dscs = self.store.stanzas(dist, 'dsc')
+        data = {
+            'Packages': ''.join(stanza + '\n' for stanza, _ in debs),
+            'Sources': ''.join(stanza + '\n' for stanza, _ in dscs),
+            'Contents': contents_file(
+                ''.join(contents for _, contents in debs).splitlines()),
+            }
+        written = {}
+        for index in INDEXES:
+            written.update(self.write_index(dist, index,
+                                            data[index].encode('utf-8')))
+        return written
+
+    def write_index(self, dist, index, data):
+        """write an index file and its compressed variants, each one through a
+        temporary file renamed once complete.
+
+        Return a {file name: (size, {algorithm: digest})} dictionary, digests
+        being computed on the written bytes so that the Release file doesn't
+        have to read them again.
+        """
+        distdir = osp.join(self.dists_directory, dist)
+        compressions = self.compressions.get(index, COMPRESSIONS)
+        try:
+            results = self._write_variants(distdir, index, data, compressions)
+        except Exception:
+            for compression in compressions:
+                tmppath = osp.join(distdir, '.%s%s.new'
+                                   % (index, EXTENSIONS[compression]))
+                if osp.exists(tmppath):
+                    os.remove(tmppath)
+            raise
+        written = {}
+        for fname in sorted(results):
+            tmppath, size, digests, elapsed = results[fname]
+            path = osp.join(distdir, fname)
+            os.chmod(tmppath, 0o664)
+            os.rename(tmppath, path)
+            self.logger.debug('wrote %s (%d bytes) in %.2fs', path, size,
+                              elapsed)
+            written[fname] = (size, digests)
+        return written
+
+    def _write_variants(self, distdir, index, data, compressions):
+        """write index variants to temporary files and return a {file name:
+        (temporary path, size, digests, elapsed time)} dictionary.
+
+        Each variant is written by its own thread, so that they are compressed
+        in parallel.
+        """
+        results = {}
+        errors = []
+        def write(compression, fname, tmppath):
+            try:
+                results[fname] = (tmppath,) + write_variant(compression, data,
+                                                            tmppath)
+            except Exception as ex:
+                errors.append('%s compression of %s failed: %s'
+                              % (compression, index, ex))
+        threads = []
+        for compression in compressions:
+            fname = index + EXTENSIONS[compression]
+            thread = threading.Thread(
+                target=write, args=(compression, fname,
+                                    osp.join(distdir, '.%s.new' % fname)))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise CompressionError(errors[0])
+        return results
+
+
+class HashingWriter(object):
+    """file-like object writing to `stream` while computing the size and
+    digests of the written data
+    """
+    algorithms = ('md5', 'sha1', 'sha256')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+        self.hashes = [(algo, hashlib.new(algo)) for algo in self.algorithms]
+
+    def write(self, data):
+        self.stream.write(data)
+        self.size += len(data)
+        for _, hashobj in self.hashes:
+            hashobj.update(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+    def digests(self):
+        return dict((algo, hashobj.hexdigest()) for algo, hashobj in self.hashes)
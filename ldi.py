@@ -19,18 +19,31 @@ packages and repositories
 from __future__ import print_function
 
 import sys
-import shutil
 import os
 import os.path as osp
+import shlex
+import signal
+import socket
+import tempfile
+import time
+from functools import partial
 from glob import glob
 from itertools import chain
 
-from lockfile import FileLock
+from lockfile import LockError
 from logilab.common import clcommands as cli, shellutils as sht
 
 from debinstall.__pkginfo__ import version
-from debinstall import debrepo
-from debinstall.debfiles import BadSignature, Changes
+from debinstall import daemon, debrepo
+from debinstall.archive import package_name
+from debinstall.checkers import run_checkers
+from debinstall.cache import (CheckerCache, HashCache, SignatureCache,
+                              stat_key)
+from debinstall.debfiles import (BadSignature, Changes, ReferenceIndex,
+                                 SignatureVerifier, check_reports)
+from debinstall.metadata import SECTIONS
+from debinstall.pipeline import Stage, run_pipeline
+from debinstall.transfer import INODE_METHODS, private_inode, transfer
 
 if osp.exists('/etc/debinstallrc'):
     RCFILE = '/etc/debinstallrc'
@@ -40,6 +53,9 @@ else:
 LDI = cli.CommandLine('ldi', doc='Logilab debian installer', version=version,
                       logthreshold='INFO', rcfile=RCFILE)
 
+# delay between checks of a publication request, in seconds
+WAIT_DELAY = 0.5
+
 OPTIONS = [
     ('distributions', # XXX to share with lgp
      {'type': 'csv', 'short': 'd', 'group': 'main',
@@ -63,7 +79,54 @@ OPTIONS = [
     ('checkers',
      {'type': 'csv', 'short': 'C', 'group': 'main',
       'help': 'comma separated list of checkers to run before package upload/publish',
-      'default': ['lintian'],
+      'default': ['structure', 'lintian'],
+      }),
+    ]
+
+CHECKER_OPTIONS = [
+    ('checkers-jobs',
+     {'type': 'int', 'group': 'main',
+      'help': 'number of checkers run concurrently',
+      'default': 4,
+      }),
+    ('checkers-batch-size',
+     {'type': 'int', 'group': 'main',
+      'help': 'maximum number of changes files checked by a single checker '
+      'process, for checkers supporting it',
+      'default': 20,
+      }),
+    ('checker-timeout',
+     {'type': 'int', 'group': 'main',
+      'help': 'number of seconds after which a checker is killed (0 to '
+      'disable)',
+      'default': 3600,
+      }),
+    ]
+
+HASH_OPTIONS = [
+    ('no-hash-cache',
+     {'action': 'store_true', 'group': 'main',
+      'help': "don't use the repository's persistent cache of file checksums",
+      'default': False,
+      }),
+    ('hash-cache-size',
+     {'type': 'int', 'group': 'main',
+      'help': 'maximum number of entries of the checksums cache',
+      'default': 100000,
+      }),
+    ('hash-workers',
+     {'type': 'int', 'group': 'main',
+      'help': 'number of files whose checksums are verified concurrently',
+      'default': 4,
+      }),
+    ]
+
+DAEMON_OPTIONS = [
+    ('no-daemon',
+     {'action': 'store_true',
+      'help': "run the command in this process even if the repository is "
+      "served by ldid",
+      'default': False,
       }),
     ]
 
@@ -72,6 +135,10 @@ def run():
     os.umask(0o02) # user in same group should be able to overwrite files
     LDI.run(sys.argv[1:])
 
+def run_daemon():
+    os.umask(0o02)
+    LDI.run(['daemon'] + sys.argv[1:])
+
 def _repo_path(config, directory):
     if not osp.isabs(directory):
         if not config.repositories_directory:
@@ -83,6 +150,19 @@ def _repo_path(config, directory):
     return directory
 
 class LDICommand(cli.Command):
+    # repository served by ldid, whose caches are kept open from one command
+    # to the other
+    repository = None
+
+    def main_run(self, args, rcfile=None):
+        # kept to be forwarded to the daemon
+        self.arguments = list(args)
+        try:
+            return cli.Command.main_run(self, args, rcfile)
+        finally:
+            if Changes.cache.hits or Changes.cache.misses:
+                self.logger.debug(Changes.cache.stats())
+
     def schmod(self, path, mode):
         """safe chmod, log on error"""
         try:
@@ -107,6 +187,34 @@ class LDICommand(cli.Command):
             self.logger.error('cant remove %s, fix this by yourself (%s)',
                               path, ex)
 
+    def _forward(self, repodir):
+        """run the command in the daemon serving the repository, if any, and
+        return True; return False if it has to be run by this process
+        """
+        sockpath = daemon.socket_path(repodir)
+        if self.config.no_daemon or not osp.exists(sockpath):
+            return False
+        # the daemon may run in another directory
+        args = [osp.abspath(arg) if not arg.startswith('-') and osp.exists(arg)
+                else arg for arg in self.arguments]
+        try:
+            daemon.check_arguments(self.name, args)
+        except ValueError as ex:
+            self.logger.debug('not run by ldid: %s', ex)
+            return False
+        try:
+            response = daemon.forward(sockpath, self.name, args,
+                                      self.logger.getEffectiveLevel())
+        except socket.error as ex:
+            self.logger.debug('cannot use daemon on %s: %s', sockpath, ex)
+            return False
+        sys.stderr.write(response['log'])
+        sys.stdout.write(response['stdout'])
+        if response['status']:
+            raise cli.CommandError('%s failed in ldid (status %s)'
+                                   % (self.name, response['status']))
+        return True
+
 
 class Create(LDICommand):
     """create a new repository"""
@@ -161,7 +269,7 @@ class Upload(LDICommand):
     name = "upload"
     min_args = 2
     arguments = "[options] <repository> <package.changes>..."
-    options = OPTIONS[1:] + [
+    options = OPTIONS[1:] + CHECKER_OPTIONS + HASH_OPTIONS + DAEMON_OPTIONS + [
         ('check-signature',
          {'type': 'yn', 'group': 'upload',
           'help': 'Check package signature before upload',
@@ -179,10 +287,24 @@ class Upload(LDICommand):
         ]
 
     def run(self, args):
-        repo = self._check_repository(_repo_path(self.config, args.pop(0)))
+        repodir = _repo_path(self.config, args.pop(0))
+        if self._forward(repodir):
+            return
+        repo = self._check_repository(repodir)
         self.debian_changes = {}
-        for filename in args:
-            changes = self._check_changes_file(filename)
+        self.references = ReferenceIndex(self.logger)
+        self._open_caches(repo)
+        try:
+            self._upload(repo, args)
+        finally:
+            self._close_caches()
+            self._close_repository(repo)
+
+    def _upload(self, repo, args):
+        all_changes = [self._check_changes_file(filename) for filename in args]
+        self._check_signatures(all_changes)
+        targets = []
+        for changes in all_changes:
             if self.config.distribution:
                 distrib = self.config.distribution
             else:
@@ -190,21 +312,26 @@ class Upload(LDICommand):
             try:
                 distribdir = repo.check_distrib('incoming', distrib)
                 self._check_signature(changes)
-                self._run_checkers(changes)
             except cli.CommandError as ex:
                 self.logger.error(ex)
                 # ignore this changes file
                 continue
-            if self.config.remove:
-                move = sht.mv
-            else:
-                move = sht.cp
-            self.process_changes_file(changes, distribdir,
-                                      self.config.upload_group, move)
+            targets.append((changes, distribdir))
+        if self.config.remove:
+            move = sht.mv
+        else:
+            move = sht.cp
+        processed = self.process_changes_files(self._run_checkers(targets),
+                                               self.config.upload_group, move)
+        for distribdir in sorted(set(distribdir for _, distribdir in processed)):
+            repo.update_metadata('incoming', osp.basename(distribdir))
         if not self.debian_changes:
             raise cli.CommandError('No changes file uploaded')
 
     def _check_repository(self, repodir):
+        if (self.repository is not None and osp.realpath(repodir)
+            == osp.realpath(self.repository.directory)):
+            return self.repository
         if not osp.isdir(repodir):
             raise cli.CommandError("Repository %s doesn't exist" % repodir)
         for section in ('dists', 'incoming'):
@@ -215,6 +342,41 @@ class Upload(LDICommand):
                     % (repodir, section))
         return debrepo.DebianRepository(self.logger, repodir)
 
+    def _cache_directory(self, repo):
+        """return the directory of the caches, whose content is trusted"""
+        # uploaders could as well skip any check they don't want to be done
+        return repo.cache_directory
+
+    def _open_caches(self, repo):
+        self.hash_cache = self.signature_cache = self.checker_cache = None
+        cachedir = self._cache_directory(repo)
+        if cachedir is not None:
+            if not self.config.no_hash_cache:
+                self.hash_cache = repo.open_cache(cachedir, HashCache,
+                                                  self.config.hash_cache_size)
+            self.signature_cache = repo.open_cache(cachedir, SignatureCache,
+                                                   self.config.hash_cache_size)
+            self.checker_cache = repo.open_cache(cachedir, CheckerCache,
+                                                 self.config.hash_cache_size)
+        self.sig_verifier = SignatureVerifier(self.signature_cache,
+                                              self.hash_cache)
+        repo.hash_cache = self.hash_cache
+
+    def _close_caches(self):
+        """forget the caches, which are closed with the repository"""
+        for cache in (self.hash_cache, self.signature_cache,
+                      self.checker_cache):
+            if cache is not None:
+                self.logger.debug(cache.stats())
+        self.hash_cache = self.signature_cache = self.checker_cache = None
+
+    def _close_repository(self, repo):
+        """close a repository, unless it's the one kept open by ldid"""
+        if repo is self.repository:
+            repo.flush()
+        else:
+            repo.close()
+
     def _check_changes_file(self, changes_file):
         """basic tests to determine debian changes file"""
         if not changes_file.endswith('.changes'):
@@ -224,103 +386,203 @@ class Upload(LDICommand):
             raise cli.CommandError(
                 '%s doesn\'t exist or is not a regulary file' % changes_file)
         try:
-            return Changes(changes_file)
+            return Changes.open(changes_file)
         except Exception as ex:
             raise cli.CommandError(
                 '%s is not a debian changes file: %s' % (changes_file, ex))
 
+    def _check_signatures(self, all_changes):
+        """verify at once the signatures of all the given changes files and of
+        their dsc files
+        """
+        if self.config.check_signature:
+            signed_files = []
+            for changes in all_changes:
+                try:
+                    signed_files += changes.signed_files()
+                except Exception:
+                    continue # missing files, reported later
+            self.sig_verifier.verify(signed_files)
+
     def _check_signature(self, changes):
         """raise error if the changes files and appropriate dsc files are not
         correctly signed
         """
         if self.config.check_signature:
             try:
-                changes.check_sig()
+                keyids = changes.check_sig(self.sig_verifier)
+                self.logger.info('%s signed by %s', changes.filename,
+                                 ', '.join(sorted(set(keyids))))
             except BadSignature as ex:
                 raise cli.CommandError(
                     "%s. Check if the PGP block exists and if the key is in your "
                     "keyring" % ex)
 
-    def _run_checkers(self, changes):
-        checkers = self.config.checkers
+    def _run_checkers(self, targets):
+        """run checkers on the changes files of the given (changes, target
+        directory) list, concurrently. Log errors and return the list of
+        targets which passed.
+        """
         try:
-            changes.run_checkers(checkers)
+            errors = run_checkers([changes.path for changes, _ in targets],
+                                  self.config.checkers, self.checker_cache,
+                                  self.config.checkers_jobs,
+                                  self.config.checker_timeout,
+                                  self.config.checkers_batch_size)
         except Exception as ex:
-            raise cli.CommandError(str(ex))
+            self.logger.error(ex)
+            return []
+        accepted = []
+        for changes, destdir in targets:
+            if errors[changes.path] is not None:
+                self.logger.error(errors[changes.path])
+                # ignore this changes file
+                continue
+            accepted.append((changes, destdir))
+        return accepted
 
     def _files_to_keep(self, changes):
-        # In case of multi-arch in same directory, we need to check if parts
-        # of changes files are not required by another changes files We're
-        # excluding the current parsed changes file
-        mask = "%s*.changes" % changes.filename.rsplit('_', 1)[0]
-        ochanges = glob(osp.join(changes.dirname, mask))
-        ochanges.remove(changes.path)
-        # Find intersection of files shared by several 'changes'
-        allfiles = changes.get_all_files()
-        result = allfiles & set([f for c in ochanges
-                                 for f in Changes(c).get_all_files()])
+        # In case of multi-arch or of multiple Debian revisions of the same
+        # upstream release in the same directory, parts of the changes file
+        # (eg. the pristine tarball) may be required by other changes files
+        result = self.references.shared(changes)
         if result:
-            self.logger.warn("keep intact changes file's parts "
-                             "required by another architecture(s)")
-            return result
-        pristine = changes.get_pristine()
-        if pristine:
-            # Another search to preserve pristine tarball in case of multiple
-            # revision of the same upstream release
-            # We're excluding the current parsed changes file
-            mask = "%s*.changes" % changes.filename.rsplit('-', 1)[0]
-            ochanges = glob(osp.join(changes.dirname, mask))
-            ochanges.remove(changes.path)
-            # Check if the detected changes files really needs the tarball
-            result = set([r for r in ochanges
-                          if Changes(r).get_pristine() == pristine])
-            if result:
-                self.logger.warn("keep intact original pristine tarball "
-                                 "required by another Debian revision(s)")
-            return result
-        return set()
-
-    def process_changes_file(self, changes, distribdir, group,
-                             move=sht.cp, rm=False, force=False):
-        if not changes.check_hashes():
-            self.logger.warn("skipping %s, checksum mismatch", changes.path)
-            return
+            self.logger.warn("keep intact changes file's parts required by "
+                             "other changes files: %s", ', '.join(
+                                 sorted(osp.basename(f) for f in result)))
+        return result
+
+    def process_changes_files(self, targets, group, move=sht.cp, rm=False,
+                              force=False):
+        """transfer the files of the changes files of the given (changes,
+        distribution directory) list, the checksums of all of them being
+        verified at once. Return the list of processed targets.
+        """
+        if move is sht.mv:
+            rm = False
+        destinations = set()
+        plans = []
+        processed = []
+        try:
+            for changes, distribdir in targets:
+                plans.append(self._plan_transfers(changes, distribdir, move,
+                                                  rm, force, destinations))
+            check_reports([report for _, report in plans], self.hash_cache,
+                          self.config.hash_workers)
+            for (changes, distribdir), (transfers, report) in zip(targets,
+                                                                  plans):
+                if self._transfer_files(changes, distribdir, group, move, rm,
+                                        transfers, report):
+                    processed.append((changes, distribdir))
+        finally:
+            # copies which haven't been installed
+            for _, report in plans:
+                for fcheck in report.files:
+                    fcheck.discard()
+        return processed
+
+    def _plan_transfers(self, changes, distribdir, move, rm, force,
+                        destinations):
+        """return the list of (file, destination, rename) transfers of a
+        changes file and the HashReport checking its files. `destinations` is
+        the set of files planned to be written by the previous changes files.
+        """
         allfiles = changes.get_all_files()
+        report = changes.hashes_report()
         # Logilab uses trivial Debian repository and put all generated files in
         # the same place. Badly, it occurs some problems in case of several
         # supported architectures and multiple Debian revision (in this order)
         if move is sht.mv:
             tokeep = self._files_to_keep(changes)
-            rm = False
+            # changes files processed next may move the files they share with
+            # this one, its references are restored if it is rejected
+            self.references.remove(changes)
         else:
             tokeep = ()
-        for filename in allfiles:
-            if filename in tokeep:
-                move_ = sht.cp
-            else:
-                move_ = move
+        transfers = []
+        for filename in sorted(allfiles):
             destfile = osp.join(distribdir, osp.basename(filename))
-            if osp.exists(destfile):
+            if osp.exists(destfile) or destfile in destinations:
                 if not force:
                     self.logger.error("%s already exists, skipping; use '--force' to overwrite" % destfile)
                     continue
                 else:
                     self.logger.warn("%s already exists, but removing anyway as requested" % destfile)
+            # source files are either moved or removed once all of them are
+            # copied, except those shared with other changes files
+            rename = move is sht.mv and filename not in tokeep
+            transfers.append((filename, destfile, rename))
+            destinations.add(destfile)
+        # files which have to be copied are checked while being copied to a
+        # temporary file, others (moved or linked, which is only done for
+        # files nobody else can modify) are checked in place
+        fchecks = dict((fcheck.path, fcheck) for fcheck in report.files)
+        for filename, destfile, rename in transfers:
+            if filename in fchecks and not (
+                    (rename or rm) and private_inode(filename)):
+                # uploads aren't locked: each one copies to its own file
+                fd, fchecks[filename].destination = tempfile.mkstemp(
+                    dir=distribdir, prefix='.%s.' % osp.basename(filename))
+                os.close(fd)
+        return transfers, report
+
+    def _transfer_files(self, changes, distribdir, group, move, rm, transfers,
+                        report):
+        """transfer the files of a checked changes file, return False if
+        it has been rejected
+        """
+        self.logger.debug(report.summary())
+        if not report:
+            for fcheck in report.files:
+                fcheck.discard()
+            for error in report.errors:
+                self.logger.error(error)
+            self.logger.warn("skipping %s, checksum mismatch", changes.path)
+            if move is sht.mv:
+                self.references.add(changes)
+            return False
+        if move is sht.mv:
+            # files shared with a changes file rejected meanwhile are kept
+            shared = self.references.shared(changes)
+        else:
+            shared = ()
+        fchecks = dict((fcheck.path, fcheck) for fcheck in report.files)
+        for filename, destfile, rename in transfers:
+            fcheck = fchecks.get(filename)
+            if fcheck is not None and fcheck.destination is not None:
+                if group:
+                    self.schown(fcheck.destination, group=group)
+                self.schmod(fcheck.destination, 0o664)
+                os.rename(fcheck.destination, destfile)
+                self.logger.debug("checked copy %s %s", filename, destfile)
+            else:
+                if osp.exists(destfile):
                     os.unlink(destfile)
-            self.logger.debug("%s %s %s", move_.__name__, filename, destfile)
-            move_(filename, distribdir)
-            if group:
-                self.schown(destfile, group=group)
-            self.schmod(destfile, 0o664)
+                method = transfer(filename, destfile,
+                                  rename=rename and filename not in shared,
+                                  link=rm, group=group, mode=0o664)
+                self.logger.debug("%s %s %s", method, filename, destfile)
+                if method not in INODE_METHODS:
+                    if group:
+                        self.schown(destfile, group=group)
+                    self.schmod(destfile, 0o664)
+            if self.hash_cache is not None and fcheck is not None:
+                # we've just checked the content of the copied file
+                self.hash_cache.set(stat_key(destfile), dict(fcheck.computed))
         if rm:
-            tokeep = allfiles
-        if tokeep:
-            for filename in tokeep:
+            for filename in changes.get_all_files():
                 self.logger.debug("rm %s", filename)
                 self.srm(filename)
+        else:
+            # files to be moved which had to be copied
+            for filename, destfile, rename in transfers:
+                if rename and filename not in shared and osp.exists(filename):
+                    self.logger.debug("rm %s", filename)
+                    self.srm(filename)
         distrib = osp.basename(distribdir)
         changeslist = self.debian_changes.setdefault(distrib, [])
         changeslist.append(osp.join(distribdir, changes.filename))
+        return True
 
 LDI.register(Upload)
 
@@ -330,7 +592,7 @@ class Publish(Upload):
     name = "publish"
     min_args = 1
     arguments = "<repository> [<package.changes>...]"
-    options = OPTIONS[1:] + [
+    options = OPTIONS[1:] + CHECKER_OPTIONS + HASH_OPTIONS + DAEMON_OPTIONS + [
         ('check-signature',
          {'type': 'yn', 'group': 'publish',
           'help': 'Check package signature before publish',
@@ -344,6 +606,12 @@ class Publish(Upload):
           'help': 'refresh the whole repository index files',
           'default': False,
           }),
+        ('force-refresh',
+         {'action': "store_true",
+          'help': 'refresh the whole repository index files, even those of '
+          'distributions which did not change since the last publication',
+          'default': False,
+          }),
         ('force',
          {'action': 'store_true', 'short': 'f', 'group': 'publish',
           'help': 'Overwrite destination files if they exist',
@@ -352,59 +620,227 @@ class Publish(Upload):
          {'action': 'store_true', 'short': 'u', 'group': 'publish',
           'help': "Don't ask for confirmation before publishing packages",
          }),
+        ('publish-jobs',
+         {'type': 'int', 'group': 'publish',
+          'help': 'number of distributions whose index files are generated '
+          'concurrently',
+          'default': 4,
+         }),
+        ('coalesce',
+         {'action': 'store_true',
+          'help': 'publish the whole incoming queue, without confirmation, '
+          'unless another coalescing publication is running, in which case it '
+          'is requested to publish the incoming queue once more',
+          'default': False,
+         }),
+        ('wait',
+         {'action': 'store_true',
+          'help': 'with --coalesce, wait for the requested publication to be '
+          'done',
+          'default': False,
+         }),
         ]
 
     def run(self, args):
-        repo = self._check_repository(_repo_path(self.config, args.pop(0)))
-        distribs = set()
+        repodir = _repo_path(self.config, args.pop(0))
+        if self._forward(repodir):
+            return
+        repo = self._check_repository(repodir)
         self.debian_changes = {}
-        # we have to launch the publication sequentially
-        lockfile = osp.join(repo.directory, 'ldi.lock')
-        with FileLock(lockfile):
-            changes_files = repo.incoming_changes_files(args)
-            if not changes_files and not self.config.refresh:
-                self.logger.error("no changes file to publish in %s",
-                                  repo.incoming_directory)
-            if os.isatty(0) and not self.config.no_confirm and changes_files:
-                self.logger.info('Publishing the following changes files:\n%s', '\n'.join(changes_files))
-                if not sht.ASK.confirm('Do you want to proceed?'):
-                    raise cli.CommandError('user abort')
-            for filename in changes_files:
-                # distribution name is the same as the incoming directory name
-                # it lets override a valid suite by a more private one (for
-                # example: contrib, volatile, experimental, ...)
-                distrib = osp.basename(osp.dirname(filename))
-                destdir = repo.check_distrib('dists', distrib)
-                changes = self._check_changes_file(filename)
-                try:
-                    self._check_signature(changes)
-                    self._run_checkers(changes)
-                except cli.CommandError as ex:
-                    self.logger.error(ex)
-                    # ignore this changes file
+        self._open_caches(repo)
+        try:
+            if self.config.coalesce:
+                self._coalesced_publish(repo)
+            else:
+                self._publish(repo, args)
+        finally:
+            self._close_caches()
+            self._close_repository(repo)
+
+    def _cache_directory(self, repo):
+        # the cache directory is shared with uploaders
+        return repo.private_cache_directory()
+
+    def _forward(self, repodir):
+        # confirmation is asked by this process
+        if not (self.config.no_confirm or self.config.coalesce):
+            if os.isatty(0):
+                return False
+            self.arguments.append('--no-confirm')
+        return Upload._forward(self, repodir)
+
+    def _coalesced_publish(self, repo):
+        """register a publication request, then process requests unless
+        another process does it.
+
+        The running publisher publishes the incoming queue once for all the
+        requests registered before the publication started, and again as long
+        as some were registered meanwhile. Requests registered once it's done
+        are noticed after the lock is released.
+        """
+        self.config.no_confirm = True
+        request = repo.request_publish()
+        publisher = repo.publisher_lock()
+        while True:
+            try:
+                publisher.acquire(timeout=0)
+            except LockError:
+                if self.config.wait and osp.exists(request):
+                    time.sleep(WAIT_DELAY)
                     continue
-                # perform a copy instead of a move to reset file ownership
-                self.process_changes_file(changes, destdir,
-                                          self.config.publish_group, rm=True,
-                                          force=self.config.force)
-                # mark distribution to be refreshed at the end
-                distribs.add(distrib)
-            repo.generate_aptconf()
-            if self.config.refresh:
-                distribs = ('*',)
-            for distrib in distribs:
-                try:
-                    self._apt_refresh(repo, distrib)
-                except Exception as ex:
-                    self.logger.error(ex)
-
-    def _apt_refresh(self, repo, distrib="*"):
-        for distdir in glob(osp.join(repo.dists_directory, distrib)):
-            if osp.isdir(distdir) and not osp.islink(distdir):
-                repo.dist_publish(osp.basename(distdir))
-                if self.config.gpg_keyid:
-                    self.logger.info('signing release')
-                    repo.sign(distdir, self.config.gpg_keyid)
+                if osp.exists(request):
+                    self.logger.info('publication requested to the running '
+                                     'publisher')
+                return
+            try:
+                self._publish_requests(repo)
+            finally:
+                publisher.release()
+            if not repo.publish_requests():
+                return
+
+    def _publish_requests(self, repo):
+        passes = 0
+        while True:
+            requests = repo.publish_requests()
+            if not requests:
+                break
+            passes += 1
+            self.logger.info('publication pass %d for %d requests', passes,
+                             len(requests))
+            if repo.incoming_changes_files([]):
+                self._publish(repo, [])
+            for request in requests:
+                self.srm(request)
+
+    def _publish(self, repo, args):
+        changes_files = repo.incoming_changes_files(args)
+        if not changes_files and not self.config.refresh:
+            self.logger.error("no changes file to publish in %s",
+                              repo.incoming_directory)
+        if os.isatty(0) and not self.config.no_confirm and changes_files:
+            self.logger.info('Publishing the following changes files:\n%s', '\n'.join(changes_files))
+            if not sht.ASK.confirm('Do you want to proceed?'):
+                raise cli.CommandError('user abort')
+        pending = {}
+        for filename in changes_files:
+            changes = self._check_changes_file(filename)
+            # distribution name is the same as the incoming directory name
+            # it lets override a valid suite by a more private one (for
+            # example: contrib, volatile, experimental, ...)
+            destdir = repo.check_distrib('dists', osp.basename(changes.dirname))
+            pending.setdefault(destdir, []).append(changes)
+        with repo.lock():
+            if repo.generate_aptconf():
+                self.logger.debug('wrote %s', repo.aptconf_file)
+        if self.config.refresh or self.config.force_refresh:
+            for distdir in self._distdirs(repo):
+                pending.setdefault(distdir, [])
+        # signatures of all the changes files are verified at once
+        self._check_signatures([changes for all_changes in pending.values()
+                                for changes in all_changes])
+        # created before threads are started
+        repo.metadata()
+        repo.stanza_store()
+        stages = run_pipeline([
+            Stage('verify', self._verify_stage),
+            Stage('check', self._check_stage),
+            Stage('ingest', partial(self._ingest_stage, repo)),
+            Stage('index', partial(self._index_stage, repo),
+                  min(self.config.publish_jobs, len(pending))),
+            ], sorted(pending.items()), self.logger)
+        for stage in stages:
+            self.logger.info(stage.report())
+        failed = [stage.name for stage in stages if stage.errors]
+        if failed:
+            raise cli.CommandError('publication failed in %s stage'
+                                   % ', '.join(failed))
+
+    def _distdirs(self, repo, distribs=('*',)):
+        """return directories of the given distributions, symlinks excepted"""
+        distdirs = []
+        for distrib in sorted(distribs):
+            for distdir in sorted(glob(osp.join(repo.dists_directory, distrib))):
+                if osp.isdir(distdir) and not osp.islink(distdir):
+                    distdir = osp.realpath(distdir)
+                    if distdir not in distdirs:
+                        distdirs.append(distdir)
+        return distdirs
+
+    # publication is a pipeline processing (distribution directory, changes
+    # list) items: each stage can process a distribution while the previous
+    # one processes the next distribution. Checks are done without lock,
+    # accepted changes files are ingested then indexes generated while their
+    # distribution is locked.
+
+    def _verify_stage(self, item, emit):
+        distdir, all_changes = item
+        accepted = []
+        for changes in all_changes:
+            try:
+                self._check_signature(changes)
+            except cli.CommandError as ex:
+                self.logger.error(ex)
+                # ignore this changes file
+                continue
+            accepted.append(changes)
+        emit((distdir, accepted))
+
+    def _check_stage(self, item, emit):
+        distdir, all_changes = item
+        if all_changes:
+            accepted = self._run_checkers([(changes, distdir)
+                                           for changes in all_changes])
+            all_changes = [changes for changes, _ in accepted]
+        emit((distdir, all_changes))
+
+    def _ingest_stage(self, repo, item, emit):
+        distdir, all_changes = item
+        if all_changes:
+            with repo.lock(osp.basename(distdir)):
+                self._ingest(repo, distdir, all_changes)
+        if all_changes or self.config.refresh or self.config.force_refresh:
+            emit(distdir)
+
+    def _index_stage(self, repo, distdir, emit):
+        try:
+            with repo.lock(osp.basename(distdir)):
+                self._dist_refresh(repo, distdir)
+        except Exception as ex:
+            self.logger.error('%s: %s', osp.basename(distdir), ex)
+
+    def _ingest(self, repo, distdir, all_changes):
+        """move changes files from the incoming queue to the locked
+        distribution directory
+        """
+        targets = []
+        for changes in all_changes:
+            if not osp.exists(changes.path):
+                self.logger.warning('%s was published meanwhile',
+                                    changes.filename)
+                continue
+            targets.append((changes, distdir))
+        # files of uploaders are copied rather than moved or linked, so that
+        # published files belong to the publisher
+        self.process_changes_files(targets, self.config.publish_group,
+                                   rm=True, force=self.config.force)
+        if targets:
+            repo.update_metadata('dists', osp.basename(distdir))
+        for incoming in sorted(set(changes.dirname for changes, _ in targets)):
+            repo.update_metadata('incoming', osp.basename(incoming))
+
+    def _dist_refresh(self, repo, distdir):
+        dist = osp.basename(distdir)
+        # index files have to be signed again if the signing key changes
+        extra = self.config.gpg_keyid or ''
+        if not self.config.force_refresh and repo.dist_uptodate(dist, extra):
+            self.logger.info('%s is up to date', dist)
+            return
+        repo.dist_publish(dist)
+        if self.config.gpg_keyid:
+            self.logger.info('signing release of %s', dist)
+            repo.sign(distdir, self.config.gpg_keyid)
+        repo.save_fingerprint(dist, extra)
 
 LDI.register(Publish)
 
@@ -437,9 +873,7 @@ class Incoming(Upload):
 
             distribs = set()
             self.debian_changes = {}
-            # we have to launch the publication sequentially
-            lockfile = osp.join(repo.directory, 'ldi.lock')
-            with FileLock(lockfile):
+            with repo.lock():
                 changes_files = repo.incoming_changes_files([])
                 if changes_files:
                     self.logger.warning('There are incoming packages in %s', path)
@@ -475,7 +909,7 @@ class List(Upload):
                     'default': False,
                     'help': 'report orphaned packages or files (can be slow)'
                    }),
-                ]
+                ] + DAEMON_OPTIONS
 
     def run(self, args):
         if not args:
@@ -495,6 +929,8 @@ class List(Upload):
             return
 
         path = _repo_path(self.config, args.pop(0))
+        if self._forward(path):
+            return
         repo = self._check_repository(path)
         if self.config.section not in ('dists', 'incoming'):
             raise cli.CommandError('Unknown section %s' % self.config.section)
@@ -508,7 +944,9 @@ class List(Upload):
                     if osp.islink(dirpath):
                         line = '%s is symlinked to %s' % (dirpath, os.readlink(dirpath))
                     else:
-                        nb = len(glob(osp.join(dirpath, "*.changes")))
+                        nb = len(repo.incoming_changes_files(None, d)
+                                 if self.config.section == 'incoming' else
+                                 repo.dists_changes_files(None, d))
                         if nb:
                             line = "%s contains %d changes files" % (dirpath, nb)
                         else:
@@ -553,16 +991,19 @@ class List(Upload):
 
     def get_orphaned_files(self, repository, distrib):
         import fnmatch
-        if self.config.section == 'dists':
-            changes_files = repository.dists_changes_files(None, distrib=distrib)
-            directory = repository.dists_directory
+        directory = getattr(repository, '%s_directory' % self.config.section)
+        metadata = repository.metadata()
+        if metadata is not None:
+            distdir = osp.join(directory, distrib)
+            references = metadata.references(
+                self.config.section, osp.basename(osp.realpath(distdir)))
+            tracked_files = set(osp.join(distdir, fname)
+                                for fname in chain(*references.values()))
         else:
-            changes_files = repository.incoming_changes_files(None, distrib=distrib)
-            directory = repository.incoming_directory
-        tracked_files = (Changes(f).get_all_files(check_if_exists=False)
-                         for f in changes_files if f)
-        tracked_files = set(chain(*tracked_files))
-
+            changes_files = repository._changes_files(directory, None, distrib)
+            tracked_files = (Changes.open(f).get_all_files(
+                check_if_exists=False) for f in changes_files if f)
+            tracked_files = set(chain(*tracked_files))
         untracked_files = set(glob(osp.join(directory, distrib, '*')))
         orphaned_files = untracked_files - tracked_files
         orphaned_files -= set(fnmatch.filter(orphaned_files, "*/Packages*"))
@@ -604,7 +1045,8 @@ class Diff(Upload):
         self.logger.debug('**** analyzing repo %s', trepo.ldiname)
         repo2 = {}
         for dist, archi, package, version in trepo.iter_packages(dists=dists):
-            repo2[package] = max(repo2.get(package), version)
+            if repo2.get(package) is None or version > repo2[package]:
+                repo2[package] = version
             try:
                 repo1[package][dist][archi] = [v for v in repo1[package][dist][archi]
                                                if v > version]
@@ -616,8 +1058,8 @@ class Diff(Upload):
             print('packages in %s which are not in %s:' % (repo.ldiname, trepo.ldiname))
             for package in sorted(repo1):
                 missing = {}
-                for dist, distinfo in repo1[package].iteritems():
-                    for archi, versions in distinfo.iteritems():
+                for dist, distinfo in repo1[package].items():
+                    for archi, versions in distinfo.items():
                         for version in versions:
                             missing.setdefault(version, []).append('%s-%s' % (dist, archi))
                 if missing:
@@ -625,12 +1067,12 @@ class Diff(Upload):
                     print('* %s (%s)' % (package, repo2version or 'no version released'))
                     lastversion = None
                     for version in reversed(sorted(missing)):
-                        if lastversion is not None and version[:2] == lastversion:
+                        if lastversion is not None and version.series == lastversion:
                             continue
                         if not self.config.all and repo2version and repo2version > version:
                             continue
                         print('  - %s (%s)' % (version, ', '.join(missing[version])), end=' ')
-                        lastversion = version[:2]
+                        lastversion = version.series
                         if repo2version == version:
                             print('MISSING DIST / ARCH')
                         else:
@@ -669,10 +1111,16 @@ class Reduce(Upload):
 
     def run(self, args):
         repo = self._check_repository(_repo_path(self.config, args.pop(0)))
+        try:
+            self._reduce(repo)
+        finally:
+            repo.close()
+
+    def _reduce(self, repo):
         idx = repo.packages_index(self.config.package)
         for package in sorted(idx):
-            for dist, distinfo in idx[package].iteritems():
-                for archi, versions in distinfo.iteritems():
+            for dist, distinfo in idx[package].items():
+                for archi, versions in distinfo.items():
                     try:
                         repo.reduce_package(dist, package, versions, archi)
                     except:
@@ -683,10 +1131,18 @@ LDI.register(Reduce)
 
 
 class Archive(Upload):
-    """Archive some versions of a package published in a repository."""
+    """Archive some versions of a package published in a repository, or list
+    archived files of a package.
+
+    Archived files are stored in archive/<dist>/<prefix>/<source package>/ and
+    recorded in the archive/MANIFEST file. Archives of older ldi versions,
+    where files are directly in archive/<dist>/, can be converted using
+    --migrate.
+    """
     name = "archive"
-    min_args = max_args = 2
-    arguments = "<repository> <source package>"
+    min_args = 1
+    max_args = 2
+    arguments = "<repository> [<source package>]"
     options = [OPTIONS[1]] + [
         ('up-to-version',
          {'type': 'string', 'short': 'u',
@@ -696,12 +1152,37 @@ class Archive(Upload):
          {'type': 'string', 'short': 'd',
           'help': 'don\'t remove package with version prior to given value',
           }),
+        ('list',
+         {'action': 'store_true', 'short': 'l', 'default': False,
+          'help': 'list archived files of the package instead of archiving',
+          }),
+        ('migrate',
+         {'action': 'store_true', 'default': False,
+          'help': 'move files of a flat archive directory to their shard',
+          }),
         ]
 
     def run(self, args):
         repo = debrepo.DebianRepository(
             self.logger, _repo_path(self.config, args.pop(0)))
+        try:
+            self._archive(repo, args)
+        finally:
+            repo.close()
+
+    def _archive(self, repo, args):
+        if self.config.migrate:
+            self._migrate(repo)
+            return
+        if not args:
+            raise cli.CommandError('missing source package')
         sourcepackage = args.pop(0)
+        if self.config.list:
+            for date, dist, _, relpath, reason in repo.archive.entries(
+                    sourcepackage):
+                print('%s %s %s (%s)' % (date, dist, osp.basename(relpath),
+                                         reason))
+            return
         if self.config.down_to_version is None:
             downtoversion = None
         else:
@@ -717,6 +1198,14 @@ class Archive(Upload):
                 continue
             repo.archive_package(dist, package, version, archi)
 
+    def _migrate(self, repo):
+        archive = repo.archive
+        for dist in sorted(os.listdir(repo.archive_directory)):
+            if not osp.isdir(osp.join(repo.archive_directory, dist)):
+                continue
+            count = archive.migrate(dist)
+            self.logger.info('%s: %d files migrated', dist, count)
+
 LDI.register(Archive)
 
 
@@ -740,6 +1229,7 @@ class Check(LDICommand):
         else:
             dists = self.config.distributions
         allfiles = set()
+        checked = []
         for dist in os.listdir(repo.dists_directory):
             if dists and not dist in dists:
                 continue
@@ -747,34 +1237,123 @@ class Check(LDICommand):
             if not osp.isdir(distdir):
                 self.logger.debug('skip non-directory %s', distdir)
                 continue
+            if osp.islink(distdir):
+                self.logger.debug('skip symlinked distribution %s', distdir)
+                continue
+            checked.append(dist)
             for fname in os.listdir(distdir):
                 if fname.startswith(('Packages', 'Sources', 'Contents', 'Release')):
                     continue
                 allfiles.add(osp.join(dist, fname))
         untrackedfiles = allfiles.copy()
-        for changesf in repo.iter_changes_files(dists=dists):
-            dist = osp.basename(osp.dirname(changesf))
-            changes = Changes(osp.join(repo.dists_directory, changesf))
-            for fname in changes.get_all_files(False):
-                try:
-                    untrackedfiles.remove(osp.join(dist, osp.basename(fname)))
-                except KeyError:
-                    if osp.join(dist, osp.basename(fname)) in allfiles:
-                        continue # shared file already removed from untrackedfiles
-                    self.logger.error('package %s reference unexisting file %s',
-                                      osp.join(dist, osp.basename(changesf)),
-                                      osp.basename(fname))
+        metadata = repo.metadata()
+        for dist in sorted(checked):
+            if metadata is not None:
+                references = metadata.references('dists', dist)
+            else:
+                references = {}
+                for changesf in glob(osp.join(repo.dists_directory, dist,
+                                              '*.changes')):
+                    references[osp.basename(changesf)] = set(
+                        osp.basename(fname) for fname
+                        in Changes.open(changesf).get_all_files(False))
+            for changesf in sorted(references):
+                for fname in sorted(references[changesf]):
+                    try:
+                        untrackedfiles.remove(osp.join(dist, fname))
+                    except KeyError:
+                        if osp.join(dist, fname) in allfiles:
+                            continue # shared file already removed from untrackedfiles
+                        self.logger.error('package %s reference unexisting file %s',
+                                          osp.join(dist, changesf), fname)
+        repo.close()
         if untrackedfiles:
             print('untracked files:')
             print('\n'.join(sorted(untrackedfiles)))
             if self.config.archive:
+                archive = repo.archive
                 for fpath in untrackedfiles:
-                    shutil.move(osp.join(repo.dists_directory, fpath),
-                                osp.join(repo.archive_directory, fpath))
+                    dist, fname = osp.split(fpath)
+                    archive.archive(dist, package_name(fname),
+                                    osp.join(repo.dists_directory, fpath),
+                                    'untracked')
         else:
             print('no untracked files')
 
 LDI.register(Check)
 
+
+class Reindex(LDICommand):
+    """Rebuild the index of the changes files of a repository"""
+    name = "reindex"
+    min_args = max_args = 1
+    arguments = "<repository>"
+    options = OPTIONS[1:2]
+
+    def run(self, args):
+        repo = debrepo.DebianRepository(
+            self.logger, _repo_path(self.config, args.pop(0)))
+        metadata = repo.metadata()
+        if metadata is None:
+            raise cli.CommandError('cannot open the index of %s'
+                                   % repo.directory)
+        try:
+            metadata.reindex()
+            for section in SECTIONS:
+                self.logger.info('%s: %d changes files indexed', section,
+                                 len(metadata.changes(section)))
+        finally:
+            repo.close()
+
+LDI.register(Reindex)
+
+
+class Daemon(Upload):
+    """Serve a repository (ldid): publish its incoming queues automatically and
+    run upload, publish and list commands sent by ldi through a unix socket.
+
+    Incoming queues are published once no changes file arrived for --debounce
+    seconds. ldi commands on the repository are run by the daemon unless
+    --no-daemon is given.
+    """
+    name = "daemon"
+    min_args = max_args = 1
+    arguments = "<repository>"
+    options = OPTIONS[1:2] + [
+        ('debounce',
+         {'type': 'float', 'group': 'daemon',
+          'help': 'number of seconds without new changes file after which the '
+          'incoming queues are published',
+          'default': 5.0,
+          }),
+        ('socket',
+         {'type': 'string', 'group': 'daemon',
+          'help': 'path of the unix socket (default to ldid.sock in the '
+          'repository, where ldi looks for it)',
+          }),
+        ('publish-options',
+         {'type': 'string', 'group': 'daemon',
+          'help': 'additional options of automatic publications, eg. '
+          '"--checkers=lintian --gpg-keyid=XXX"',
+          'default': '',
+          }),
+        ]
+
+    def run(self, args):
+        repo = self._check_repository(_repo_path(self.config, args.pop(0)))
+        server = daemon.LdiDaemon(self.logger, repo, LDI, LDI.rcfile,
+                                  self.config.debounce,
+                                  shlex.split(self.config.publish_options),
+                                  self.config.socket)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            repo.close()
+
+LDI.register(Daemon)
+
 if __name__ == '__main__':
     run()
@@ -0,0 +1,224 @@
+# Copyright (c) 2007-2011 LOGILAB S.A. (Paris, FRANCE).
+# http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""sqlite index of the changes files of a repository and of the files they
+reference.
+
+Each (section, distribution) directory is indexed with its modification time:
+when a directory is found modified by someone not using the index, it is
+scanned again, so the index never answers with stale data.
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path as osp
+import sqlite3
+import threading
+
+from debinstall.cache import stat_key
+from debinstall.debfiles import Changes
+
+SECTIONS = ('incoming', 'dists')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS dirs (section TEXT, dist TEXT, '
+    'mtime_ns INTEGER, PRIMARY KEY (section, dist))',
+    'CREATE TABLE IF NOT EXISTS changes (section TEXT, dist TEXT, '
+    'filename TEXT, source TEXT, binaries TEXT, version TEXT, '
+    'architecture TEXT, size INTEGER, mtime_ns INTEGER, '
+    'PRIMARY KEY (section, dist, filename))',
+    'CREATE TABLE IF NOT EXISTS files (section TEXT, dist TEXT, '
+    'changes TEXT, name TEXT, size INTEGER, md5 TEXT, sha1 TEXT, '
+    'sha256 TEXT)',
+    'CREATE INDEX IF NOT EXISTS files_changes ON files (section, dist, '
+    'changes)',
+    'CREATE INDEX IF NOT EXISTS files_name ON files (section, dist, name)',
+    )
+
+
+def changes_info(path):
+    """return a (changes row, file rows) tuple describing a changes file, rows
+    lacking their section and distribution
+    """
+    st = stat_key(path)
+    changes = Changes.open(path)
+    filename = changes.filename
+    try:
+        architecture = filename[:-len('.changes')].rsplit('_', 1)[1]
+    except IndexError:
+        architecture = changes['Architecture']
+    row = (filename, changes['Source'], changes['Binary'],
+           changes['Version'], architecture, st[2], st[3])
+    files = []
+    for fcheck in changes.hashes_report().files:
+        files.append((filename, osp.basename(fcheck.path), fcheck.expected_size,
+                      fcheck.expected.get('md5'), fcheck.expected.get('sha1'),
+                      fcheck.expected.get('sha256')))
+    return row, files
+
+
+class MetadataIndex(object):
+    """index of the changes files of a repository"""
+    def __init__(self, path, repodir, logger=None):
+        self.path = path
+        self.repodir = repodir
+        self.logger = logger
+        self._lock = threading.RLock()
+        self.cnx = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        for sql in SCHEMA:
+            self.cnx.execute(sql)
+        self.cnx.commit()
+
+    def __repr__(self):
+        return 'MetadataIndex(%s)' % self.path
+
+    def close(self):
+        self.cnx.close()
+
+    def distributions(self, section):
+        """return the sorted list of distribution directories of a section,
+        symlinks excepted
+        """
+        sectiondir = osp.join(self.repodir, section)
+        return sorted(dist for dist in os.listdir(sectiondir)
+                      if osp.isdir(osp.join(sectiondir, dist))
+                      and not osp.islink(osp.join(sectiondir, dist)))
+
+    def sync(self, section, dist, force=False):
+        """update the index of a distribution directory if it was modified
+        since it was indexed (or unconditionally if `force` is true), in a
+        single transaction
+        """
+        distdir = osp.join(self.repodir, section, dist)
+        with self._lock:
+            if not osp.isdir(distdir):
+                self._drop(section, dist)
+                return
+            # recorded before listing, so that files added while scanning are
+            # seen by the next sync
+            mtime = stat_key(distdir)[3]
+            rows = self.cnx.execute('SELECT mtime_ns FROM dirs WHERE section=? '
+                                    'AND dist=?', (section, dist)).fetchall()
+            if rows and rows[0][0] == mtime and not force:
+                return
+            known = dict((row[0], tuple(row[1:])) for row in self.cnx.execute(
+                'SELECT filename, size, mtime_ns FROM changes WHERE section=? '
+                'AND dist=?', (section, dist)))
+            current = {}
+            for fname in os.listdir(distdir):
+                if fname.endswith('.changes'):
+                    try:
+                        current[fname] = stat_key(osp.join(distdir, fname))[2:4]
+                    except OSError: # removed meanwhile
+                        continue
+            removed = [fname for fname in known
+                       if current.get(fname) != known[fname]]
+            added = []
+            for fname in sorted(current):
+                if known.get(fname) == current[fname]:
+                    continue
+                try:
+                    added.append(changes_info(osp.join(distdir, fname)))
+                except Exception as ex:
+                    if self.logger is not None:
+                        self.logger.warning('cannot index %s/%s/%s: %s',
+                                            section, dist, fname, ex)
+            with self.cnx:
+                for fname in removed:
+                    self._remove(section, dist, fname)
+                for row, files in added:
+                    self.cnx.execute(
+                        'INSERT OR REPLACE INTO changes VALUES (?,?,?,?,?,?,?,?,?)',
+                        (section, dist) + row)
+                    self.cnx.executemany(
+                        'INSERT INTO files VALUES (?,?,?,?,?,?,?,?)',
+                        [(section, dist) + frow for frow in files])
+                self.cnx.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)',
+                                 (section, dist, mtime))
+            if (removed or added) and self.logger is not None:
+                self.logger.debug('%s/%s index: %d changes files removed, %d '
+                                  'added', section, dist,
+                                  len([f for f in removed if f not in current]),
+                                  len(added))
+
+    def _remove(self, section, dist, fname):
+        self.cnx.execute('DELETE FROM changes WHERE section=? AND dist=? AND '
+                         'filename=?', (section, dist, fname))
+        self.cnx.execute('DELETE FROM files WHERE section=? AND dist=? AND '
+                         'changes=?', (section, dist, fname))
+
+    def _drop(self, section, dist):
+        with self.cnx:
+            for table in ('dirs', 'changes', 'files'):
+                self.cnx.execute('DELETE FROM %s WHERE section=? AND dist=?'
+                                 % table, (section, dist))
+
+    def sync_section(self, section, dists=None, force=False):
+        """sync distributions of a section (all of them if `dists` is None),
+        dropping those which don't exist anymore; return the synced ones
+        """
+        existing = self.distributions(section)
+        with self._lock:
+            indexed = [row[0] for row in self.cnx.execute(
+                'SELECT dist FROM dirs WHERE section=?', (section,))]
+        for dist in indexed:
+            if dist not in existing:
+                self._drop(section, dist)
+        if dists is not None:
+            existing = [dist for dist in existing if dist in dists]
+        for dist in existing:
+            self.sync(section, dist, force)
+        return existing
+
+    def reindex(self):
+        """rebuild the whole index"""
+        with self._lock:
+            with self.cnx:
+                for table in ('dirs', 'changes', 'files'):
+                    self.cnx.execute('DELETE FROM %s' % table)
+            for section in SECTIONS:
+                self.sync_section(section, force=True)
+
+    def changes(self, section, dists=None, source=None):
+        """return a sorted list of (dist, changes file name, source, version,
+        architecture) tuples
+        """
+        dists = self.sync_section(section, dists)
+        sql = ('SELECT dist, filename, source, version, architecture FROM '
+               'changes WHERE section=?')
+        args = [section]
+        if source is not None:
+            sql += ' AND source=?'
+            args.append(source)
+        with self._lock:
+            rows = self.cnx.execute(sql + ' ORDER BY dist, filename',
+                                    args).fetchall()
+        dists = set(dists)
+        return [row for row in rows if row[0] in dists]
+
+    def references(self, section, dist):
+        """return a {changes file name: set of file names} dictionary of the
+        files referenced by changes files of a distribution, changes files
+        themselves included
+        """
+        self.sync(section, dist)
+        with self._lock:
+            rows = self.cnx.execute('SELECT changes, name FROM files WHERE '
+                                    'section=? AND dist=?', (section, dist))
+            references = {}
+            for changes, name in rows:
+                references.setdefault(changes, set([changes])).add(name)
+            return references
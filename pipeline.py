@@ -0,0 +1,128 @@
+# Copyright (c) 2007-2011 LOGILAB S.A. (Paris, FRANCE).
+# http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""pipelines of stages run by threads and connected by bounded queues, each
+stage measuring how long it was busy and idle (waiting for input or for the
+next stage to accept its output).
+"""
+
+from __future__ import with_statement
+
+import threading
+from time import time
+try:
+    from queue import Queue
+except ImportError: # python 2
+    from Queue import Queue
+
+# number of items waiting between two stages
+QUEUE_SIZE = 16
+
+_STOP = object()
+
+
+class Stage(object):
+    """a pipeline stage calling `func(item, emit)` for each item it receives,
+    `emit` passing a result to the next stage. `workers` threads run the
+    stage.
+    """
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.busy = self.idle = 0.
+        self.items = self.errors = 0
+        self._lock = threading.Lock()
+        self._running = 0
+        self.input = self.output = None
+        self.logger = None
+
+    def __repr__(self):
+        return 'Stage(%s)' % self.name
+
+    def report(self):
+        total = self.busy + self.idle
+        return '%s: %d items, busy %.2fs, idle %.2fs (%d%% busy)' % (
+            self.name, self.items, self.busy, self.idle,
+            total and 100 * self.busy / total or 0)
+
+    def _emit(self, item, blocked):
+        if self.output is not None:
+            start = time()
+            self.output.put(item)
+            blocked.append(time() - start)
+
+    def _run(self):
+        idle = busy = 0.
+        items = errors = 0
+        while True:
+            start = time()
+            item = self.input.get()
+            idle += time() - start
+            if item is _STOP:
+                # let other workers of the stage stop too
+                self.input.put(_STOP)
+                break
+            blocked = []
+            start = time()
+            try:
+                self.func(item, lambda result: self._emit(result, blocked))
+            except Exception as ex:
+                errors += 1
+                if self.logger is not None:
+                    self.logger.exception('%s stage failed on %s: %s',
+                                          self.name, item, ex)
+            items += 1
+            busy += time() - start - sum(blocked)
+            idle += sum(blocked)
+        with self._lock:
+            self.busy += busy
+            self.idle += idle
+            self.items += items
+            self.errors += errors
+            self._running -= 1
+            last = not self._running
+        if last and self.output is not None:
+            self.output.put(_STOP)
+
+    def start(self):
+        threads = []
+        self._running = self.workers
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+
+def run_pipeline(stages, items, logger=None, queue_size=QUEUE_SIZE):
+    """feed `items` to a pipeline made of `stages` and wait until every stage
+    is done
+    """
+    queues = [Queue(queue_size) for _ in stages]
+    threads = []
+    for index, stage in enumerate(stages):
+        stage.logger = logger
+        stage.input = queues[index]
+        if index + 1 < len(stages):
+            stage.output = queues[index + 1]
+        threads += stage.start()
+    for item in items:
+        queues[0].put(item)
+    queues[0].put(_STOP)
+    for thread in threads:
+        thread.join()
+    return stages
@@ -4,9 +4,16 @@ import shutil
 import logging
 from glob import glob
 import subprocess
+import tempfile
+import threading
+import time
 
 from logilab.common.testlib import TestCase, unittest_main
 
+from debinstall.daemon import LdiDaemon, socket_path
+from debinstall import ldi
+from debinstall.debfiles import SignatureVerifier
+from debinstall.debrepo import DebianRepository
 from debinstall.ldi import LDI
 
 TESTDIR = osp.abspath(osp.dirname(__file__))
@@ -22,7 +29,11 @@ class LdiLogHandler(logging.Handler):
 HANDLER = LdiLogHandler()
 
 def setUpModule(*args):
-    os.environ['GNUPGHOME'] = osp.join(TESTDIR, 'gnupg')
+    # gpg writes its state files in its home directory
+    global GNUPGHOME
+    GNUPGHOME = tempfile.mkdtemp()
+    shutil.copy(osp.join(TESTDIR, 'gnupg', 'pubring.gpg'), GNUPGHOME)
+    os.environ['GNUPGHOME'] = GNUPGHOME
     data_dir = osp.join(TESTDIR, 'data')
     if not osp.isdir(data_dir):
         os.mkdir(data_dir)
@@ -32,6 +43,7 @@ def setUpModule(*args):
 def tearDownModule(*args):
     if osp.exists(REPODIR):
         shutil.rmtree(REPODIR)
+    shutil.rmtree(GNUPGHOME)
 
 def run_command(cmd, *commandargs):
     cmd = LDI.get_command(cmd, logger=LDI.create_logger(HANDLER))
@@ -76,6 +88,53 @@ class LdiUploadTC(TestCase):
         self.assertEqual(cmd.debian_changes,
                           {'unstable': [osp.join(REPODIR, 'incoming/unstable/package1_1.0-1_i386.changes')]})
 
+    def test_upload_batch(self):
+        calls = {'gpg': 0, 'check_reports': 0}
+        gpg, check_reports = SignatureVerifier._gpg, ldi.check_reports
+        def counting_gpg(verifier, args):
+            calls['gpg'] += 1
+            return gpg(verifier, args)
+        def counting_check_reports(reports, *args):
+            calls['check_reports'] += 1
+            self.assertEqual(len(reports), 2)
+            return check_reports(reports, *args)
+        # no cached signature
+        shutil.rmtree(osp.join(REPODIR, 'cache'), ignore_errors=True)
+        SignatureVerifier._gpg = counting_gpg
+        ldi.check_reports = counting_check_reports
+        try:
+            cmd, status = run_command(
+                'upload', '--checkers=structure', REPODIR,
+                osp.join(TESTDIR, 'packages', 'signed_package',
+                         'package1_1.0-1_i386.changes'),
+                osp.join(TESTDIR, 'packages', 'signed_package_rev2',
+                         'package1_1.0-2_i386.changes'))
+        finally:
+            SignatureVerifier._gpg = gpg
+            ldi.check_reports = check_reports
+        self.assertEqual(status, 0, HANDLER.msgs)
+        self.assertEqual(len(cmd.debian_changes['unstable']), 2)
+        # changes and dsc files of both uploads verified by a single gpg
+        # process, files of both uploads checked at once
+        self.assertEqual(calls, {'gpg': 1, 'check_reports': 1})
+
+    def test_upload_remove_relative_path(self):
+        srcdir = osp.join(TESTDIR, 'data', 'src')
+        shutil.copytree(osp.join(TESTDIR, 'packages', 'signed_package'), srcdir)
+        cwd = os.getcwd()
+        os.chdir(srcdir)
+        try:
+            cmd, status = run_command('upload', '--remove',
+                                      '--checkers=structure', '-d', 'unstable',
+                                      REPODIR, 'package1_1.0-1_i386.changes')
+            self.assertEqual(status, 0, HANDLER.msgs)
+            self.assertEqual(os.listdir(srcdir), [])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(srcdir)
+        self.assertEqual(len(os.listdir(osp.join(REPODIR, 'incoming',
+                                                 'unstable'))), 5)
+
     def test_upload_unsigned_changes(self):
         changesfile = osp.join(TESTDIR, 'packages', 'unsigned_package', 'package1_1.0-1_i386.changes')
         cmd, status = run_command('upload', REPODIR, changesfile)
@@ -115,5 +174,131 @@ class LdiPublishTC(TestCase):
         self.assertEqual(cmd.returncode, 0, err)
 
 
+class LdiRefreshTC(TestCase):
+    def setUp(self):
+        changesfile = osp.join(TESTDIR, 'packages', 'signed_package', 'package1_1.0-1_i386.changes')
+        cmd, status = run_command('upload', '--checkers=structure', REPODIR,
+                                  changesfile)
+        assert status == 0, HANDLER.msgs
+    tearDown = _tearDown
+
+    def test_publish_refresh(self):
+        cmd, status = run_command('publish', '--no-confirm', '--refresh',
+                                  '--checkers=structure', '--publish-jobs=3',
+                                  REPODIR)
+        self.assertEqual(status, 0, HANDLER.msgs)
+        for dist in ('testing', 'stable', 'unstable'):
+            self.assertTrue(osp.isfile(osp.join(REPODIR, 'dists', dist,
+                                                'Release')), dist)
+        with open(osp.join(REPODIR, 'dists', 'unstable', 'Packages')) as stream:
+            self.assertIn('Package: package1\n', stream.read())
+
+    def test_refresh_unchanged(self):
+        cmd, status = run_command('publish', '--no-confirm', '--refresh',
+                                  '--checkers=structure', REPODIR)
+        self.assertEqual(status, 0, HANDLER.msgs)
+        release = osp.join(REPODIR, 'dists', 'unstable', 'Release')
+        mtime = os.stat(release).st_mtime
+        HANDLER.msgs.clear()
+        cmd, status = run_command('publish', '--no-confirm', '--refresh',
+                                  REPODIR)
+        self.assertEqual(status, 0, HANDLER.msgs)
+        self.assertIn('unstable is up to date', HANDLER.msgs['INFO'])
+        self.assertEqual(os.stat(release).st_mtime, mtime)
+        cmd, status = run_command('publish', '--no-confirm', '--force-refresh',
+                                  REPODIR)
+        self.assertEqual(status, 0, HANDLER.msgs)
+        self.assertNotEqual(os.stat(release).st_mtime, mtime)
+
+    def test_publish_coalesce(self):
+        repo = DebianRepository(None, REPODIR)
+        # a request registered by a publisher which stopped before processing
+        # it
+        repo.request_publish()
+        cmd, status = run_command('publish', '--coalesce',
+                                  '--checkers=structure', REPODIR)
+        self.assertEqual(status, 0, HANDLER.msgs)
+        self.assertIn('publication pass 1 for 2 requests',
+                      HANDLER.msgs['INFO'])
+        self.assertEqual(repo.publish_requests(), [])
+        self.assertTrue(osp.isfile(osp.join(REPODIR, 'dists', 'unstable',
+                                            'package1_1.0-1_i386.changes')))
+
+    def test_publish_coalesce_running(self):
+        repo = DebianRepository(None, REPODIR)
+        publisher = repo.publisher_lock()
+        publisher.acquire(timeout=0)
+        try:
+            cmd, status = run_command('publish', '--coalesce',
+                                      '--checkers=structure', REPODIR)
+        finally:
+            publisher.release()
+        self.assertEqual(status, 0, HANDLER.msgs)
+        self.assertIn('publication requested to the running publisher',
+                      HANDLER.msgs['INFO'])
+        self.assertEqual(len(repo.publish_requests()), 1)
+        # the lock file left by the previous publisher doesn't prevent a new
+        # one from running
+        self.assertTrue(osp.exists(osp.join(repo.locks_directory,
+                                            'publisher')))
+        cmd, status = run_command('publish', '--coalesce',
+                                  '--checkers=structure', REPODIR)
+        self.assertEqual(status, 0, HANDLER.msgs)
+        self.assertEqual(repo.publish_requests(), [])
+
+    def test_publish_stage_failure(self):
+        def index_stage(self, repo, item, emit):
+            raise OSError('disk full')
+        orig = ldi.Publish._index_stage
+        ldi.Publish._index_stage = index_stage
+        try:
+            cmd, status = run_command('publish', '--no-confirm',
+                                      '--checkers=structure', REPODIR)
+        finally:
+            ldi.Publish._index_stage = orig
+        self.assertEqual(status, 2)
+        self.assertIn('publication failed in index stage',
+                      HANDLER.msgs['ERROR'])
+
+
+class LdiDaemonTC(TestCase):
+    tearDown = _tearDown
+
+    def test_serve(self):
+        repo = DebianRepository(logging.getLogger('test'), REPODIR)
+        server = LdiDaemon(repo.logger, repo, LDI, debounce=0.1,
+                           publish_args=['--checkers=structure'])
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            for _ in range(100):
+                if osp.exists(socket_path(REPODIR)):
+                    break
+                time.sleep(0.05)
+            changesfile = osp.join(TESTDIR, 'packages', 'signed_package',
+                                   'package1_1.0-1_i386.changes')
+            cmd, status = run_command('upload', '--checkers=structure',
+                                      REPODIR, changesfile)
+            self.assertEqual(status, 0, HANDLER.msgs)
+            # run by the daemon, which published the incoming queue
+            published = osp.join(REPODIR, 'dists', 'unstable',
+                                 'package1_1.0-1_i386.changes')
+            for _ in range(100):
+                if osp.exists(published):
+                    break
+                time.sleep(0.05)
+            self.assertTrue(osp.exists(published))
+            # kept open for the next commands
+            self.assertTrue(repo._metadata)
+            self.assertIn(('digests', repo.cache_directory),
+                          [(cls.table, cachedir)
+                           for cachedir, cls in repo._caches])
+        finally:
+            server.stop()
+            thread.join(10)
+            repo.close()
+        self.assertFalse(osp.exists(socket_path(REPODIR)))
+
+
 if __name__ == '__main__':
     unittest_main()
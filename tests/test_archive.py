@@ -0,0 +1,73 @@
+import logging
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.archive import ArchiveStore, pool_prefix
+
+TESTDIR = osp.abspath(osp.dirname(__file__))
+PKGDIR = osp.join(TESTDIR, 'packages', 'signed_package')
+
+
+class ArchiveStore_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = ArchiveStore(self.tmpdir, logging.getLogger('test'))
+        os.makedirs(osp.join(self.tmpdir, 'unstable'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pool_prefix(self):
+        self.assertEqual(pool_prefix('package1'), 'p')
+        self.assertEqual(pool_prefix('libfoo'), 'libf')
+        self.assertEqual(pool_prefix('lib'), 'l')
+
+    def test_archive(self):
+        srcdir = osp.join(self.tmpdir, 'src')
+        shutil.copytree(PKGDIR, srcdir)
+        self.archive.archive('unstable', 'package1',
+                             osp.join(srcdir, 'package1_1.0-1_all.deb'),
+                             'reduce')
+        self.archive.archive('unstable', 'package1',
+                             osp.join(srcdir, 'package1_1.0-1.dsc'),
+                             'reduce', copy=True)
+        self.assertFalse(osp.exists(osp.join(srcdir, 'package1_1.0-1_all.deb')))
+        self.assertTrue(osp.exists(osp.join(srcdir, 'package1_1.0-1.dsc')))
+        pkgdir = osp.join(self.tmpdir, 'unstable', 'p', 'package1')
+        self.assertEqual(self.archive.files('unstable', 'package1'),
+                         [osp.join(pkgdir, 'package1_1.0-1.dsc'),
+                          osp.join(pkgdir, 'package1_1.0-1_all.deb')])
+        entries = list(self.archive.entries('package1'))
+        self.assertEqual([entry[1:] for entry in entries], [
+            ('unstable', 'package1', 'p/package1/package1_1.0-1_all.deb',
+             'reduce'),
+            ('unstable', 'package1', 'p/package1/package1_1.0-1.dsc',
+             'reduce')])
+        self.assertEqual(list(self.archive.entries('package2')), [])
+        # looked up in the manifest of the source package
+        os.remove(self.archive.manifest)
+        self.assertEqual(list(self.archive.entries('package1')), entries)
+        self.assertEqual(list(self.archive.entries('package1', ['stable'])),
+                         [])
+
+    def test_migrate(self):
+        distdir = osp.join(self.tmpdir, 'unstable')
+        for fname in os.listdir(PKGDIR):
+            shutil.copy(osp.join(PKGDIR, fname), distdir)
+        shutil.copy(osp.join(PKGDIR, 'package1_1.0-1_all.deb'),
+                    osp.join(distdir, 'other_1.0_all.deb'))
+        self.assertEqual(self.archive.migrate('unstable'), 6)
+        self.assertEqual(sorted(os.listdir(distdir)), ['o', 'p'])
+        self.assertEqual(len(self.archive.files('unstable', 'package1')), 5)
+        self.assertEqual([entry[3] for entry in self.archive.entries('other')],
+                         ['o/other/other_1.0_all.deb'])
+        # nothing left to migrate
+        self.assertEqual(self.archive.migrate('unstable'), 0)
+
+
+if __name__ == '__main__':
+    unittest_main()
@@ -0,0 +1,101 @@
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.cache import HashCache, open_cache, stat_key
+from debinstall.debfiles import digest_file
+
+TESTDIR = osp.abspath(osp.dirname(__file__))
+
+
+class HashCache_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = open_cache(osp.join(self.tmpdir, 'cache'), HashCache, 3)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _file(self, name, content):
+        path = osp.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_hit_and_miss(self):
+        path = self._file('a', b'some content')
+        digests = digest_file(path, ('md5',), self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        self.assertEqual(digest_file(path, ('md5',), self.cache), digests)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        # sha1 is unknown yet
+        digest_file(path, ('sha1', 'md5'), self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual(sorted(self.cache.get(stat_key(path), ('md5',))),
+                         ['md5', 'sha1'])
+
+    def test_modified_file(self):
+        path = self._file('a', b'some content')
+        digests = digest_file(path, ('md5',), self.cache)
+        path = self._file('a', b'other content, other size')
+        self.assertNotEqual(digest_file(path, ('md5',), self.cache), digests)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_rewritten_file(self):
+        path = self._file('a', b'some content')
+        st = os.stat(path)
+        digests = digest_file(path, ('md5',), self.cache)
+        # same size, mtime restored: only the ctime tells the file changed
+        path = self._file('a', b'evil content')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(stat_key(path)[:4], (st.st_dev, st.st_ino, st.st_size,
+                                               st.st_mtime_ns))
+        self.assertNotEqual(digest_file(path, ('md5',), self.cache), digests)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_old_schema(self):
+        self.cache.close()
+        path = osp.join(self.tmpdir, 'cache', 'digests.db')
+        os.unlink(path)
+        import sqlite3
+        cnx = sqlite3.connect(path)
+        cnx.execute('CREATE TABLE digests (dev INTEGER, ino INTEGER, '
+                    'size INTEGER, mtime_ns INTEGER, sha256 TEXT, sha1 TEXT, '
+                    'md5 TEXT, last_used REAL)')
+        cnx.commit()
+        cnx.close()
+        self.cache = open_cache(osp.join(self.tmpdir, 'cache'), HashCache, 3)
+        path = self._file('a', b'some content')
+        digests = digest_file(path, ('md5',), self.cache)
+        self.assertEqual(digest_file(path, ('md5',), self.cache), digests)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_concurrent_connections(self):
+        path = self._file('a', b'some content')
+        digest_file(path, ('md5',), self.cache)
+        other = open_cache(osp.join(self.tmpdir, 'cache'), HashCache, 3)
+        other.cnx.execute('PRAGMA busy_timeout=100')
+        try:
+            digest_file(path, ('md5',), self.cache)
+            self.assertEqual(self.cache.hits, 1)
+            # the hit didn't leave the database locked
+            digest_file(self._file('b', b'other content'), ('md5',), other)
+        finally:
+            other.close()
+
+    def test_eviction(self):
+        for i in range(5):
+            digest_file(self._file(str(i), b'x' * i), ('md5',), self.cache)
+        self.cache.evict()
+        self.assertEqual(self.cache.execute('SELECT COUNT(*) FROM digests'),
+                         [(3,)])
+        self.assertIsNone(self.cache.get(stat_key(osp.join(self.tmpdir, '0')),
+                                         ('md5',)))
+
+
+if __name__ == '__main__':
+    unittest_main()
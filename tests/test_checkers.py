@@ -0,0 +1,300 @@
+import os
+import os.path as osp
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.cache import CheckerCache, open_cache
+from debinstall.checkers import (ALL_CHECKERS, Checker, LintianChecker,
+                                 StructureChecker, process_options,
+                                 run_checkers)
+from debinstall.debfiles import CheckerError
+
+TESTDIR = osp.abspath(osp.dirname(__file__))
+CHANGES = osp.join(TESTDIR, 'packages', 'signed_package',
+                   'package1_1.0-1_i386.changes')
+
+
+class ShellChecker(Checker):
+    """fails and counts its runs in the file given as first argument"""
+    name = 'shell'
+    command = 'sh'
+    version_options = ['-c', 'echo 1.0']
+    ok_status = (0, )
+
+    def __init__(self, counter):
+        self.options = ['-c', 'echo run >> %s; echo out; echo err >&2; exit 3'
+                        % counter, 'sh']
+
+
+class CheckerCache_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.counter = osp.join(self.tmpdir, 'counter')
+        self.cache = open_cache(self.tmpdir, CheckerCache, 10)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def runs(self):
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+    def test_cached_failure(self):
+        checker = ShellChecker(self.counter)
+        result = checker.run(CHANGES, self.cache)
+        self.assertEqual(result, (False, b'out\n', b'err\n'))
+        self.assertEqual(checker.run(CHANGES, self.cache), result)
+        self.assertEqual(self.runs(), 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_options_change(self):
+        checker = ShellChecker(self.counter)
+        checker.run(CHANGES, self.cache)
+        checker.options = checker.options + ['--other']
+        checker.run(CHANGES, self.cache)
+        self.assertEqual(self.runs(), 2)
+
+
+class SleepChecker(Checker):
+    name = 'sleep'
+    command = 'sh'
+    options = ['-c', 'sleep 10', 'sh']
+
+
+class IdChecker(Checker):
+    """fails and reports the ids it runs with"""
+    name = 'id'
+    command = 'sh'
+    options = ['-c', 'sleep 0.5; id -u; id -g; exit 1', 'sh']
+
+
+class RunCheckers_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        ALL_CHECKERS['shell'] = ShellChecker(osp.join(self.tmpdir, 'counter'))
+        ALL_CHECKERS['sleep'] = SleepChecker()
+
+    def tearDown(self):
+        del ALL_CHECKERS['shell'], ALL_CHECKERS['sleep']
+        shutil.rmtree(self.tmpdir)
+
+    def test_aggregated_errors(self):
+        other = osp.join(TESTDIR, 'packages', 'signed_package_rev2',
+                         'package1_1.0-2_i386.changes')
+        errors = run_checkers([CHANGES, other], ['shell', 'shell'], jobs=3)
+        self.assertEqual(sorted(errors), sorted([CHANGES, other]))
+        for changesfile, error in errors.items():
+            self.assertIsInstance(error, CheckerError)
+            self.assertEqual(str(error).count('checker shell is in error on %s'
+                                              % changesfile), 2)
+
+    def test_timeout(self):
+        errors = run_checkers([CHANGES], ['sleep'], timeout=0.2)
+        self.assertIn('killed after 0.2 seconds', str(errors[CHANGES]))
+
+    def test_unknown_checker(self):
+        self.assertRaises(Exception, run_checkers, [CHANGES], ['unknown'])
+
+    def test_process_options(self):
+        if sys.version_info < (3, 9):
+            self.skipTest('preexec_fn needed to drop privileges')
+        # other threads run while checkers are spawned
+        options = process_options(new_session=True)
+        self.assertNotIn('preexec_fn', options)
+        self.assertTrue(options['start_new_session'])
+
+    def test_real_user_privileges(self):
+        if os.getuid():
+            self.skipTest('must be root to change the effective user')
+        ALL_CHECKERS['id'] = IdChecker()
+        os.setegid(65534)
+        os.seteuid(65534)
+        try:
+            errors = {}
+            thread = threading.Thread(target=lambda: errors.update(
+                run_checkers([CHANGES], ['id'])))
+            thread.start()
+            # other threads keep the effective privileges of ldi
+            euids = set()
+            while thread.is_alive():
+                euids.add(os.geteuid())
+                time.sleep(0.05)
+            thread.join()
+        finally:
+            os.seteuid(0)
+            os.setegid(0)
+            del ALL_CHECKERS['id']
+        self.assertEqual(euids, set([65534]))
+        # output is given as bytes
+        self.assertIn('0\n0\n', str(errors[CHANGES]).replace('\\n', '\n'))
+
+
+FAKE_LINTIAN = r"""
+echo run >> $0
+for f; do
+    n=$(basename $f .changes); p=${n%%_*}
+    echo "N: Processing changes file $p (version 1.0-1, arch all) ..."
+    case $p in
+        bad*) echo "E: $p: some-error"; st=1;;
+        *) echo "W: $p source: some-warning";;
+    esac
+done
+exit ${st:-0}
+"""
+
+CHANGES_TEMPLATE = """Source: %(name)s
+Binary: %(name)s %(name)s-dbg
+Version: 1.0-1
+Architecture: all
+Files:
+ d41d8cd98f00b204e9800998ecf8427e 0 misc extra %(name)s_1.0-1_all.deb
+"""
+
+class FakeLintianChecker(LintianChecker):
+    command = 'sh'
+    version_options = ['-c', 'echo 1.0']
+
+    def __init__(self, counter):
+        self.options = ['-c', FAKE_LINTIAN, counter]
+
+
+class LintianBatch_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.counter = osp.join(self.tmpdir, 'counter')
+        self.checker = FakeLintianChecker(self.counter)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _changes(self, name):
+        path = osp.join(self.tmpdir, '%s_1.0-1_all.changes' % name)
+        with open(path, 'w') as f:
+            f.write(CHANGES_TEMPLATE % {'name': name})
+        return path
+
+    def runs(self):
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+    def test_split_output(self):
+        good, bad = self._changes('good'), self._changes('bad')
+        results = self.checker.run_batch([good, bad])
+        self.assertEqual(self.runs(), 1)
+        self.assertTrue(results[good][0])
+        self.assertFalse(results[bad][0])
+        self.assertIn(b'W: good source: some-warning', results[good][1])
+        self.assertNotIn(b'bad', results[good][1])
+        self.assertIn(b'E: bad: some-error', results[bad][1])
+
+    def test_ambiguous_fallback(self):
+        other = osp.join(TESTDIR, 'packages', 'signed_package_rev2',
+                         'package1_1.0-2_i386.changes')
+        results = self.checker.run_batch([CHANGES, other])
+        self.assertEqual(self.runs(), 2)
+        self.assertTrue(results[CHANGES][0])
+        self.assertTrue(results[other][0])
+
+    def test_batch_size(self):
+        ALL_CHECKERS['fake'] = self.checker
+        try:
+            changesfiles = [self._changes('good%s' % i) for i in range(5)]
+            errors = run_checkers(changesfiles, ['fake'], batchsize=2)
+        finally:
+            del ALL_CHECKERS['fake']
+        self.assertEqual(self.runs(), 3)
+        self.assertEqual(list(errors.values()), [None] * 5)
+
+
+class StructureChecker_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        srcdir = osp.join(TESTDIR, 'packages', 'signed_package')
+        for fname in os.listdir(srcdir):
+            shutil.copy(osp.join(srcdir, fname), self.tmpdir)
+        self.changes = osp.join(self.tmpdir, 'package1_1.0-1_i386.changes')
+        self.deb = osp.join(self.tmpdir, 'package1_1.0-1_all.deb')
+        self.checker = StructureChecker()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_valid(self):
+        self.assertEqual(self.checker.check(self.changes), [])
+
+    def test_bad_size(self):
+        with open(self.deb, 'ab') as f:
+            f.write(b'x')
+        self.assertEqual(self.checker.check(self.changes),
+                         ['package1_1.0-1_all.deb: size is 1855, 1854 expected'])
+
+    def test_corrupted_deb(self):
+        with open(self.deb, 'r+b') as f:
+            f.seek(800)
+            f.write(b'\0' * 100)
+        errors = self.checker.check(self.changes)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('package1_1.0-1_all.deb: '))
+
+    def test_misnamed_deb(self):
+        # declare the deb under another name in the changes file
+        misnamed = osp.join(self.tmpdir, 'package1_1.0-2_all.deb')
+        os.rename(self.deb, misnamed)
+        with open(self.changes) as f:
+            content = f.read()
+        with open(self.changes, 'w') as f:
+            f.write(content.replace('package1_1.0-1_all.deb',
+                                    'package1_1.0-2_all.deb'))
+        self.assertEqual(self.checker.check(self.changes),
+                         ['package1_1.0-2_all.deb: file name does not match '
+                          'control file (package1_1.0-1_all)'])
+
+    def test_missing_decompressor(self):
+        # zstd compressed members, zstandard being an optional dependency
+        members = [('debian-binary', b'2.0\n'),
+                   ('control.tar.zst', b'\x28\xb5\x2f\xfd' + b'x' * 100),
+                   ('data.tar.zst', b'\x28\xb5\x2f\xfd' + b'y' * 101)]
+        with open(self.deb, 'wb') as f:
+            f.write(b'!<arch>\n')
+            for name, data in members:
+                f.write(('%-16s%-12s%-6s%-6s%-8s%-10s`\n' % (
+                    name, 0, 0, 0, 100644, len(data))).encode('ascii'))
+                f.write(data + b'\n' * (len(data) % 2))
+        zstandard = sys.modules.get('zstandard')
+        sys.modules['zstandard'] = None # import fails
+        try:
+            self.assertEqual(self.checker.check_deb(self.deb), [])
+        finally:
+            if zstandard is None:
+                del sys.modules['zstandard']
+            else:
+                sys.modules['zstandard'] = zstandard
+
+    def test_missing_files_field(self):
+        with open(self.changes) as f:
+            content = f.read()
+        with open(self.changes, 'w') as f:
+            f.write(content.replace('Files: \n', 'Other: \n'))
+        self.assertEqual(self.checker.check(self.changes),
+                         ['package1_1.0-1_i386.changes: missing Files field'])
+
+    def test_short_circuit(self):
+        counter = osp.join(self.tmpdir, 'counter')
+        ALL_CHECKERS['shell'] = ShellChecker(counter)
+        try:
+            os.remove(self.deb)
+            errors = run_checkers([self.changes], ['shell', 'structure'])
+        finally:
+            del ALL_CHECKERS['shell']
+        self.assertFalse(osp.exists(counter))
+        self.assertIn('checker structure is in error', str(errors[self.changes]))
+
+
+if __name__ == '__main__':
+    unittest_main()
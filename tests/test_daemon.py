@@ -0,0 +1,109 @@
+import logging
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.daemon import (InotifyWatcher, LdiDaemon, PollingWatcher,
+                                check_arguments, watcher)
+from debinstall.debrepo import DebianRepository
+
+
+class Watcher_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _test_watcher(self, watch):
+        try:
+            watch.watch([self.tmpdir])
+            self.assertEqual(watch.wait(0), set())
+            with open(osp.join(self.tmpdir, 'a.changes'), 'w') as stream:
+                stream.write('Source: a\n')
+            self.assertEqual(watch.wait(5), set([self.tmpdir]))
+            watch.watch([])
+            with open(osp.join(self.tmpdir, 'b.changes'), 'w') as stream:
+                stream.write('Source: b\n')
+            self.assertEqual(watch.wait(0.1), set())
+        finally:
+            watch.close()
+
+    def test_polling(self):
+        watch = PollingWatcher()
+        watch.delay = 0.01
+        # modification times may have a coarse resolution
+        watch.watch([self.tmpdir])
+        watch.directories[self.tmpdir] = None
+        self.assertEqual(watch.wait(0), set([self.tmpdir]))
+        watch.watch([])
+        self.assertEqual(watch.wait(0), set())
+
+    def test_inotify(self):
+        watch = watcher()
+        if not isinstance(watch, InotifyWatcher):
+            watch.close()
+            self.skipTest('inotify not available')
+        self._test_watcher(watch)
+
+
+class Requests_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for subdir in ('incoming', 'dists'):
+            os.mkdir(osp.join(self.tmpdir, subdir))
+        self.repo = DebianRepository(logging.getLogger('test'), self.tmpdir)
+        self.daemon = LdiDaemon(self.repo.logger, self.repo, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_check_arguments(self):
+        self.assertEqual(check_arguments('upload', ['-d', 'unstable',
+                                                    '--checkers=structure',
+                                                    'repo', 'a.changes']),
+                         ['repo', 'a.changes'])
+        self.assertEqual(check_arguments('publish', ['-C', '', '-u', 'repo']),
+                         ['repo'])
+        for command, args in (('create', ['repo']),
+                              ('upload', ['--remove', 'repo', 'a.changes']),
+                              ('upload', ['-rd', 'unstable', 'repo']),
+                              ('upload', ['--upload-group=x', 'repo']),
+                              ('publish', ['-u', '--gpg-keyid=X', 'repo']),
+                              ('publish', ['-u', '--rcfile', 'x', 'repo']),
+                              # would ask for a confirmation
+                              ('publish', ['repo'])):
+            self.assertRaises(ValueError, check_arguments, command, args)
+
+    def test_check_request(self):
+        request = {'command': 'publish', 'args': [u'-u', self.tmpdir]}
+        self.assertIsNone(self.daemon.check_request(request,
+                                                    (1, os.geteuid(), 1)))
+        self.assertTrue(self.daemon.check_request(request, None))
+        # another repository
+        other = {'command': 'publish', 'args': [u'-u', u'/tmp']}
+        self.assertTrue(self.daemon.check_request(other, (1, os.geteuid(), 1)))
+        if os.geteuid():
+            self.skipTest('must be root to give the directories away')
+        os.chown(osp.join(self.tmpdir, 'dists'), -1, 12345)
+        self.assertIn('not allowed to publish',
+                      self.daemon.check_request(request, (1, 54321, 54321)))
+        self.assertIsNone(self.daemon.check_request(request,
+                                                    (1, 54321, 12345)))
+        # files of others aren't uploaded
+        os.chown(osp.join(self.tmpdir, 'incoming'), -1, 12345)
+        changes = osp.join(self.tmpdir, 'a.changes')
+        open(changes, 'w').close()
+        request = {'command': 'upload', 'args': [self.tmpdir, changes]}
+        self.assertIn('does not belong',
+                      self.daemon.check_request(request, (1, 54321, 12345)))
+        os.chown(changes, 54321, -1)
+        self.assertIsNone(self.daemon.check_request(request,
+                                                    (1, 54321, 12345)))
+
+
+if __name__ == '__main__':
+    unittest_main()
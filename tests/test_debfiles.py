@@ -1,5 +1,7 @@
 import os
 import os.path as osp
+import shutil
+import tempfile
 
 from logilab.common.testlib import TestCase, unittest_main
 
@@ -9,7 +11,10 @@ TESTDIR = osp.abspath(osp.dirname(__file__))
 
 class Changes_TC(TestCase):
     def setUp(self):
-        os.environ['GNUPGHOME'] = osp.join(TESTDIR, 'gnupg')
+        # gpg writes its state files in its home directory
+        self.gnupghome = tempfile.mkdtemp()
+        shutil.copy(osp.join(TESTDIR, 'gnupg', 'pubring.gpg'), self.gnupghome)
+        os.environ['GNUPGHOME'] = self.gnupghome
 
         self.packages_dir = osp.join(TESTDIR,
                                      "packages")
@@ -23,6 +28,9 @@ class Changes_TC(TestCase):
                                           "signed_no_source",
                                           'package1_1.0-1_i386.changes'))
 
+    def tearDown(self):
+        shutil.rmtree(self.gnupghome)
+
     def test_get_dsc(self):
         dsc = self.signed.get_dsc()
         self.assertEqual(dsc, osp.join(self.signed.dirname,
@@ -43,11 +51,165 @@ class Changes_TC(TestCase):
         result = self.signed.get_all_files()
         self.assertCountEqual(signed_files, result)
 
+    def test_fields(self):
+        self.assertEqual(self.signed['source'], 'package1')
+        self.assertEqual(self.signed['Description'],
+                         '\n package1   - dummy package to test debinstall')
+        self.assertNotIn('files', self.signed._parsed)
+        self.assertEqual(self.signed['Files'][0],
+                         {'md5sum': 'b1d035634c5c3ed512a63daf1d5a1b7c',
+                          'size': '859', 'section': 'misc', 'priority': 'extra',
+                          'name': 'package1_1.0-1.dsc'})
+        self.assertRaises(KeyError, self.signed.__getitem__, 'Checksums-Sha1')
+
+    def test_all_files_missing(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shutil.copy(self.signed.path, tmpdir)
+            changes = Changes(osp.join(tmpdir, self.signed.filename))
+            self.assertRaises(Exception, changes.get_all_files)
+            self.assertEqual(len(changes.get_all_files(False)), 5)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_check_sig(self):
         self.signed.check_sig()
         self.no_source.check_sig()
         self.assertRaises(BadSignature, self.unsigned.check_sig)
 
+    def test_verify_signatures_batch(self):
+        verifier = SignatureVerifier()
+        files = self.signed.signed_files() + [self.unsigned.path]
+        result = verifier.verify(files)
+        self.assertEqual([result[f].valid for f in files], [True, True, False])
+        self.assertEqual(result[self.signed.path].keyid, '099AD4C66AA05327')
+        self.assertEqual(self.signed.check_sig(verifier),
+                         ['099AD4C66AA05327', '5E93F8F2A827CEDE'])
+
+    def test_check_hashes(self):
+        report = self.signed.check_hashes()
+        self.assertTrue(report)
+        self.assertEqual(len(report.files), 4)
+        for fcheck in report.files:
+            self.assertEqual(list(fcheck.expected), ['md5'])
+        self.assertEqual(report.size, 859 + 188 + 1278 + 1854)
+
+    def test_check_hashes_mismatch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            srcdir = osp.join(self.packages_dir, 'signed_package')
+            for fname in os.listdir(srcdir):
+                shutil.copy(osp.join(srcdir, fname), tmpdir)
+            with open(osp.join(tmpdir, 'package1_1.0-1.diff.gz'), 'ab') as f:
+                f.write(b'garbage')
+            os.remove(osp.join(tmpdir, 'package1_1.0-1_all.deb'))
+            report = Changes(osp.join(tmpdir, 'package1_1.0-1_i386.changes')
+                             ).check_hashes()
+            self.assertFalse(report)
+            self.assertEqual([f.name for f in report.failures],
+                             ['package1_1.0-1.diff.gz', 'package1_1.0-1_all.deb'])
+            self.assertEqual(report.failures[0].mismatches, ['md5'])
+            self.assertIsNotNone(report.failures[1].error)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_check_reports_parallel(self):
+        rev2 = Changes(osp.join(self.packages_dir, 'signed_package_rev2',
+                                'package1_1.0-2_i386.changes'))
+        reports = [self.signed.hashes_report(), rev2.hashes_report()]
+        self.assertEqual(check_reports(reports, workers=3), reports)
+        self.assertTrue(all(reports))
+        self.assertEqual([len(r.files) for r in reports], [4, 3])
+        for report in reports:
+            self.assertTrue(all(f.computed for f in report.files))
+
+
+class ChangesCache_TC(TestCase):
+    def test_lru(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            srcdir = osp.join(TESTDIR, 'packages', 'signed_package')
+            paths = []
+            for arch in ('i386', 'amd64', 'armel'):
+                paths.append(osp.join(tmpdir, 'package1_1.0-1_%s.changes'
+                                      % arch))
+                shutil.copy(osp.join(srcdir, 'package1_1.0-1_i386.changes'),
+                            paths[-1])
+            cache = ChangesCache(size=2)
+            changes = cache.get(paths[0])
+            self.assertIs(cache.get(paths[0]), changes)
+            cache.get(paths[1])
+            cache.get(paths[2])
+            # least recently used entry evicted
+            self.assertIsNot(cache.get(paths[0]), changes)
+            self.assertEqual((cache.hits, cache.misses), (1, 4))
+            changes = cache.get(paths[0])
+            with open(paths[0], 'a') as stream:
+                stream.write('\n')
+            # modified file parsed again
+            self.assertIsNot(cache.get(paths[0]), changes)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class ReferenceIndex_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        srcdir = osp.join(TESTDIR, 'packages', 'signed_package')
+        for fname in os.listdir(srcdir):
+            shutil.copy(osp.join(srcdir, fname), self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared(self):
+        i386 = Changes(osp.join(self.tmpdir, 'package1_1.0-1_i386.changes'))
+        amd64 = osp.join(self.tmpdir, 'package1_1.0-1_amd64.changes')
+        shutil.copy(i386.path, amd64)
+        amd64 = Changes(amd64)
+        index = ReferenceIndex()
+        self.assertEqual(index.referrers(i386.get_dsc()),
+                         set([i386.path, amd64.path]))
+        self.assertEqual(index.shared(i386), i386.get_all_files() -
+                         set([i386.path]))
+        index.remove(amd64)
+        self.assertEqual(index.shared(i386), set())
+
+
+class DigestFile_TC(TestCase):
+    def test_single_pass_digests(self):
+        import hashlib
+        path = osp.join(TESTDIR, 'packages', 'signed_package',
+                        'package1_1.0.orig.tar.gz')
+        with open(path, 'rb') as f:
+            data = f.read()
+        digests = digest_file(path)
+        for algo in ('sha256', 'sha1', 'md5'):
+            self.assertEqual(digests[algo], hashlib.new(algo, data).hexdigest())
+        self.assertEqual(hash_file(hashlib.md5, path), digests['md5'])
+
+    def test_check_while_copying(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            changes = Changes(osp.join(TESTDIR, 'packages', 'signed_package',
+                                       'package1_1.0-1_i386.changes'))
+            fchecks = changes.hashes_report().files
+            for fcheck in fchecks:
+                fcheck.destination = osp.join(tmpdir, fcheck.name)
+            fchecks[0].expected['md5'] = '0' * 32
+            for fcheck in fchecks:
+                fcheck.check()
+            self.assertFalse(fchecks[0].ok)
+            # a copy which doesn't match is removed
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             sorted(fcheck.name for fcheck in fchecks[1:]))
+            for fcheck in fchecks[1:]:
+                self.assertTrue(fcheck.ok)
+                self.assertEqual(digest_file(fcheck.destination, ('md5',)),
+                                 fcheck.computed)
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     unittest_main()
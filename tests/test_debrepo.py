@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import os
+import os.path as osp
+import shutil
+import stat
+import tempfile
+import threading
+
+from lockfile import FileLock, LockError
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.debrepo import (APTDEFAULT_APTCONF, DebianRepository, Version,
+                                format_release, parse_aptconf, release_date)
+
+
+class AptConf_TC(TestCase):
+    def test_default(self):
+        options = parse_aptconf(APTDEFAULT_APTCONF % {'origin': 'Test',
+                                                      'archivedir': '/x'})
+        self.assertEqual(options['APT::FTPArchive::Release::Origin'], 'Test')
+        self.assertEqual(options['APT::FTPArchive::Release::Label'],
+                         'Test debian packages repository')
+        self.assertEqual(options['Default::Packages::Compress'],
+                         '. gzip bzip2')
+        self.assertEqual(options['Dir::ArchiveDir'], '/x')
+
+    def test_full_names(self):
+        options = parse_aptconf('APT::FTPArchive::Release::Suite "stable";\n'
+                                '// comment\nTree { "a"; "b"; };')
+        self.assertEqual(options['APT::FTPArchive::Release::Suite'], 'stable')
+        self.assertEqual(options['Tree'], ['a', 'b'])
+
+
+class Release_TC(TestCase):
+    def test_format(self):
+        digests = dict((algo, hashlib.new(algo, b'').hexdigest())
+                       for algo in ('md5', 'sha1', 'sha256'))
+        release = format_release({'Label': 'L', 'Origin': 'O',
+                                  'Codename': 'unstable',
+                                  'Date': release_date(0)},
+                                 {'Packages': (0, digests)})
+        self.assertEqual(release.splitlines()[:5], [
+            'Origin: O', 'Label: L', 'Codename: unstable',
+            'Date: Thu, 01 Jan 1970 00:00:00 UTC', 'MD5Sum:'])
+        self.assertIn(' d41d8cd98f00b204e9800998ecf8427e'
+                      '                0 Packages\n', release)
+
+
+class DebianRepository_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = DebianRepository(logging.getLogger('test'), self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_distribution_locks(self):
+        path = osp.join(self.repo.locks_directory, 'unstable')
+        acquired = []
+        def publish(dist):
+            with self.repo.lock(dist):
+                acquired.append(dist)
+        with self.repo.lock('unstable'):
+            self.assertTrue(FileLock(path).is_locked())
+            # other distributions and the repository aren't locked
+            thread = threading.Thread(target=publish, args=('stable',))
+            thread.start()
+            thread.join(10)
+            self.assertEqual(acquired, ['stable'])
+            with self.repo.lock():
+                pass
+        self.assertFalse(FileLock(path).is_locked())
+
+    def test_publisher_lock(self):
+        lock = self.repo.publisher_lock()
+        lock.acquire(timeout=0)
+        try:
+            self.assertRaises(LockError,
+                              self.repo.publisher_lock().acquire, timeout=0)
+        finally:
+            lock.release()
+        # nothing is left to be cleaned up
+        lock = self.repo.publisher_lock()
+        lock.acquire(timeout=0)
+        lock.release()
+
+    def test_private_cache_directory(self):
+        os.mkdir(self.repo.dists_directory)
+        directory = self.repo.private_cache_directory()
+        st = os.stat(directory)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o2770)
+        self.assertEqual(st.st_gid, os.stat(self.repo.dists_directory).st_gid)
+        if os.geteuid():
+            self.skipTest('must be root to give the directory away')
+        # created by someone else, eg. an uploader
+        os.chown(directory, 12345, -1)
+        repo = DebianRepository(logging.getLogger('test'), self.tmpdir)
+        self.assertIsNone(repo.private_cache_directory())
+
+    def test_metadata_directory(self):
+        for section in ('incoming', 'dists'):
+            os.mkdir(osp.join(self.tmpdir, section))
+        metadata = self.repo.metadata()
+        self.assertEqual(osp.dirname(metadata.path),
+                         self.repo.publisher_cache_directory)
+        self.repo.close()
+        if os.geteuid():
+            self.skipTest('must be root to give the directory away')
+        # an index others may have written isn't trusted
+        os.chown(self.repo.publisher_cache_directory, 12345, -1)
+        repo = DebianRepository(logging.getLogger('test'), self.tmpdir)
+        self.assertIsNone(repo.metadata())
+        self.assertEqual(repo.dists_changes_files([]), [])
+
+
+class Version_TC(TestCase):
+    def test_parse(self):
+        version = Version('1:2.3~rc1+dfsg-1-2')
+        self.assertEqual(version.epoch, 1)
+        self.assertEqual(version.upstream_version, '2.3~rc1+dfsg-1')
+        self.assertEqual(version.debian_version, '2')
+        self.assertEqual(version.series, (1, 2, 3))
+        self.assertEqual(str(version), '1:2.3~rc1+dfsg-1-2')
+        self.assertIs(Version('1:2.3~rc1+dfsg-1-2'), version)
+        self.assertEqual(Version('1.2').debian_version, None)
+        for invalid in ('', 'a1.0', '1.0 1', '1.0-a_b', 'x:1.0'):
+            self.assertRaises(ValueError, Version, invalid)
+
+    def test_series(self):
+        self.assertEqual(Version('1.2~rc1').series, Version('1.2.1-3').series)
+        self.assertEqual(Version('1.2~rc1').series, (0, 1, 2))
+        self.assertEqual(Version('1.02+dfsg').series, (0, 1, 2))
+        self.assertEqual(Version('2:3~beta.1').series, (2, 3))
+        self.assertNotEqual(Version('1.2').series, Version('1.3').series)
+
+    def test_ordering(self):
+        # sorted according to dpkg --compare-versions
+        versions = ['1.0~rc1', '1.0', '1.0-1~bpo1', '1.0-1', '1.0-1.1',
+                    '1.0-2', '1.0-10', '1.0a', '1.0+b1', '1.0.1', '2.0~~',
+                    '2.0~', '2.0', '1:0.9']
+        self.assertEqual([str(v) for v in sorted(Version(v) for v in
+                                                 reversed(versions))],
+                         versions)
+        self.assertEqual(Version('1.0'), Version('1.00'))
+        self.assertEqual(Version('1.0'), Version('1.0-0'))
+        self.assertNotEqual(Version('1.0'), Version('1.0.0'))
+
+
+if __name__ == '__main__':
+    unittest_main()
@@ -0,0 +1,115 @@
+import gzip
+import hashlib
+import logging
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.indexes import (IndexGenerator, StanzaStore, PACKAGES_ORDER,
+                                check_compressions, contents_file,
+                                format_stanza)
+
+TESTDIR = osp.abspath(osp.dirname(__file__))
+PKGDIR = osp.join(TESTDIR, 'packages', 'signed_package')
+
+
+class Stanza_TC(TestCase):
+    def test_field_order(self):
+        stanza = format_stanza([('Description', 'foo\n bar'),
+                                ('X-Custom', 'x'), ('Filename', 'a.deb'),
+                                ('Package', 'a'), ('Conffiles', '\n /etc/a')],
+                               PACKAGES_ORDER)
+        self.assertEqual(stanza, 'Package: a\nConffiles:\n /etc/a\n'
+                         'Filename: a.deb\nDescription: foo\n bar\n'
+                         'X-Custom: x\n')
+
+    def test_contents(self):
+        self.assertEqual(contents_file(['usr/bin/b\tutils/b',
+                                        'usr/bin/a\tutils/a',
+                                        'usr/bin/b\tadmin/c']),
+                         'usr/bin/a' + '\t' * 6 + '    utils/a\n'
+                         'usr/bin/b' + '\t' * 6 + '    utils/b,admin/c\n')
+
+
+class IndexGenerator_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.distdir = osp.join(self.tmpdir, 'unstable')
+        shutil.copytree(PKGDIR, self.distdir)
+        self.store = StanzaStore(osp.join(self.tmpdir, 'stanzas.db'))
+        self.generator = IndexGenerator(logging.getLogger('test'),
+                                        self.tmpdir, self.store)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self, name):
+        with open(osp.join(self.distdir, name), 'rb') as stream:
+            return stream.read().decode('utf-8')
+
+    def test_generate(self):
+        written = self.generator.generate('unstable')
+        self.assertIn('Packages.gz', written)
+        packages = self._read('Packages')
+        self.assertTrue(packages.startswith('Package: package1\n'))
+        self.assertIn('Filename: unstable/package1_1.0-1_all.deb\n', packages)
+        self.assertTrue(packages.endswith('\n\n'))
+        with gzip.open(osp.join(self.distdir, 'Packages.gz')) as stream:
+            self.assertEqual(stream.read().decode('utf-8'), packages)
+        sources = self._read('Sources')
+        self.assertIn('Directory: unstable\n', sources)
+        self.assertIn(' 859 package1_1.0-1.dsc\n', sources)
+        self.assertIn('usr/share/doc/package1/copyright', self._read('Contents'))
+
+    def test_incremental(self):
+        self.generator.generate('unstable')
+        keys = self.store.keys('unstable')
+        self.assertEqual(sorted(keys), ['package1_1.0-1.dsc',
+                                        'package1_1.0-1_all.deb'])
+        # nothing to read again
+        self.generator.update_store('unstable')
+        self.assertEqual(self.store.keys('unstable'), keys)
+        os.remove(osp.join(self.distdir, 'package1_1.0-1_all.deb'))
+        self.generator.generate('unstable')
+        self.assertEqual(self._read('Packages'), '')
+        self.assertEqual(self._read('Contents'), '')
+        self.assertNotEqual(self._read('Sources'), '')
+
+    def test_rewritten_file(self):
+        self.generator.generate('unstable')
+        sources = self._read('Sources')
+        # same size, mtime restored: only the ctime tells the file changed
+        path = osp.join(self.distdir, 'package1_1.0-1.dsc')
+        st = os.stat(path)
+        with open(path, 'r+b') as stream:
+            content = stream.read()
+            stream.seek(0)
+            stream.write(content.replace(b'package1', b'packageX', 1))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.generator.generate('unstable')
+        self.assertNotEqual(self._read('Sources'), sources)
+
+    def test_compressions(self):
+        self.assertEqual(check_compressions(['.', 'gzip', 'foo']), ['foo'])
+        self.generator.compressions = {'Packages': ['xz', 'gzip'],
+                                       'Sources': ['.']}
+        written = self.generator.generate('unstable')
+        self.assertEqual(sorted(written), [
+            'Contents', 'Contents.bz2', 'Contents.gz',
+            'Packages.gz', 'Packages.xz', 'Sources'])
+        self.assertFalse(osp.exists(osp.join(self.distdir, 'Packages')))
+        with open(osp.join(self.distdir, 'Packages.xz'), 'rb') as stream:
+            data = stream.read()
+        size, digests = written['Packages.xz']
+        self.assertEqual(size, len(data))
+        self.assertEqual(digests['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertFalse([fname for fname in os.listdir(self.distdir)
+                          if fname.endswith('.new')])
+
+
+if __name__ == '__main__':
+    unittest_main()
@@ -0,0 +1,71 @@
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.metadata import MetadataIndex
+
+TESTDIR = osp.abspath(osp.dirname(__file__))
+PKGDIR = osp.join(TESTDIR, 'packages')
+
+
+class MetadataIndex_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for section in ('incoming', 'dists'):
+            os.makedirs(osp.join(self.tmpdir, section, 'unstable'))
+        self.index = MetadataIndex(osp.join(self.tmpdir, 'metadata.db'),
+                                   self.tmpdir)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _publish(self, package):
+        distdir = osp.join(self.tmpdir, 'dists', 'unstable')
+        for fname in os.listdir(osp.join(PKGDIR, package)):
+            shutil.copy(osp.join(PKGDIR, package, fname), distdir)
+
+    def test_sync(self):
+        self.assertEqual(self.index.changes('dists'), [])
+        self._publish('signed_package')
+        # directory modification is detected without explicit sync
+        self.assertEqual(self.index.changes('dists'),
+                         [('unstable', 'package1_1.0-1_i386.changes',
+                           'package1', '1.0-1', 'i386')])
+        self.assertEqual(self.index.references('dists', 'unstable'), {
+            'package1_1.0-1_i386.changes': set([
+                'package1_1.0-1_i386.changes', 'package1_1.0-1_all.deb',
+                'package1_1.0-1.dsc', 'package1_1.0-1.diff.gz',
+                'package1_1.0.orig.tar.gz'])})
+        self._publish('signed_package_rev2')
+        os.remove(osp.join(self.tmpdir, 'dists', 'unstable',
+                           'package1_1.0-1_i386.changes'))
+        self.index.sync('dists', 'unstable', force=True)
+        self.assertEqual([row[1] for row in self.index.changes('dists')],
+                         ['package1_1.0-2_i386.changes'])
+        self.assertEqual(self.index.changes('incoming'), [])
+
+    def test_removed_distribution(self):
+        self._publish('signed_package')
+        self.assertEqual(len(self.index.changes('dists')), 1)
+        shutil.rmtree(osp.join(self.tmpdir, 'dists', 'unstable'))
+        self.assertEqual(self.index.changes('dists'), [])
+        self.assertEqual(self.index.cnx.execute(
+            'SELECT COUNT(*) FROM files').fetchall(), [(0,)])
+
+    def test_reindex(self):
+        self._publish('signed_package')
+        self.index.changes('dists')
+        self.index.cnx.execute('DELETE FROM changes')
+        self.index.cnx.commit()
+        # directory didn't change: the index is trusted
+        self.assertEqual(self.index.changes('dists'), [])
+        self.index.reindex()
+        self.assertEqual(len(self.index.changes('dists', ['unstable'])), 1)
+
+
+if __name__ == '__main__':
+    unittest_main()
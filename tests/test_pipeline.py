@@ -0,0 +1,39 @@
+import threading
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.pipeline import Stage, run_pipeline
+
+
+class Pipeline_TC(TestCase):
+    def test_stages(self):
+        results = []
+        lock = threading.Lock()
+        def double(item, emit):
+            emit(item * 2)
+        def odd(item, emit):
+            if item % 4:
+                emit(item)
+        def collect(item, emit):
+            if item == 6:
+                raise ValueError(item)
+            with lock:
+                results.append(item)
+        stages = run_pipeline([Stage('double', double), Stage('odd', odd),
+                               Stage('collect', collect, workers=3)],
+                              range(10), queue_size=2)
+        self.assertEqual(sorted(results), [2, 10, 14, 18])
+        self.assertEqual([stage.items for stage in stages], [10, 10, 5])
+        self.assertEqual([stage.errors for stage in stages], [0, 0, 1])
+        self.assertTrue(stages[0].report().startswith('double: 10 items, '))
+
+    def test_order(self):
+        results = []
+        run_pipeline([Stage('first', lambda item, emit: emit(item)),
+                      Stage('second', lambda item, emit: results.append(item))],
+                     range(100), queue_size=1)
+        self.assertEqual(results, list(range(100)))
+
+
+if __name__ == '__main__':
+    unittest_main()
@@ -0,0 +1,72 @@
+import os
+import os.path as osp
+import shutil
+import stat
+import tempfile
+
+from logilab.common.testlib import TestCase, unittest_main
+
+from debinstall.transfer import private_inode, transfer
+
+
+class Transfer_TC(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = osp.join(self.tmpdir, 'source')
+        with open(self.source, 'wb') as stream:
+            stream.write(b'x' * 100000)
+        os.chmod(self.source, 0o600)
+        self.destination = osp.join(self.tmpdir, 'destination')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _content(self, path):
+        with open(path, 'rb') as stream:
+            return stream.read()
+
+    def test_rename(self):
+        inode = os.stat(self.source).st_ino
+        self.assertEqual(transfer(self.source, self.destination, rename=True),
+                         'rename')
+        self.assertFalse(osp.exists(self.source))
+        st = os.stat(self.destination)
+        self.assertEqual(st.st_ino, inode)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o664)
+
+    def test_link(self):
+        self.assertEqual(transfer(self.source, self.destination, link=True),
+                         'link')
+        self.assertTrue(osp.samefile(self.source, self.destination))
+        self.assertEqual(stat.S_IMODE(os.stat(self.destination).st_mode),
+                         0o664)
+
+    def test_shared_source_copied(self):
+        # others may write the source: a link would let them modify the
+        # destination
+        os.chmod(self.source, 0o664)
+        self.assertFalse(private_inode(self.source))
+        method = transfer(self.source, self.destination, rename=True,
+                          link=True)
+        self.assertNotIn(method, ('rename', 'link'))
+        self.assertFalse(osp.samefile(self.source, self.destination))
+        os.chmod(self.source, 0o600)
+        os.link(self.source, osp.join(self.tmpdir, 'other'))
+        self.assertFalse(private_inode(self.source))
+        if os.geteuid() == 0:
+            os.unlink(osp.join(self.tmpdir, 'other'))
+            os.chown(self.source, 12345, -1)
+            self.assertFalse(private_inode(self.source))
+
+    def test_copy(self):
+        method = transfer(self.source, self.destination)
+        self.assertIn(method, ('reflink', 'copy_file_range', 'sendfile',
+                               'copy'))
+        self.assertFalse(osp.samefile(self.source, self.destination))
+        self.assertEqual(self._content(self.destination), b'x' * 100000)
+        # mode of copies is left to the caller
+        self.assertEqual(stat.S_IMODE(os.stat(self.source).st_mode), 0o600)
+
+
+if __name__ == '__main__':
+    unittest_main()
@@ -0,0 +1,175 @@
+# Copyright (c) 2007-2011 LOGILAB S.A. (Paris, FRANCE).
+# http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""transfer of package files into a repository, avoiding to copy data when the
+file system allows it.
+
+Methods are tried in this order:
+
+* rename, when the source file may disappear right away,
+* hard link, when the source file will be removed later,
+* reflink (copy on write clone, eg. on btrfs or xfs),
+* in-kernel copy with os.copy_file_range or os.sendfile,
+* buffered copy.
+
+Renamed or linked files share their inode with the source file, so their owner
+and anyone who opened them for writing could still modify them: only files
+which are private to the current user are renamed or linked (see
+`private_inode`), and they are only kept if their group and mode can be set as
+a copy's would be.
+"""
+
+import errno
+import os
+import os.path as osp
+import shutil
+import stat
+
+try:
+    import fcntl
+except ImportError: # not a unix platform
+    fcntl = None
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+BUFSIZE = 1 << 20
+# methods leaving the destination file with the source's inode
+INODE_METHODS = ('rename', 'link')
+
+
+def group_id(group):
+    """return the gid of a group name or id"""
+    try:
+        return int(group)
+    except ValueError:
+        import grp
+        return grp.getgrnam(group).gr_gid
+
+def _expected_gid(destination, group):
+    """return the group a file created as `destination` should have"""
+    if group:
+        return group_id(group)
+    dirstat = os.stat(osp.dirname(osp.abspath(destination)))
+    if dirstat.st_mode & stat.S_ISGID:
+        return dirstat.st_gid
+    return os.getegid()
+
+def private_inode(path):
+    """return True if `path` may only be written by the current user: it is
+    owned by the effective user, has no other hard link and isn't writable by
+    its group nor by others
+    """
+    st = os.lstat(path)
+    return (stat.S_ISREG(st.st_mode) and st.st_uid == os.geteuid()
+            and st.st_nlink == 1
+            and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+def _set_ownership(path, gid, mode):
+    """set group and mode of a file we don't necessarily own, raising OSError
+    on failure
+    """
+    st = os.stat(path)
+    if st.st_gid != gid:
+        os.chown(path, -1, gid)
+    if stat.S_IMODE(st.st_mode) != mode:
+        os.chmod(path, mode)
+
+def _rename(source, destination, gid, mode):
+    os.rename(source, destination)
+    try:
+        _set_ownership(destination, gid, mode)
+    except OSError:
+        os.rename(destination, source)
+        raise
+
+def _link(source, destination, gid, mode):
+    os.link(source, destination)
+    try:
+        _set_ownership(destination, gid, mode)
+    except OSError:
+        os.unlink(destination)
+        raise
+
+def _reflink(source, destination):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink not supported')
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def _kernel_copy(source, destination):
+    copy = getattr(os, 'copy_file_range', None)
+    if copy is None:
+        copy = getattr(os, 'sendfile', None)
+        if copy is None:
+            raise OSError(errno.ENOSYS, 'no in-kernel copy')
+        name = 'sendfile'
+    else:
+        name = 'copy_file_range'
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                if name == 'sendfile':
+                    copied = copy(dst.fileno(), src.fileno(), None,
+                                  min(remaining, 1 << 30))
+                else:
+                    copied = copy(src.fileno(), dst.fileno(),
+                                  min(remaining, 1 << 30))
+                if not copied:
+                    break
+                remaining -= copied
+    return name
+
+def _buffered_copy(source, destination):
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            shutil.copyfileobj(src, dst, BUFSIZE)
+
+def transfer(source, destination, rename=False, link=False, group=None,
+             mode=0o664):
+    """transfer `source` file to `destination` and return the name of the
+    method used.
+
+    `rename` tells the source file may be moved, `link` that it will be removed
+    afterwards so that a hard link may be used, which is only done for private
+    files. Copies are left to the caller for group and mode settings, renamed
+    or linked files get the given `group` (else the one of a new file) and
+    `mode`.
+    """
+    if (rename or link) and private_inode(source):
+        gid = _expected_gid(destination, group)
+        if rename:
+            try:
+                _rename(source, destination, gid, mode)
+                return 'rename'
+            except OSError:
+                pass
+        try:
+            _link(source, destination, gid, mode)
+            return 'link'
+        except OSError:
+            pass
+    try:
+        _reflink(source, destination)
+        return 'reflink'
+    except (OSError, IOError):
+        pass
+    try:
+        return _kernel_copy(source, destination)
+    except (OSError, IOError):
+        pass
+    _buffered_copy(source, destination)
+    return 'copy'